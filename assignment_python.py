@@ -1,180 +1,35 @@
-import sqlite3
-import random
-import time
-import matplotlib.pyplot as plt
-import xlsxwriter
 import datetime
-#from statistics import mean
-from collections import Counter
-import xlrd
-class TekXSimulator:
-    def __init__(self):
-        self.A = 0
-        self.B = 0
-        self.DO1 = 0
-        self.DO2 = 0
-        self.Tx = 0.0  
-
-    def update_status(self):
-        self.DO1 = random.randint(0, 1)
-        self.DO2 = random.randint(0, 1)
-        self.Tx = round(random.uniform(20, 30), 2)  # Simulated temperature reading
-
-class DeviceManager:
-    def __init__(self, device, db_filename, excel_filename):
-        self.device = device
-        self.db_filename = db_filename
-        self.excel_filename = excel_filename
-        self.create_db()
+import os
+import sys
+import tempfile
+import time
+import tekx_core
+from tekx_core import TekXSimulator, EXPORTERS, Metrics, downsample_trend, format_stats
+from tekx_ingest import IngestClient, default_authkey_file, read_authkey
 
-    def set_inputs(self, A, B):
-        self.device.A = A
-        self.device.B = B
-        self.device.update_status()
-        self.log_readings()
-        self.log_readings_to_excel()
 
-    #def get_status(self):
-    #    return self.device.DO1, self.device.DO2, self.device.Tx
-    def get_status(self):
-        conn = sqlite3.connect(self.db_filename)
-        c = conn.cursor()
-        c.execute('''SELECT * FROM readings WHERE serial_number = (SELECT MAX(serial_number) FROM readings)''')
-        data = c.fetchall()
-        conn.close()
+class DeviceManager(tekx_core.DeviceManager):
+    # The shared DeviceManager with console output: get_status prints, and the
+    # trends open pyplot windows. pyplot is imported on the first plot, so the
+    # menu (and everything that only reads or writes readings) starts without it.
+    def get_status(self, device_id=None):
+        version, latest = self.get_latest_reading(device_id)
 
-        if not data:
+        if latest is None:
+            device = self.devices[self.device_id if device_id is None else device_id]
             print("No data available. Setting all readings to 0.")
-            print("DO1:", self.device.DO1)
-            print("DO2:", self.device.DO2)
-            print("Tx:", self.device.Tx)
+            print("DO1:", device.DO1)
+            print("DO2:", device.DO2)
+            print("Tx:", device.Tx)
             return
 
-        for row in data:
-            print("DO1:", row[5])
-            print("DO2:", row[6])
-            print("Tx:", row[7])
-
-
-    def calculate_mode(self, data):
-        # Count occurrences of each value
-        counts = Counter(data)
-        # Get the most common value(s)
-        mode_values = counts.most_common(1)
-        if mode_values:  # Check if there are mode values
-            mode_value, mode_count = mode_values[0]
-            return mode_value 
-        else:
-            return None
-    def get_specific_date_trend(self, selected_date):
-        conn = sqlite3.connect(self.db_filename)
-        c = conn.cursor()
-
-        c.execute("SELECT timestamp, DO1, DO2,Tx FROM readings WHERE date = ? ORDER BY timestamp",
-                  (selected_date,))
-        data = c.fetchall()
-        conn.close()
-
-        timestamps = [row[0] for row in data]
-        DO1_values = [row[1] for row in data]
-        DO2_values = [row[2] for row in data]
-        Tx_values  = [row[3] for row in data]
-
-        return timestamps, DO1_values, DO2_values,Tx_values
-    def get_date_range_trend(self, start_date, end_date):
-        conn = sqlite3.connect(self.db_filename)
-        c = conn.cursor()
-
-        c.execute("SELECT date, DO1, DO2 ,Tx FROM readings WHERE date >= ? AND date <= ? ORDER BY date",
-              (start_date, end_date))
-        data = c.fetchall()
-        conn.close()
+        print("DO1:", latest[4])
+        print("DO2:", latest[5])
+        print("Tx:", latest[6])
 
-        date_dict = {}  # Dictionary to store DO1, DO2, and Tx values for each date
-        for row in data:
-            date = row[0]
-            DO1_value = row[1]
-            DO2_value = row[2]
-            tx_value = row[3]
-            if date not in date_dict:
-                date_dict[date] = {'DO1': [], 'DO2': [], 'Tx': []}
-        
-            date_dict[date]['DO1'].append(DO1_value)
-            date_dict[date]['DO2'].append(DO2_value)
-            date_dict[date]['Tx'].append(tx_value)
-        return date_dict
-    def calculate_average(self,number_list):
-        if not number_list:
-            return 0
-        
-        total = sum(number_list)
-        average = total / len(number_list)
-       # print(number_list,average)
-        return average       
-    def calculate_mode_for_dates(self, date_dict):
-        dates = []
-        do1_modes = []
-        do2_modes = []
-        tx_modes = []
-    
-        for date, values in date_dict.items():
-            if not values:
-                continue
-        
-            # Calculate mode for DO1 and DO2
-            do1_mode = self.calculate_mode(values['DO1'])
-            do2_mode = self.calculate_mode(values['DO2'])
-            tx_mode = self.calculate_average(values['Tx'])
-            # Append results to lists
-            dates.append(date)
-            do1_modes.append(do1_mode)
-            do2_modes.append(do2_mode)
-            tx_modes.append(tx_mode)
-    
-        return dates, do1_modes, do2_modes, tx_modes
-
-    def create_db(self):
-        conn = sqlite3.connect(self.db_filename)
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS readings
-                     (serial_number INTEGER PRIMARY KEY AUTOINCREMENT,
-                      timestamp REAL, date TEXT, A INTEGER, B INTEGER,
-                      DO1 INTEGER, DO2 INTEGER, Tx REAL)''')
-        conn.commit()
-        conn.close()
-
-    def log_readings(self):
-        conn = sqlite3.connect(self.db_filename)
-        c = conn.cursor()
-        timestamp = time.time()
-        date = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
-        c.execute("INSERT INTO readings (timestamp, date, A, B, DO1, DO2, Tx) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                  (timestamp, date, self.device.A, self.device.B, self.device.DO1, self.device.DO2, self.device.Tx))
-        conn.commit()
-        conn.close()
-
-
-    def log_readings_to_excel(self):
-        workbook = xlsxwriter.Workbook(self.excel_filename)
-        worksheet = workbook.add_worksheet()
-
-        # Write header
-        header = ['Timestamp', 'Date', 'A', 'B', 'DO1', 'DO2', 'Tx']
-        for col, item in enumerate(header):
-            worksheet.write(0, col, item)
-
-        # Write data
-        conn = sqlite3.connect(self.db_filename)
-        c = conn.cursor()
-        c.execute("SELECT timestamp, date, A, B, DO1, DO2, Tx FROM readings ORDER BY timestamp")
-        data = c.fetchall()
-        for row_idx, row_data in enumerate(data):
-            for col_idx, cell_data in enumerate(row_data):
-                worksheet.write(row_idx + 1, col_idx, cell_data)
-
-        workbook.close()
     def plot_weekly_trends_2d(self, start_date, end_date):
-        dates, DO1_values, DO2_values, Tx_values = self.calculate_mode_for_dates(self.get_date_range_trend(start_date, end_date))
+        import matplotlib.pyplot as plt
+        dates, DO1_values, DO2_values, Tx_values = self.get_date_range_aggregates(start_date, end_date)
 
         # Plot DO1 and DO2
         plt.plot(dates, DO1_values, marker='o', label='DO1')
@@ -196,18 +51,23 @@ class DeviceManager:
         plt.legend()
         plt.tight_layout()
         plt.show()
-    def plot_specific_date_trends_2d(self, selected_date):
-        timestamps, DO1_values, DO2_values, Tx_values = self.get_specific_date_trend(selected_date)
-        if not timestamps:
+
+    def plot_specific_date_trends_2d(self, selected_date, full_resolution=False):
+        import matplotlib.pyplot as plt
+        timestamps, DO1_values, DO2_values, Tx_values = self.get_specific_date_trend_arrays(selected_date,
+                                                                                           as_datetime64=True)
+        if not len(timestamps):
             print("No data available for the selected date.")
             return
 
-        timestamps = [datetime.datetime.fromtimestamp(ts) for ts in timestamps]
-        print(timestamps,DO1_values, DO2_values, Tx_values)
+        # Keep about one point per horizontal pixel unless asked for every reading.
+        max_points = None if full_resolution else int(plt.gcf().get_figwidth() * plt.gcf().dpi)
+        DO1_x, DO1_values, DO2_x, DO2_values, Tx_x, Tx_values = downsample_trend(
+            timestamps, DO1_values, DO2_values, Tx_values, max_points)
 
         # Plot DO1 and DO2
-        plt.plot(timestamps, DO1_values, marker='o', label='DO1')
-        plt.plot(timestamps, DO2_values, marker='s', label='DO2', linestyle='dashed')
+        plt.plot(DO1_x, DO1_values, marker='o', label='DO1')
+        plt.plot(DO2_x, DO2_values, marker='s', label='DO2', linestyle='dashed')
         plt.xlabel('TIMESTAMP')
         plt.ylabel('Value')
         plt.title('Trends of DO1 and DO2')
@@ -217,7 +77,7 @@ class DeviceManager:
         plt.show()
 
         # Plot temperature (Tx)
-        plt.plot(timestamps, Tx_values, marker='x', label='Temperature')
+        plt.plot(Tx_x, Tx_values, marker='x', label='Temperature')
         plt.xlabel('TIMESTAMP')
         plt.ylabel('Temperature')
         plt.title('Temperature Trend')
@@ -243,6 +103,73 @@ def add_sample_data_to_excel(workbook, date, A, B, DO1, DO2, Tx, timestamp):
 
 
 
+def measure_ingest_rate(counts=(1000, 10000, 100000)):
+    # Readings/s for one-commit-per-reading, a single executemany batch, and
+    # write-behind set_inputs, each against a fresh database.
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n in counts:
+            for method in ('log_readings', 'log_readings_batch', 'write_behind'):
+                simulator = TekXSimulator()
+                db_filename = os.path.join(tmpdir, "ingest_%s_%d.db" % (method, n))
+                manager = DeviceManager(simulator, db_filename, None, export_mode='manual',
+                                        write_behind=(method == 'write_behind'))
+                start = time.perf_counter()
+                if method == 'log_readings':
+                    for _ in range(n):
+                        simulator.update_status()
+                        manager.log_readings()
+                elif method == 'log_readings_batch':
+                    rows = []
+                    for _ in range(n):
+                        simulator.update_status()
+                        rows.append(manager.make_reading())
+                    manager.log_readings_batch(rows)
+                else:
+                    for _ in range(n):
+                        manager.set_inputs(1, 0)
+                    manager.flush()
+                elapsed = time.perf_counter() - start
+                manager.close()
+                results.append((method, n, n / elapsed))
+                print("%-20s %7d readings: %10.0f readings/s" % (method, n, n / elapsed))
+    return results
+
+def measure_fleet_polling(device_count=1000, interval=1.0, duration=10.0):
+    # Poll device_count simulators every `interval` seconds for `duration` seconds,
+    # with and without write-behind, and report how long each poll took.
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for write_behind in (False, True):
+            db_filename = os.path.join(tmpdir, "fleet_%s.db" % write_behind)
+            manager = DeviceManager(TekXSimulator(), db_filename, None, export_mode='manual',
+                                    write_behind=write_behind)
+            for device_id in range(1, device_count):
+                manager.register_device(device_id)
+            durations = []
+            deadline = time.monotonic() + duration
+            next_poll = time.monotonic()
+            while next_poll < deadline:
+                start = time.perf_counter()
+                manager.poll_devices()
+                durations.append(time.perf_counter() - start)
+                next_poll += interval
+                time.sleep(max(0.0, next_poll - time.monotonic()))
+            manager.flush()
+            with manager.db.reader() as conn:
+                logged = conn.execute("SELECT COUNT(*) FROM readings").fetchone()[0]
+            manager.close()
+            print("%-13s %d devices x %d polls: %d readings logged, poll mean %.1f ms, max %.1f ms"
+                  % ("write_behind" if write_behind else "batch", device_count, len(durations), logged,
+                     1000 * sum(durations) / len(durations), 1000 * max(durations)))
+
+def print_stats(summary):
+    # The streaming statistics, one column per window.
+    if not summary:
+        return
+    print("\n%-16s" % "Statistics" + "".join("%10s" % name for name in summary))
+    for label, values in format_stats(summary):
+        print("%-16s" % label + "".join("%10s" % value for value in values))
+
 def print_options():
     print("\nOptions:")
     print("1. Get Current Status")
@@ -250,15 +177,26 @@ def print_options():
     print("3. Get Weekly Trends")
     print("4. Get Trends for specific range")
     print("5. Get Trends for Specific Date")
-    print("6. Download Excel Report")
+    print("6. Download Report (Excel, CSV, Parquet, Arrow or binary)")
     print("7. Exit")
 
-def main():
+def main(metrics_filename=None, ingest_address=None):
     tekx_simulator = TekXSimulator()
     db_filename = "tekx_readings8.db"
     excel_filename = "tekx_readings8.xlsx"
 
-    device_manager = DeviceManager(tekx_simulator, db_filename, excel_filename)
+    # With metrics_filename every DeviceManager call and query is timed, and the
+    # metrics (JSON for .json, Prometheus text otherwise) are written there on
+    # exit. Slow queries are logged to <metrics_filename>.slow.jsonl as they happen.
+    metrics = Metrics(slow_query_log=metrics_filename + '.slow.jsonl') if metrics_filename else None
+    # With ingest_address readings are committed by the ingest daemon listening
+    # there (tekx_ingest.py), so this and other processes can log at the same time.
+    ingest = None
+    if ingest_address:
+        ingest = IngestClient(ingest_address, read_authkey(default_authkey_file(db_filename)))
+    device_manager = DeviceManager(tekx_simulator, db_filename, excel_filename,
+                                   export_mode='deferred', export_interval=30.0, export_threshold=1000,
+                                   write_behind=True, metrics=metrics, ingest=ingest)
    # add_sample_data_for_one_week(device_manager,excel_filename)
 
     while True:
@@ -268,6 +206,7 @@ def main():
         if choice == '1':
             print("Current Status:")
             device_manager.get_status()
+            print_stats(device_manager.get_online_stats())
             #print("DO1: {}, DO2: {}, Tx: {}".format(DO1, DO2, Tx))
         elif choice == '2':
             while True:
@@ -288,8 +227,9 @@ def main():
             device_manager.set_inputs(A, B)
             print("Inputs A and B configured successfully.")
         elif choice == '3':
-            start_date = datetime.datetime.now() - datetime.timedelta(days=7)
-            end_date = datetime.datetime.now()
+            # The last seven days, today included (bounds are whole days).
+            end_date = datetime.date.today()
+            start_date = end_date - datetime.timedelta(days=6)
             device_manager.plot_weekly_trends_2d( start_date, end_date)
         elif choice == '4':
             start_date=input("Enter the start date in 'YYYY-MM-DD' format: ")
@@ -299,15 +239,59 @@ def main():
             device_manager.plot_weekly_trends_2d( start_date, end_date)
         elif choice == '5':
             selected_date = input("Enter the date (YYYY-MM-DD): ")
-            device_manager.plot_specific_date_trends_2d(selected_date)
+            full_resolution = input("Plot every reading at full resolution? (y/N): ").strip().lower() == 'y'
+            device_manager.plot_specific_date_trends_2d(selected_date, full_resolution)
         elif choice == '6':
-            device_manager.log_readings_to_excel()
-            print("Excel report downloaded successfully.")
+            start_date = input("Enter the start date in 'YYYY-MM-DD' format (blank for all): ").strip() or None
+            end_date = input("Enter the end date in 'YYYY-MM-DD' format (blank for all): ").strip() or None
+            fmt = input("Enter the format (%s) [xlsx]: " % "/".join(EXPORTERS)).strip().lower() or 'xlsx'
+            try:
+                filenames, rows, elapsed = device_manager.export_readings(fmt, None, start_date, end_date)
+            except (ValueError, RuntimeError) as e:
+                print("Export failed:", e)
+                continue
+            print("Report downloaded successfully:", ", ".join(filenames) if len(filenames) <= 3
+                  else "%s ... (%d files)" % (filenames[0], len(filenames)))
+            print("%d readings in %.2f s (%.0f readings/s)" % (rows, elapsed, rows / elapsed if elapsed else 0))
         elif choice == '7':
             print("Exiting...")
+            try:
+                device_manager.close()
+            except RuntimeError as e:
+                # A background worker failed, e.g. readings that never reached the database.
+                print("Error:", e)
+            finally:
+                if ingest is not None:
+                    ingest.close()
+                if metrics is not None:
+                    metrics.write(metrics_filename)
+                    print("Metrics written to", metrics_filename)
             break
         else:
             print("Invalid choice. Please try again.")
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ['--ingest-rate']:
+        measure_ingest_rate()
+    elif sys.argv[1:] == ['--fleet-polling']:
+        measure_fleet_polling()
+    elif sys.argv[1:2] == ['--compact'] and len(sys.argv) in (3, 4):
+        # --compact DAYS [archive|delete]
+        with DeviceManager(TekXSimulator(), "tekx_readings8.db", None, export_mode='manual') as manager:
+            removed = manager.compact(int(sys.argv[2]), sys.argv[3] if len(sys.argv) == 4 else None)
+            print("Compacted %d readings older than %s days." % (removed, sys.argv[2]))
+    elif sys.argv[1:2] == ['--convert-storage'] and len(sys.argv) == 3:
+        # --convert-storage standard|packed
+        with DeviceManager(TekXSimulator(), "tekx_readings8.db", None, export_mode='manual') as manager:
+            before, after = manager.convert_storage(sys.argv[2])
+            print("Storage is now %s: %.1f MB -> %.1f MB." % (manager.storage, before / 1e6, after / 1e6))
+    elif sys.argv[1:] == ['--check-query-plans']:
+        with DeviceManager(TekXSimulator(), "tekx_readings8.db", None, export_mode='manual') as manager:
+            for name, (uses_index, details) in manager.check_query_plans().items():
+                print("%-22s %-8s %s" % (name, "OK" if uses_index else "NO INDEX", "; ".join(details)))
+    elif len(sys.argv) % 2 == 1 and set(sys.argv[1::2]) <= {'--metrics', '--ingest'}:
+        # [--metrics FILE] [--ingest ADDRESS]
+        options = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+        main(options.get('--metrics'), options.get('--ingest'))
+    else:
+        main()
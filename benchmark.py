@@ -0,0 +1,258 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import matplotlib
+matplotlib.use('Agg')  # headless; must happen before pyplot is imported
+import matplotlib.pyplot as plt
+import numpy as np
+import assignment_python as ap
+import tekx_core
+
+# Standalone performance harness for DeviceManager. Builds synthetic databases
+# (1 Hz readings ending at the last local midnight), times the main code paths
+# and writes JSON. With --baseline it compares against a stored run and exits
+# with status 1 when a metric regressed by more than --threshold.
+#
+#   python benchmark.py --sizes 10000 1000000 --output baseline.json
+#   python benchmark.py --sizes 10000 1000000 --baseline baseline.json
+#   python benchmark.py --current new.json --baseline baseline.json
+
+DEFAULT_SIZES = (10000, 1000000, 10000000)
+EXCEL_MAX_ROWS = 1048575  # one worksheet, minus the header row
+
+
+def build_database(db_filename, size, seed=0, chunk_size=1000000):
+    # Reuse an earlier build of the same size, otherwise generate one.
+    if os.path.exists(db_filename):
+        conn = sqlite3.connect(db_filename)
+        try:
+            count = conn.execute("SELECT COUNT(*) FROM readings").fetchone()[0]
+        except sqlite3.Error:
+            count = None
+        conn.close()
+        if count == size:
+            return None
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_filename + suffix):
+                os.remove(db_filename + suffix)
+
+    midnight = datetime.datetime.combine(datetime.date.today(), datetime.time()).timestamp()
+    simulator = ap.TekXSimulator(seed=seed)
+    start = time.perf_counter()
+    with ap.DeviceManager(simulator, db_filename, None, export_mode='manual') as manager:
+        for offset in range(0, size, chunk_size):
+            count = min(chunk_size, size - offset)
+            columns = simulator.generate_batch(count, start_time=midnight - size + offset, Tx_drift=0.999)
+            manager.log_readings_columns(*columns)
+    return time.perf_counter() - start
+
+
+def best_of(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def metric(value, unit, better='lower'):
+    return {'value': value, 'unit': unit, 'better': better}
+
+
+@contextlib.contextmanager
+def rendering_show():
+    # Under Agg plt.show() does nothing; render and close the figure instead so
+    # the timing includes drawing and figures don't pile up.
+    def show():
+        figure = plt.gcf()
+        figure.canvas.draw()
+        plt.close(figure)
+    original = plt.show
+    plt.show = show
+    try:
+        yield
+    finally:
+        plt.show = original
+        plt.close('all')
+
+
+def benchmark_size(size, db_dir, repeat, excel_max_rows, status_calls=1000, log_calls=2000):
+    results = {}
+    db_filename = os.path.join(db_dir, "bench_%d.db" % size)
+    excel_filename = os.path.join(db_dir, "bench_%d.xlsx" % size)
+    build_time = build_database(db_filename, size)
+    if build_time is not None:
+        results['build_s'] = metric(build_time, 's')
+
+    simulator = ap.TekXSimulator(seed=1)
+    # Uncached, so every timing reaches SQLite; the cache gets its own metrics.
+    with ap.DeviceManager(simulator, db_filename, excel_filename, export_mode='manual',
+                          cache_rows=0) as manager:
+        with manager.db.reader() as conn:
+            dates = [row[0] for row in conn.execute("SELECT DISTINCT date FROM daily_rollup ORDER BY date")]
+        selected_date = dates[-1]
+        week_start = dates[max(0, len(dates) - 7)]
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            latencies = []
+            for _ in range(status_calls):
+                start = time.perf_counter()
+                manager.get_status()
+                latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        results['get_status_p50_us'] = metric(1e6 * latencies[len(latencies) // 2], 'us')
+        results['get_status_p95_us'] = metric(1e6 * latencies[int(len(latencies) * 0.95)], 'us')
+
+        results['specific_date_trend_s'] = metric(
+            best_of(lambda: manager.get_specific_date_trend(selected_date), repeat), 's')
+        results['specific_date_trend_arrays_s'] = metric(
+            best_of(lambda: manager.get_specific_date_trend_arrays(selected_date), repeat), 's')
+        results['date_range_trend_modes_s'] = metric(
+            best_of(lambda: manager.calculate_mode_for_dates(
+                manager.get_date_range_trend(week_start, selected_date)), repeat), 's')
+        results['date_range_aggregates_s'] = metric(
+            best_of(lambda: manager.get_date_range_aggregates(week_start, selected_date), repeat), 's')
+
+        # selected_date is a closed day, so after the first call these are pure hits.
+        manager.query_cache = tekx_core.QueryCache()
+        manager.get_specific_date_trend_arrays(selected_date)
+        manager.get_date_range_aggregates(week_start, selected_date)
+        results['specific_date_trend_arrays_cached_us'] = metric(
+            1e6 * best_of(lambda: manager.get_specific_date_trend_arrays(selected_date), repeat), 'us')
+        results['date_range_aggregates_cached_us'] = metric(
+            1e6 * best_of(lambda: manager.get_date_range_aggregates(week_start, selected_date), repeat), 'us')
+        manager.query_cache = None
+
+        with rendering_show(), contextlib.redirect_stdout(io.StringIO()):
+            results['render_specific_date_s'] = metric(
+                best_of(lambda: manager.plot_specific_date_trends_2d(selected_date), repeat), 's')
+            results['render_weekly_s'] = metric(
+                best_of(lambda: manager.plot_weekly_trends_2d(week_start, selected_date), repeat), 's')
+
+        # Exports are slow enough that one run is representative.
+        if size <= excel_max_rows:
+            results['excel_export_s'] = metric(best_of(manager.log_readings_to_excel, 1), 's')
+        for fmt in ('csv', 'parquet', 'arrow', 'binary'):
+            filename = os.path.join(db_dir, "bench_%d_export%s" % (size, tekx_core.EXPORT_EXTENSIONS[fmt]))
+            try:
+                filenames, rows, elapsed = manager.export_readings(fmt, filename)
+            except RuntimeError as e:  # pyarrow not installed
+                print("Skipping %s export: %s" % (fmt, e), file=sys.stderr)
+                continue
+            results['export_%s_per_s' % fmt] = metric(rows / elapsed, 'readings/s', better='higher')
+            if fmt == 'parquet':
+                shutil.rmtree(filename)
+            else:
+                os.remove(filename)
+
+        # Logged last, then removed again so a reused database keeps its size.
+        # The rows land on today's date, which the synthetic data never reaches.
+        with manager.db.reader() as conn:
+            last_serial = conn.execute("SELECT MAX(serial_number) FROM readings").fetchone()[0]
+        start = time.perf_counter()
+        for _ in range(log_calls):
+            simulator.update_status()
+            manager.log_readings()
+        results['log_readings_per_s'] = metric(log_calls / (time.perf_counter() - start), 'readings/s',
+                                               better='higher')
+        with manager.db.writer() as conn:
+            conn.execute("DELETE FROM daily_rollup WHERE date IN "
+                         "(SELECT DISTINCT date FROM readings WHERE serial_number > ?)", (last_serial,))
+            conn.execute("DELETE FROM readings WHERE serial_number > ?", (last_serial,))
+
+    if os.path.exists(excel_filename):
+        os.remove(excel_filename)
+    return results
+
+
+def run(sizes, db_dir, repeat, excel_max_rows):
+    report = {
+        'meta': {
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'numpy': np.__version__,
+            'matplotlib': matplotlib.__version__,
+            'platform': platform.platform(),
+            'repeat': repeat,
+        },
+        'results': {},
+    }
+    for size in sizes:
+        print("Benchmarking %d readings..." % size, file=sys.stderr)
+        report['results'][str(size)] = benchmark_size(size, db_dir, repeat, excel_max_rows)
+    return report
+
+
+def compare(baseline, current, threshold):
+    # Returns the (size, name, baseline, current, change) rows that got worse by
+    # more than threshold; change is relative, positive meaning worse.
+    regressions = []
+    print("%10s %-30s %14s %14s %9s" % ("readings", "metric", "baseline", "current", "change"), file=sys.stderr)
+    for size, metrics in sorted(current['results'].items(), key=lambda item: int(item[0])):
+        for name, result in sorted(metrics.items()):
+            old = baseline['results'].get(size, {}).get(name)
+            if old is None or not old['value']:
+                continue
+            change = (result['value'] - old['value']) / old['value']
+            if result['better'] == 'higher':
+                change = -change
+            flag = "REGRESSION" if change > threshold else ""
+            print("%10s %-30s %14.6g %14.6g %+8.1f%% %s"
+                  % (size, name, old['value'], result['value'], 100 * change, flag), file=sys.stderr)
+            if flag:
+                regressions.append((size, name, old['value'], result['value'], change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark DeviceManager ingest, queries, export and plotting.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--repeat', type=int, default=3, help="runs per timing; the best is kept")
+    parser.add_argument('--db-dir', help="keep the synthetic databases here and reuse them across runs")
+    parser.add_argument('--excel-max-rows', type=int, default=EXCEL_MAX_ROWS,
+                        help="skip the Excel export above this many readings")
+    parser.add_argument('--output', help="write the results as JSON to this file (default: stdout)")
+    parser.add_argument('--current', help="compare this stored result instead of running the benchmarks")
+    parser.add_argument('--baseline', help="stored result to compare against")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="relative slowdown that counts as a regression (default: 0.25)")
+    args = parser.parse_args(argv)
+
+    if args.current:
+        with open(args.current) as f:
+            report = json.load(f)
+    elif args.db_dir:
+        os.makedirs(args.db_dir, exist_ok=True)
+        report = run(args.sizes, args.db_dir, args.repeat, args.excel_max_rows)
+    else:
+        with tempfile.TemporaryDirectory() as db_dir:
+            report = run(args.sizes, db_dir, args.repeat, args.excel_max_rows)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    elif not args.current:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(baseline, report, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
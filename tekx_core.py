@@ -0,0 +1,2321 @@
+import sqlite3
+import contextlib
+import urllib.parse
+import random
+import time
+import csv
+import datetime
+import threading
+import functools
+import itertools
+import math
+import numpy as np
+import os
+import queue
+import bisect
+import inspect
+import json
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Device simulation, storage and export shared by the CLI (assignment_python.py)
+# and the Tk app (tkinter_app_python.py). Nothing here imports matplotlib, and
+# the export backends (xlsxwriter, pyarrow) are imported when first used, so
+# importing this module costs little more than NumPy.
+
+class TekXSimulator:
+    def __init__(self, seed=None):
+        self.A = 0
+        self.B = 0
+        self.DO1 = 0
+        self.DO2 = 0
+        self.Tx = 0.0  
+        self.rng = np.random.default_rng(seed)  # for generate_batch
+
+    def update_status(self):
+        self.DO1 = random.randint(0, 1)
+        self.DO2 = random.randint(0, 1)
+        self.Tx = round(random.uniform(20, 30), 2)  # Simulated temperature reading
+
+    def generate_batch(self, count, start_time=None, rate=1.0, Tx_drift=None, block_size=4096):
+        # count readings taken `rate` times a second from start_time (by default the
+        # batch ends now), as columns in log_readings_batch order:
+        # (timestamps, dates, A, B, DO1, DO2, Tx) with dates as datetime64[D].
+        # Tx is uniform in 20..30 like update_status, or with Tx_drift=phi an AR(1)
+        # series around 25 with the same spread, continuing from self.Tx.
+        if start_time is None:
+            start_time = time.time() - count / rate
+        timestamps = start_time + np.arange(count) / rate
+        dates = timestamps_to_dates(timestamps)
+        A = np.full(count, self.A, dtype=np.int64)
+        B = np.full(count, self.B, dtype=np.int64)
+        DO1 = self.rng.integers(0, 2, count, dtype=np.uint8)
+        DO2 = self.rng.integers(0, 2, count, dtype=np.uint8)
+        if Tx_drift is None:
+            Tx = self.rng.uniform(20, 30, count)
+        else:
+            Tx = self._drifting_Tx(count, Tx_drift, block_size)
+        Tx = np.round(Tx, 2)
+        if count:
+            self.DO1, self.DO2, self.Tx = int(DO1[-1]), int(DO2[-1]), float(Tx[-1])
+        return timestamps, dates, A, B, DO1, DO2, Tx
+
+    def _drifting_Tx(self, count, phi, block_size):
+        # x[t] = 25 + phi * (x[t-1] - 25) + noise. Within a block the zero-start
+        # response is phi**t * cumsum(noise / phi**t), so only the carry from one
+        # block to the next is a Python loop. Blocks are kept short enough that
+        # phi**-t stays well inside float range.
+        if not 0 <= phi < 1:
+            raise ValueError("Tx_drift must be in [0, 1)")
+        mean, spread = 25.0, 10 / math.sqrt(12)
+        noise = self.rng.normal(0, spread * math.sqrt(1 - phi * phi), count)
+        if phi == 0 or not count:
+            return np.clip(mean + noise, 20, 30)
+        block_size = max(1, min(block_size, int(30 / -math.log(phi))))
+        blocks = -(-count // block_size)
+        padded = np.zeros(blocks * block_size)
+        padded[:count] = noise
+        powers = phi ** np.arange(block_size)
+        response = powers * np.cumsum(padded.reshape(blocks, block_size) / powers, axis=1)
+        carry = np.empty(blocks)
+        x = self.Tx - mean if 20 <= self.Tx <= 30 else 0.0
+        decay = phi ** block_size
+        for j in range(blocks):
+            carry[j] = x
+            x = decay * x + response[j, -1]
+        deviation = response + carry[:, None] * (phi * powers)
+        return np.clip(mean + deviation.ravel()[:count], 20, 30)
+
+def timestamps_to_datetime64(timestamps):
+    # Local wall-clock datetime64[us] for an array of epoch seconds, matching
+    # datetime.fromtimestamp. One UTC offset covers the whole array unless a DST
+    # change falls inside it, in which case each value is converted on its own.
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    if not len(timestamps):
+        return timestamps.astype('datetime64[us]')
+    first = datetime.datetime.fromtimestamp(timestamps[0]).astimezone().utcoffset()
+    last = datetime.datetime.fromtimestamp(timestamps[-1]).astimezone().utcoffset()
+    if first != last:
+        return np.array([datetime.datetime.fromtimestamp(ts) for ts in timestamps], dtype='datetime64[us]')
+    micros = np.rint((timestamps + first.total_seconds()) * 1e6).astype(np.int64)
+    return micros.astype('datetime64[us]')
+
+def timestamps_to_dates(timestamps):
+    # Local calendar date (datetime64[D]) of each epoch second, matching the
+    # '%Y-%m-%d' dates log_readings stores, DST changes included: each timestamp
+    # is placed between the local midnights around it.
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    if not len(timestamps):
+        return np.empty(0, dtype='datetime64[D]')
+    first = np.datetime64(datetime.datetime.fromtimestamp(timestamps.min()).date(), 'D')
+    last = np.datetime64(datetime.datetime.fromtimestamp(timestamps.max()).date(), 'D')
+    days = np.arange(first, last + 1)
+    midnights = np.array([time.mktime(day.timetuple()) for day in days.astype(object)])
+    return days[np.searchsorted(midnights, timestamps, side='right') - 1]
+
+def _as_float_axis(x):
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype(np.int64).astype(np.float64)
+    return x.astype(np.float64)
+
+def downsample_lttb(x, y, max_points):
+    # Largest-Triangle-Three-Buckets: keeps first and last point and, from each
+    # bucket in between, the point forming the largest triangle with the point
+    # kept from the previous bucket and the average of the next one.
+    n = len(x)
+    if max_points >= n or max_points < 3:
+        return x, y
+    xs = _as_float_axis(x)
+    ys = np.asarray(y, dtype=np.float64)
+    every = (n - 2) / (max_points - 2)
+    kept = np.empty(max_points, dtype=np.int64)
+    kept[0] = 0
+    kept[-1] = n - 1
+    a = 0
+    for i in range(max_points - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = xs[end:next_end].mean()
+        avg_y = ys[end:next_end].mean()
+        areas = np.abs((xs[a] - avg_x) * (ys[start:end] - ys[a])
+                       - (xs[a] - xs[start:end]) * (avg_y - ys[a]))
+        a = start + int(areas.argmax())
+        kept[i + 1] = a
+    return x[kept], y[kept]
+
+def downsample_steps(x, y, max_points):
+    # For the 0/1 DO signals: the samples either side of every change (plus the
+    # ends) draw exactly the same line. If even those are too many, fall back to
+    # the first, last, min and max sample of each bucket.
+    n = len(x)
+    if max_points >= n:
+        return x, y
+    y = np.asarray(y)
+    changes = np.flatnonzero(y[1:] != y[:-1])
+    kept = np.unique(np.concatenate(([0, n - 1], changes, changes + 1)))
+    if len(kept) > max_points:
+        edges = np.linspace(0, n, max(max_points // 4, 1) + 1).astype(np.int64)
+        kept = []
+        for start, end in zip(edges[:-1], edges[1:]):
+            if end > start:
+                bucket = y[start:end]
+                kept.extend((start, start + int(bucket.argmin()), start + int(bucket.argmax()), end - 1))
+        kept = np.unique(kept)
+    return x[kept], y[kept]
+
+# Downsamplers by name; each takes (x, y, max_points) and returns the kept (x, y).
+DOWNSAMPLERS = {
+    'lttb': downsample_lttb,
+    'steps': downsample_steps,
+}
+
+def downsample_trend(timestamps, DO1_values, DO2_values, Tx_values, max_points,
+                     analog='lttb', digital='steps'):
+    # Returns (DO1_x, DO1, DO2_x, DO2, Tx_x, Tx); max_points=None keeps every reading.
+    if max_points is None:
+        return timestamps, DO1_values, timestamps, DO2_values, timestamps, Tx_values
+    DO1_x, DO1_values = DOWNSAMPLERS[digital](timestamps, DO1_values, max_points)
+    DO2_x, DO2_values = DOWNSAMPLERS[digital](timestamps, DO2_values, max_points)
+    Tx_x, Tx_values = DOWNSAMPLERS[analog](timestamps, Tx_values, max_points)
+    return DO1_x, DO1_values, DO2_x, DO2_values, Tx_x, Tx_values
+
+# Exporters stream readings in EXPORT_SQL column order, one fetchmany chunk at a
+# time, to `filename` and return the list of files written.
+EXPORT_HEADER = ['Timestamp', 'Date', 'A', 'B', 'DO1', 'DO2', 'Tx']
+
+def _open_excel_sheet(workbook, filenames, filename, sheets_per_file):
+    # Next worksheet, in a new workbook when there is none yet or the current one
+    # already holds sheets_per_file sheets. Files after the first are named
+    # <name>_2.xlsx, <name>_3.xlsx, ...
+    if workbook is None or (sheets_per_file and len(workbook.worksheets()) >= sheets_per_file):
+        if workbook is not None:
+            workbook.close()
+        base, extension = os.path.splitext(filename)
+        filename = filename if not filenames else "%s_%d%s" % (base, len(filenames) + 1, extension)
+        import xlsxwriter
+        # constant_memory flushes each row to disk once the next one starts.
+        workbook = xlsxwriter.Workbook(filename, {'constant_memory': True})
+        filenames.append(filename)
+    worksheet = workbook.add_worksheet()
+    worksheet.write_row(0, 0, EXPORT_HEADER)
+    return workbook, worksheet
+
+def export_xlsx(chunks, filename, max_rows=1048576, sheets_per_file=None):
+    # A sheet that reaches max_rows (header included) rolls over to a new one.
+    filenames = []
+    workbook, worksheet = _open_excel_sheet(None, filenames, filename, sheets_per_file)
+    row_idx = 1
+    for chunk in chunks:
+        for row_data in chunk:
+            if row_idx == max_rows:
+                workbook, worksheet = _open_excel_sheet(workbook, filenames, filename, sheets_per_file)
+                row_idx = 1
+            worksheet.write_row(row_idx, 0, row_data)
+            row_idx += 1
+    workbook.close()
+    return filenames
+
+def export_csv(chunks, filename):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_HEADER)
+        for chunk in chunks:
+            writer.writerows(chunk)
+    return [filename]
+
+# Fixed-width little-endian records, readable with np.fromfile(path, BINARY_EXPORT_DTYPE).
+BINARY_EXPORT_DTYPE = np.dtype([('timestamp', '<f8'), ('date', 'S10'), ('A', '<i8'), ('B', '<i8'),
+                                ('DO1', 'u1'), ('DO2', 'u1'), ('Tx', '<f8')])
+
+def export_binary(chunks, filename):
+    with open(filename, 'wb') as f:
+        for chunk in chunks:
+            np.array(chunk, dtype=BINARY_EXPORT_DTYPE).tofile(f)
+    return [filename]
+
+def _arrow_batch(chunk, with_date=True):
+    import pyarrow as pa
+    timestamp, date, A, B, DO1, DO2, Tx = zip(*chunk)
+    columns = [pa.array(timestamp, pa.float64()), pa.array(date, pa.string()), pa.array(A, pa.int64()),
+               pa.array(B, pa.int64()), pa.array(DO1, pa.int8()), pa.array(DO2, pa.int8()),
+               pa.array(Tx, pa.float64())]
+    names = ['timestamp', 'date', 'A', 'B', 'DO1', 'DO2', 'Tx']
+    if not with_date:
+        del columns[1], names[1]
+    return pa.RecordBatch.from_arrays(columns, names)
+
+def export_arrow(chunks, filename):
+    # One Arrow IPC (Feather v2) file, a record batch per chunk.
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise RuntimeError("Arrow export needs pyarrow (pip install pyarrow)")
+    writer = None
+    for chunk in chunks:
+        batch = _arrow_batch(chunk)
+        if writer is None:
+            writer = pa.ipc.new_file(filename, batch.schema)
+        writer.write_batch(batch)
+    if writer is None:
+        writer = pa.ipc.new_file(filename, _arrow_batch([(0.0, '', 0, 0, 0, 0, 0.0)]).schema)
+    writer.close()
+    return [filename]
+
+def export_parquet(chunks, filename):
+    # A Hive-style dataset: filename/date=YYYY-MM-DD/part-N.parquet, one row group
+    # per chunk. The readings arrive in date order, so only one file is open at a time.
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+    os.makedirs(filename, exist_ok=True)
+    filenames = []
+    parts = {}
+    writer = None
+    current_date = None
+    for chunk in chunks:
+        start = 0
+        while start < len(chunk):
+            date = chunk[start][1]
+            end = start + 1
+            while end < len(chunk) and chunk[end][1] == date:
+                end += 1
+            batch = _arrow_batch(chunk[start:end], with_date=False)
+            if date != current_date:
+                if writer is not None:
+                    writer.close()
+                directory = os.path.join(filename, "date=%s" % date)
+                os.makedirs(directory, exist_ok=True)
+                path = os.path.join(directory, "part-%d.parquet" % parts.get(date, 0))
+                parts[date] = parts.get(date, 0) + 1
+                writer = pq.ParquetWriter(path, batch.schema)
+                filenames.append(path)
+                current_date = date
+            writer.write_batch(batch)
+            start = end
+    if writer is not None:
+        writer.close()
+    return filenames
+
+EXPORTERS = {
+    'xlsx': export_xlsx,
+    'csv': export_csv,
+    'parquet': export_parquet,
+    'arrow': export_arrow,
+    'binary': export_binary,
+}
+
+# Default file (or, for parquet, directory) suffix per format.
+EXPORT_EXTENSIONS = {
+    'xlsx': '.xlsx',
+    'csv': '.csv',
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+    'binary': '.bin',
+}
+
+class Metrics:
+    # Opt-in instrumentation. Keeps a latency histogram (seconds), call, error and
+    # row counts per (kind, name) - kinds are 'method' for DeviceManager methods,
+    # 'query' for SQL statements, 'connect' for opened connections, 'ui' for the
+    # Tk callbacks and 'http' for tekx_service requests - and a log of statements slower than slow_query_seconds
+    # with their EXPLAIN QUERY PLAN, also appended as JSON lines to
+    # slow_query_log when set. Nothing is wrapped unless a Metrics is passed in,
+    # so there is no cost when it isn't.
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+    MAX_NAME_LENGTH = 200
+
+    def __init__(self, slow_query_seconds=0.1, slow_query_log=None, max_slow_queries=100):
+        self.slow_query_seconds = slow_query_seconds
+        self.slow_query_log = slow_query_log
+        self.slow_queries = deque(maxlen=max_slow_queries)
+        self._series = {}
+        self._gauges = []
+        self._lock = threading.Lock()
+
+    def observe(self, kind, name, seconds, rows=None, error=False):
+        with self._lock:
+            series = self._series.get((kind, name))
+            if series is None:
+                series = self._series[kind, name] = {'buckets': [0] * (len(self.BUCKETS) + 1),
+                                                     'count': 0, 'sum': 0.0, 'rows': 0, 'errors': 0}
+            # The last bucket counts everything above BUCKETS[-1].
+            series['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            series['count'] += 1
+            series['sum'] += seconds
+            if rows:
+                series['rows'] += rows
+            if error:
+                series['errors'] += 1
+
+    def wrap(self, kind, name, func):
+        # func timed under (kind, name); the row count is a best guess from the result.
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                self.observe(kind, name, time.perf_counter() - start, error=True)
+                raise
+            self.observe(kind, name, time.perf_counter() - start, _result_row_count(result))
+            return result
+        return timed
+
+    def add_gauges(self, func):
+        # func() returns {name: number}, read whenever a snapshot is taken.
+        self._gauges.append(func)
+
+    def record_query(self, conn, sql, params, seconds, rows, error=False):
+        name = ' '.join(sql.split())[:self.MAX_NAME_LENGTH]
+        self.observe('query', name, seconds, rows, error)
+        if seconds >= self.slow_query_seconds:
+            self._log_slow_query(conn, sql, params, seconds, rows)
+
+    def _log_slow_query(self, conn, sql, params, seconds, rows):
+        # The plan is taken on a plain cursor so it isn't timed itself.
+        try:
+            plan = [row[3] for row in sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, params)]
+        except (sqlite3.Error, ValueError) as e:
+            plan = ["(no plan: %s)" % e]
+        entry = {'time': datetime.datetime.now().isoformat(timespec='milliseconds'),
+                 'seconds': round(seconds, 6), 'rows': rows, 'sql': ' '.join(sql.split()),
+                 'params': repr(params)[:self.MAX_NAME_LENGTH], 'plan': plan}
+        with self._lock:
+            self.slow_queries.append(entry)
+            if self.slow_query_log:
+                with open(self.slow_query_log, 'a') as f:
+                    f.write(json.dumps(entry) + "\n")
+
+    def gauges(self):
+        values = {}
+        for func in self._gauges:
+            values.update(func())
+        return values
+
+    def snapshot(self):
+        gauges = self.gauges()
+        with self._lock:
+            series = [dict(kind=kind, name=name, **dict(values, buckets=list(values['buckets'])))
+                      for (kind, name), values in sorted(self._series.items())]
+            slow_queries = list(self.slow_queries)
+        return {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                'buckets': list(self.BUCKETS), 'series': series, 'gauges': gauges,
+                'slow_queries': slow_queries}
+
+    def prometheus_text(self):
+        # Prometheus text exposition format: one histogram plus row and error
+        # counters per kind, and the gauges.
+        snapshot = self.snapshot()
+        lines = []
+        for kind in sorted({series['kind'] for series in snapshot['series']}):
+            metric = 'tekx_%s_seconds' % kind
+            lines.append("# TYPE %s histogram" % metric)
+            for series in snapshot['series']:
+                if series['kind'] != kind:
+                    continue
+                label = 'name="%s"' % _prometheus_escape(series['name'])
+                total = 0
+                for bound, count in zip(self.BUCKETS + ('+Inf',), series['buckets']):
+                    total += count
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (metric, label, bound, total))
+                lines.append("%s_sum{%s} %.9g" % (metric, label, series['sum']))
+                lines.append("%s_count{%s} %d" % (metric, label, series['count']))
+            for counter in ('rows', 'errors'):
+                metric = 'tekx_%s_%s_total' % (kind, counter)
+                lines.append("# TYPE %s counter" % metric)
+                for series in snapshot['series']:
+                    if series['kind'] == kind:
+                        lines.append('%s{name="%s"} %d' % (metric, _prometheus_escape(series['name']),
+                                                           series[counter]))
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append("# TYPE tekx_%s gauge" % name)
+            lines.append("tekx_%s %.9g" % (name, value))
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename):
+        # A JSON snapshot for .json files, Prometheus text otherwise. Written to a
+        # temporary file first so a scraper never sees half of it.
+        if filename.endswith('.json'):
+            content = json.dumps(self.snapshot(), indent=2)
+        else:
+            content = self.prometheus_text()
+        temporary = filename + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(content)
+        os.replace(temporary, filename)
+
+def _prometheus_escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _result_row_count(value):
+    # Rows in a method's result where that is obvious: a list or dict, or a
+    # tuple of equally long columns. None otherwise.
+    if isinstance(value, (list, dict)):
+        return len(value)
+    if (isinstance(value, tuple) and value and isinstance(value[0], (list, np.ndarray))
+            and all(isinstance(column, (list, np.ndarray)) and len(column) == len(value[0])
+                    for column in value)):
+        return len(value[0])
+    return None
+
+class _TimedCursor(sqlite3.Cursor):
+    # Times each statement from execute() until its rows have been fetched (all
+    # of them, or the one a fetchone() caller wanted) and reports it to the
+    # connection's Metrics.
+    def __init__(self, connection):
+        super().__init__(connection)
+        self._sql = None
+
+    def _report(self):
+        if self._sql is not None:
+            self.connection.metrics.record_query(self.connection, self._sql, self._params,
+                                                 self._seconds, self._rows)
+            self._sql = None
+
+    def _fail(self, sql, params, seconds):
+        self._sql = None
+        self.connection.metrics.record_query(self.connection, sql, params, seconds, None, error=True)
+
+    def execute(self, sql, parameters=()):
+        self._report()
+        start = time.perf_counter()
+        try:
+            super().execute(sql, parameters)
+        except BaseException:
+            self._fail(sql, parameters, time.perf_counter() - start)
+            raise
+        self._sql, self._params, self._rows = sql, parameters, 0
+        self._seconds = time.perf_counter() - start
+        if self.description is None:
+            self._rows = max(self.rowcount, 0)
+            self._report()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._report()
+        if not isinstance(seq_of_parameters, (list, tuple)):
+            seq_of_parameters = list(seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            super().executemany(sql, seq_of_parameters)
+        except BaseException:
+            self._fail(sql, seq_of_parameters[:1], time.perf_counter() - start)
+            raise
+        self.connection.metrics.record_query(self.connection, sql,
+                                             seq_of_parameters[0] if seq_of_parameters else (),
+                                             time.perf_counter() - start, len(seq_of_parameters))
+        return self
+
+    def _timed_fetch(self, fetch, *args):
+        start = time.perf_counter()
+        rows = fetch(*args)
+        if self._sql is not None:
+            self._seconds += time.perf_counter() - start
+        return rows
+
+    def fetchone(self):
+        row = self._timed_fetch(super().fetchone)
+        if self._sql is not None:
+            self._rows += row is not None
+            self._report()
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._timed_fetch(super().fetchmany, *args)
+        if self._sql is not None:
+            self._rows += len(rows)
+            if not rows:
+                self._report()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed_fetch(super().fetchall)
+        if self._sql is not None:
+            self._rows += len(rows)
+            self._report()
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            if self._sql is not None:
+                self._seconds += time.perf_counter() - start
+                self._report()
+            raise
+        if self._sql is not None:
+            self._seconds += time.perf_counter() - start
+            self._rows += 1
+        return row
+
+    def close(self):
+        self._report()
+        super().close()
+
+class _TimedConnection(sqlite3.Connection):
+    # Connection whose cursors are _TimedCursors; ConnectionManager sets metrics.
+    metrics = None
+
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class ConnectionManager:
+    # One long-lived writer connection (WAL, relaxed fsync) guarded by a lock, plus a
+    # small pool of read-only connections handed out one thread at a time. With
+    # metrics set every connection times its statements into it.
+    def __init__(self, db_filename, read_pool_size=4, synchronous='NORMAL',
+                 cache_size=-65536, mmap_size=268435456, busy_timeout=5000, metrics=None):
+        self.db_filename = db_filename
+        self.metrics = metrics
+        self.read_pool_size = read_pool_size
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.busy_timeout = busy_timeout
+        self._write_lock = threading.RLock()
+        self._write_depth = 0
+        self._readers = queue.LifoQueue()
+        self._reader_slots = threading.BoundedSemaphore(read_pool_size)
+        self._open_readers = []
+        self._closed = False
+        self._local = threading.local()
+
+        self._writer = self._connect('writer', db_filename)
+        # Only takes effect on a new database, so it has to come before the switch
+        # to WAL writes the header. Existing ones are converted by DeviceManager.reclaim_space.
+        self._writer.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute("PRAGMA synchronous=" + synchronous)
+        self._writer.execute("PRAGMA temp_store=MEMORY")
+        self._apply_common_pragmas(self._writer)
+
+    def _apply_common_pragmas(self, conn):
+        conn.execute("PRAGMA cache_size=%d" % self.cache_size)
+        conn.execute("PRAGMA mmap_size=%d" % self.mmap_size)
+        conn.execute("PRAGMA busy_timeout=%d" % self.busy_timeout)
+
+    def _connect(self, kind, database, **kwargs):
+        if self.metrics is None:
+            return sqlite3.connect(database, timeout=self.busy_timeout / 1000, check_same_thread=False, **kwargs)
+        start = time.perf_counter()
+        conn = sqlite3.connect(database, timeout=self.busy_timeout / 1000, check_same_thread=False,
+                               factory=_TimedConnection, **kwargs)
+        conn.metrics = self.metrics
+        self.metrics.observe('connect', kind, time.perf_counter() - start)
+        return conn
+
+    def _connect_read_only(self, db_filename, kind='reader'):
+        uri = 'file:' + urllib.parse.quote(os.path.abspath(db_filename)) + '?mode=ro'
+        conn = self._connect(kind, uri, uri=True)
+        self._apply_common_pragmas(conn)
+        return conn
+
+    def _open_reader(self):
+        conn = self._connect_read_only(self.db_filename)
+        self._open_readers.append(conn)
+        return conn
+
+    def _install_cancel_handler(self, conn):
+        cancel_event = getattr(self._local, 'cancel_event', None)
+        if cancel_event is not None:
+            conn.set_progress_handler(lambda: 1 if cancel_event.is_set() else 0, 1000)
+        return cancel_event
+
+    def _check_open(self):
+        if self._closed:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+
+    @contextlib.contextmanager
+    def writer(self):
+        # Commits when the outermost writer() block exits, rolls back on error.
+        with self._write_lock:
+            self._check_open()
+            self._write_depth += 1
+            try:
+                yield self._writer
+            except BaseException:
+                if self._write_depth == 1:
+                    self._writer.rollback()
+                raise
+            else:
+                if self._write_depth == 1:
+                    self._writer.commit()
+            finally:
+                self._write_depth -= 1
+
+    @contextlib.contextmanager
+    def reader(self):
+        self._check_open()
+        self._reader_slots.acquire()
+        try:
+            try:
+                conn = self._readers.get_nowait()
+            except queue.Empty:
+                conn = self._open_reader()
+            cancel_event = self._install_cancel_handler(conn)
+            try:
+                yield conn
+            finally:
+                if cancel_event is not None:
+                    conn.set_progress_handler(None, 0)
+                if conn.in_transaction:
+                    conn.rollback()
+                self._readers.put(conn)
+        finally:
+            self._reader_slots.release()
+
+    @contextlib.contextmanager
+    def partition_reader(self, db_filename):
+        # Short-lived read-only connection to another database file (an archive
+        # partition), with the same pragmas and cancellation as the pooled readers.
+        self._check_open()
+        conn = self._connect_read_only(db_filename, 'partition')
+        try:
+            self._install_cancel_handler(conn)
+            yield conn
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def cancellable(self, cancel_event):
+        # Reads made by this thread inside the block abort with
+        # sqlite3.OperationalError('interrupted') once cancel_event is set.
+        self._local.cancel_event = cancel_event
+        try:
+            yield
+        finally:
+            self._local.cancel_event = None
+
+    def data_version(self):
+        # Changes whenever a connection other than the writer (including one in
+        # another process) commits; our own commits leave it untouched.
+        with self._write_lock:
+            self._check_open()
+            return self._writer.execute("PRAGMA data_version").fetchone()[0]
+
+    def close(self):
+        if self._closed:
+            return
+        with self._write_lock:
+            self._closed = True
+            # Readers go first so the writer is the last connection and can
+            # checkpoint and remove the -wal/-shm files.
+            for conn in self._open_readers:
+                conn.close()
+            self._open_readers = []
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _result_rows(value):
+    # Readings (or days, hours) held by a query result: the unit QueryCache is bounded in.
+    if isinstance(value, dict):
+        return sum(len(day['Tx']) for day in value.values())
+    return len(value[0])
+
+def _result_copy(value):
+    # A query result whose lists and dicts the caller may change freely. Their
+    # items are scalars or row tuples, and arrays are read-only, so those are shared.
+    if isinstance(value, tuple):
+        return tuple(_result_copy(item) for item in value)
+    if isinstance(value, list):
+        return list(value)
+    if isinstance(value, dict):
+        return {key: _result_copy(item) for key, item in value.items()}
+    return value
+
+class QueryCache:
+    # LRU cache of DeviceManager query results keyed by method and arguments, and
+    # bounded by the readings the cached results hold in total. A result whose
+    # dates all lay before the day it was computed on is final, since past days
+    # don't change. One reaching today remembers the max serial_number it was
+    # computed at and is recomputed once that has moved. Readings this process
+    # writes for past days drop the entries covering them; past-day writes from
+    # other processes are not noticed. Callers get their own copies of cached
+    # lists and dicts; cached arrays are made read-only and shared.
+    def __init__(self, max_rows=2000000):
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # key -> (value, rows, max serial or None, first date, last date)
+        self._rows = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def fetch(self, key, first_date, last_date, compute, max_serial):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None and (entry[2] is None or entry[2] == max_serial()):
+            with self._lock:
+                self.hits += 1
+            return _result_copy(entry[0])
+
+        with self._lock:
+            self.misses += 1
+            generation = self._generation
+        serial = None if last_date < time.strftime('%Y-%m-%d') else max_serial()
+        value = compute()
+        for column in (value if isinstance(value, tuple) else ()):
+            if isinstance(column, np.ndarray):
+                column.setflags(write=False)
+        rows = max(1, _result_rows(value))
+        with self._lock:
+            # Skip storing a result that a past-day write may have overtaken.
+            if generation != self._generation:
+                return value
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._rows -= old[1]
+            if rows <= self.max_rows:
+                self._entries[key] = (value, rows, serial, first_date, last_date)
+                self._rows += rows
+            while self._rows > self.max_rows:
+                self._rows -= self._entries.popitem(last=False)[1][1]
+                self.evictions += 1
+        return _result_copy(value)
+
+    def invalidate_dates(self, dates):
+        # Drop the entries covering any of these past dates ('YYYY-MM-DD'); entries
+        # reaching today are already checked against the max serial_number.
+        today = time.strftime('%Y-%m-%d')
+        dates = sorted(set(date for date in dates if date < today))
+        if not dates:
+            return
+        with self._lock:
+            self._generation += 1
+            for key, entry in list(self._entries.items()):
+                if any(entry[3] <= date <= entry[4] for date in dates):
+                    del self._entries[key]
+                    self._rows -= entry[1]
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._rows = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'entries': len(self._entries),
+                    'rows': self._rows, 'max_rows': self.max_rows}
+
+def _date_string(value, fmt='%Y-%m-%d'):
+    # A date or datetime as the text the date columns hold; anything else as is.
+    if isinstance(value, datetime.date):
+        return value.strftime(fmt)
+    return value
+
+def _day_string(value):
+    # A date range bound as 'YYYY-MM-DD' (None stays None). The packed layout
+    # turns bounds into day numbers while the standard one compares text, so
+    # both are only given whole days: '2024-03-05 12:00' means 2024-03-05.
+    # The original text comparison left out the start day of a datetime
+    # bound ('2024-03-05' < '2024-03-05 12:00'); now that day is included,
+    # which is why the weekly views pass dates (today - 6 days .. today).
+    return None if value is None else str(_date_string(value))[:10]
+
+def cached_query(first, last=None, fmt='%Y-%m-%d'):
+    # Serves a DeviceManager read method through its query_cache. first and last
+    # name the parameters holding the first and last date the method covers
+    # (last defaults to first). Arguments are bound to the method's signature,
+    # so positional, keyword and defaulted calls share one key. date/datetime
+    # values in first and last are passed on as fmt strings, cache or not, so
+    # a range asked with datetimes hits again later the same day.
+    def decorate(method):
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            for name in {first, last or first}:
+                bound.arguments[name] = _date_string(bound.arguments[name], fmt)
+            if self.query_cache is None:
+                return method(*bound.args, **bound.kwargs)
+            key = (method.__name__,) + tuple(bound.arguments.items())[1:]
+            return self.query_cache.fetch(key, str(bound.arguments[first])[:10],
+                                          str(bound.arguments[last or first])[:10],
+                                          lambda: method(*bound.args, **bound.kwargs), self.max_serial)
+        return wrapper
+    return decorate
+
+class StreamingStats:
+    # Running statistics of one device's readings over sliding windows, updated
+    # in O(1) per reading and read without touching the database. Each window
+    # is a ring of `buckets` sub-windows holding mergeable summaries: count,
+    # Welford mean and M2 of Tx, its min and max, how many readings had DO1/DO2
+    # on, how often they switched, and a histogram of Tx in `resolution` steps
+    # for the percentiles (right to within resolution / 2). A summary merges the
+    # buckets still inside the window, so windows move in steps of
+    # seconds / buckets. Transitions count against the reading that changed.
+    WINDOWS = (('minute', 60), ('hour', 3600), ('day', 86400))
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, windows=WINDOWS, buckets=60, resolution=0.1):
+        self.buckets = buckets
+        self.resolution = resolution
+        self.windows = [(name, seconds, seconds / buckets, [None] * buckets) for name, seconds in windows]
+        self._last = None
+        self._lock = threading.Lock()
+
+    def add(self, timestamp, DO1, DO2, Tx):
+        key = round(Tx / self.resolution)
+        with self._lock:
+            if self._last is None:
+                DO1_changed = DO2_changed = 0
+            else:
+                DO1_changed = int(DO1 != self._last[0])
+                DO2_changed = int(DO2 != self._last[1])
+            self._last = (DO1, DO2)
+            for name, seconds, width, ring in self.windows:
+                index = int(timestamp // width)
+                bucket = ring[index % self.buckets]
+                if bucket is None or bucket[0] < index:
+                    # [index, count, mean, M2, min, max, DO1 on, DO2 on,
+                    #  DO1 transitions, DO2 transitions, Tx histogram]
+                    ring[index % self.buckets] = [index, 1, Tx, 0.0, Tx, Tx, DO1, DO2,
+                                                  DO1_changed, DO2_changed, {key: 1}]
+                    continue
+                if bucket[0] > index:
+                    continue  # already older than the window
+                bucket[1] += 1
+                delta = Tx - bucket[2]
+                bucket[2] += delta / bucket[1]
+                bucket[3] += delta * (Tx - bucket[2])
+                if Tx < bucket[4]:
+                    bucket[4] = Tx
+                if Tx > bucket[5]:
+                    bucket[5] = Tx
+                bucket[6] += DO1
+                bucket[7] += DO2
+                bucket[8] += DO1_changed
+                bucket[9] += DO2_changed
+                bucket[10][key] = bucket[10].get(key, 0) + 1
+
+    def summary(self, now=None):
+        # {window name: statistics} for the windows ending at now (default: the current time).
+        if now is None:
+            now = time.time()
+        with self._lock:
+            return {name: self._merge(seconds, ring, int(now // width))
+                    for name, seconds, width, ring in self.windows}
+
+    def _merge(self, seconds, ring, newest):
+        count = DO1_ones = DO2_ones = DO1_transitions = DO2_transitions = 0
+        mean = M2 = 0.0
+        Tx_min = Tx_max = None
+        histogram = Counter()
+        for bucket in ring:
+            if bucket is None or not newest - self.buckets < bucket[0] <= newest:
+                continue
+            # Chan et al.'s pairwise update combines two Welford summaries.
+            total = count + bucket[1]
+            delta = bucket[2] - mean
+            mean += delta * bucket[1] / total
+            M2 += bucket[3] + delta * delta * count * bucket[1] / total
+            count = total
+            Tx_min = bucket[4] if Tx_min is None else min(Tx_min, bucket[4])
+            Tx_max = bucket[5] if Tx_max is None else max(Tx_max, bucket[5])
+            DO1_ones += bucket[6]
+            DO2_ones += bucket[7]
+            DO1_transitions += bucket[8]
+            DO2_transitions += bucket[9]
+            histogram.update(bucket[10])
+        stats = {'seconds': seconds, 'count': count,
+                 'Tx_mean': mean if count else None,
+                 'Tx_stdev': math.sqrt(M2 / (count - 1)) if count > 1 else None,
+                 'Tx_min': Tx_min, 'Tx_max': Tx_max,
+                 'DO1_duty': DO1_ones / count if count else None,
+                 'DO2_duty': DO2_ones / count if count else None,
+                 'DO1_transitions': DO1_transitions, 'DO2_transitions': DO2_transitions}
+        # Nearest-rank percentiles, walking the histogram once in Tx order. A bin
+        # centre can lie past the extremes it holds, so clamp to [Tx_min, Tx_max].
+        targets = [(p, max(1, math.ceil(p / 100 * count))) for p in self.PERCENTILES]
+        seen = 0
+        for key in sorted(histogram):
+            seen += histogram[key]
+            while targets and seen >= targets[0][1]:
+                value = min(max(round(key * self.resolution, 6), Tx_min), Tx_max)
+                stats['Tx_p%d' % targets.pop(0)[0]] = value
+        for p, rank in targets:
+            stats['Tx_p%d' % p] = None
+        return stats
+
+# (label, key, format) of the StreamingStats values the front ends show, in order.
+STATS_FIELDS = (
+    ('Readings', 'count', '%d'),
+    ('Tx mean', 'Tx_mean', '%.2f'),
+    ('Tx std dev', 'Tx_stdev', '%.2f'),
+    ('Tx min', 'Tx_min', '%.2f'),
+    ('Tx max', 'Tx_max', '%.2f'),
+    ('Tx median', 'Tx_p50', '%.1f'),
+    ('Tx 90th pct', 'Tx_p90', '%.1f'),
+    ('Tx 99th pct', 'Tx_p99', '%.1f'),
+    ('DO1 duty cycle', 'DO1_duty', '%.0f%%'),
+    ('DO2 duty cycle', 'DO2_duty', '%.0f%%'),
+    ('DO1 transitions', 'DO1_transitions', '%d'),
+    ('DO2 transitions', 'DO2_transitions', '%d'),
+)
+
+def format_stats(summary):
+    # [(label, [value per window])] as display strings, '-' where there is no value.
+    rows = []
+    for label, key, fmt in STATS_FIELDS:
+        values = []
+        for stats in summary.values():
+            value = stats[key]
+            if value is None:
+                values.append('-')
+            else:
+                values.append(fmt % (100 * value if key.endswith('_duty') else value))
+        rows.append((label, values))
+    return rows
+
+class DeviceManager:
+    # 'immediate' rebuilds the workbook after every reading, 'deferred' rebuilds it
+    # in the background every export_interval seconds or once export_threshold
+    # readings are pending, 'manual' only when log_readings_to_excel is called.
+    EXPORT_MODES = ('immediate', 'deferred', 'manual')
+    # What compact() does with raw readings past the retention age once they are
+    # summarised: copy them into per-month archive files, or drop them.
+    RETENTION_MODES = ('archive', 'delete')
+
+    SPECIFIC_DATE_SQL = "SELECT timestamp, DO1, DO2, Tx FROM readings WHERE date = ? ORDER BY timestamp"
+    DEVICE_SPECIFIC_DATE_SQL = ("SELECT timestamp, DO1, DO2, Tx FROM readings "
+                                "WHERE device_id = ? AND date = ? ORDER BY timestamp")
+    DATE_RANGE_SQL = "SELECT date, DO1, DO2, Tx FROM readings WHERE date >= ? AND date <= ? ORDER BY date"
+    EXPORT_SQL = "SELECT timestamp, date, A, B, DO1, DO2, Tx FROM readings ORDER BY timestamp"
+    # Dates only ever increase with the timestamp, so this is the same order as
+    # EXPORT_SQL while letting the date index serve the range.
+    EXPORT_RANGE_SQL = ("SELECT timestamp, date, A, B, DO1, DO2, Tx FROM readings "
+                        "WHERE date >= ? AND date <= ? ORDER BY date, timestamp")
+    EXCEL_MAX_ROWS = 1048576  # per worksheet, header row included
+    READINGS_SINCE_SQL = ("SELECT serial_number, timestamp, date, A, B, DO1, DO2, Tx FROM readings "
+                          "WHERE serial_number > ? ORDER BY serial_number DESC LIMIT ?")
+    DEVICE_READINGS_SINCE_SQL = ("SELECT serial_number, timestamp, date, A, B, DO1, DO2, Tx FROM readings "
+                                 "WHERE device_id = ? AND serial_number > ? ORDER BY serial_number DESC LIMIT ?")
+    MAX_SERIAL_SQL = "SELECT MAX(serial_number) FROM readings"
+    LATEST_READING_SQL = ("SELECT timestamp, date, A, B, DO1, DO2, Tx, device_id FROM readings "
+                          "ORDER BY serial_number DESC LIMIT 1")
+    DEVICE_LATEST_READING_SQL = ("SELECT timestamp, date, A, B, DO1, DO2, Tx, device_id FROM readings "
+                                 "WHERE device_id = ? ORDER BY serial_number DESC LIMIT 1")
+    INSERT_READING_SQL = ("INSERT INTO readings (timestamp, date, A, B, DO1, DO2, Tx, device_id) "
+                          "VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+
+    # daily_rollup keeps one row per date and device, updated in the same
+    # transaction as the readings, so day-level trends never touch the raw table.
+    # DO1/DO2 are 0/1, so the daily mode is whichever value covers more than half
+    # the day. On a tie Counter.most_common keeps the value seen first, i.e. the
+    # earliest reading, which is why first_DO1/first_DO2 are tracked. Across
+    # devices MIN(first_timestamp) is the only min/max aggregate, so SQLite takes
+    # the bare first_DO1/first_DO2 columns from the device that reported first.
+    DAILY_ROLLUP_SQL = '''SELECT date,
+                                 CASE WHEN 2 * SUM(DO1_ones) > SUM(count) THEN 1
+                                      WHEN 2 * SUM(DO1_ones) < SUM(count) THEN 0
+                                      ELSE first_DO1 END,
+                                 CASE WHEN 2 * SUM(DO2_ones) > SUM(count) THEN 1
+                                      WHEN 2 * SUM(DO2_ones) < SUM(count) THEN 0
+                                      ELSE first_DO2 END,
+                                 SUM(Tx_sum) / SUM(count),
+                                 MIN(first_timestamp)
+                          FROM daily_rollup WHERE date >= ? AND date <= ?
+                          GROUP BY date ORDER BY date'''
+    DEVICE_DAILY_ROLLUP_SQL = '''SELECT date,
+                                        CASE WHEN 2 * DO1_ones > count THEN 1
+                                             WHEN 2 * DO1_ones < count THEN 0
+                                             ELSE first_DO1 END,
+                                        CASE WHEN 2 * DO2_ones > count THEN 1
+                                             WHEN 2 * DO2_ones < count THEN 0
+                                             ELSE first_DO2 END,
+                                        Tx_sum / count
+                                 FROM daily_rollup WHERE device_id = ? AND date >= ? AND date <= ?
+                                 ORDER BY date'''
+    DAILY_ROLLUP_UPSERT_SQL = '''INSERT INTO daily_rollup (date, device_id, count, DO1_ones, DO2_ones,
+                                                           Tx_sum, Tx_min, Tx_max,
+                                                           first_timestamp, first_DO1, first_DO2)
+                                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                 ON CONFLICT (date, device_id) DO UPDATE SET
+                                     count = count + excluded.count,
+                                     DO1_ones = DO1_ones + excluded.DO1_ones,
+                                     DO2_ones = DO2_ones + excluded.DO2_ones,
+                                     Tx_sum = Tx_sum + excluded.Tx_sum,
+                                     Tx_min = MIN(Tx_min, excluded.Tx_min),
+                                     Tx_max = MAX(Tx_max, excluded.Tx_max),
+                                     first_timestamp = MIN(first_timestamp, excluded.first_timestamp),
+                                     first_DO1 = CASE WHEN excluded.first_timestamp < first_timestamp
+                                                      THEN excluded.first_DO1 ELSE first_DO1 END,
+                                     first_DO2 = CASE WHEN excluded.first_timestamp < first_timestamp
+                                                      THEN excluded.first_DO2 ELSE first_DO2 END'''
+    DAILY_ROLLUP_BACKFILL_SQL = (
+        "DELETE FROM daily_rollup",
+        '''INSERT INTO daily_rollup (date, device_id, count, DO1_ones, DO2_ones, Tx_sum, Tx_min, Tx_max,
+                                     first_timestamp)
+           SELECT date, device_id, COUNT(*), SUM(DO1), SUM(DO2), SUM(Tx), MIN(Tx), MAX(Tx), MIN(timestamp)
+           FROM readings GROUP BY date, device_id''',
+        '''UPDATE daily_rollup SET (first_DO1, first_DO2) =
+               (SELECT DO1, DO2 FROM readings
+                WHERE readings.device_id = daily_rollup.device_id AND readings.date = daily_rollup.date
+                ORDER BY timestamp LIMIT 1)''',
+    )
+
+    # hourly_rollup has the daily_rollup layout per local hour ('YYYY-MM-DD HH') and
+    # is filled by compact() for the readings it takes out of the live table.
+    HOURLY_ROLLUP_SQL = '''SELECT hour,
+                                  CASE WHEN 2 * SUM(DO1_ones) > SUM(count) THEN 1
+                                       WHEN 2 * SUM(DO1_ones) < SUM(count) THEN 0
+                                       ELSE first_DO1 END,
+                                  CASE WHEN 2 * SUM(DO2_ones) > SUM(count) THEN 1
+                                       WHEN 2 * SUM(DO2_ones) < SUM(count) THEN 0
+                                       ELSE first_DO2 END,
+                                  SUM(Tx_sum) / SUM(count),
+                                  MIN(first_timestamp)
+                           FROM hourly_rollup WHERE hour >= ? AND hour < ?
+                           GROUP BY hour ORDER BY hour'''
+    DEVICE_HOURLY_ROLLUP_SQL = '''SELECT hour,
+                                         CASE WHEN 2 * DO1_ones > count THEN 1
+                                              WHEN 2 * DO1_ones < count THEN 0
+                                              ELSE first_DO1 END,
+                                         CASE WHEN 2 * DO2_ones > count THEN 1
+                                              WHEN 2 * DO2_ones < count THEN 0
+                                              ELSE first_DO2 END,
+                                         Tx_sum / count
+                                  FROM hourly_rollup WHERE device_id = ? AND hour >= ? AND hour < ?
+                                  ORDER BY hour'''
+    HOURLY_ROLLUP_UPSERT_SQL = '''INSERT INTO hourly_rollup (hour, device_id, count, DO1_ones, DO2_ones,
+                                                             Tx_sum, Tx_min, Tx_max,
+                                                             first_timestamp, first_DO1, first_DO2)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                  ON CONFLICT (hour, device_id) DO UPDATE SET
+                                      count = count + excluded.count,
+                                      DO1_ones = DO1_ones + excluded.DO1_ones,
+                                      DO2_ones = DO2_ones + excluded.DO2_ones,
+                                      Tx_sum = Tx_sum + excluded.Tx_sum,
+                                      Tx_min = MIN(Tx_min, excluded.Tx_min),
+                                      Tx_max = MAX(Tx_max, excluded.Tx_max),
+                                      first_timestamp = MIN(first_timestamp, excluded.first_timestamp),
+                                      first_DO1 = CASE WHEN excluded.first_timestamp < first_timestamp
+                                                       THEN excluded.first_DO1 ELSE first_DO1 END,
+                                      first_DO2 = CASE WHEN excluded.first_timestamp < first_timestamp
+                                                       THEN excluded.first_DO2 ELSE first_DO2 END'''
+    COMPACT_READINGS_SQL = "SELECT device_id, timestamp, DO1, DO2, Tx FROM readings WHERE date >= ? AND date < ?"
+    COMPACT_MONTHS_SQL = "SELECT DISTINCT substr(date, 1, 7) FROM readings WHERE date < ? ORDER BY 1"
+    # Archive files hold plain readings tables with the trend indexes, so every
+    # readings query runs against them unchanged.
+    ARCHIVE_SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS archive.readings
+           (serial_number INTEGER PRIMARY KEY, timestamp REAL, date TEXT, A INTEGER, B INTEGER,
+            DO1 INTEGER, DO2 INTEGER, Tx REAL, device_id INTEGER NOT NULL DEFAULT 0)''',
+        '''CREATE INDEX IF NOT EXISTS archive.idx_readings_date_timestamp
+           ON readings (date, timestamp, DO1, DO2, Tx)''',
+        '''CREATE INDEX IF NOT EXISTS archive.idx_readings_device_date
+           ON readings (device_id, date, timestamp, DO1, DO2, Tx)''',
+        '''CREATE INDEX IF NOT EXISTS archive.idx_readings_timestamp ON readings (timestamp)''',
+    )
+    # OR IGNORE on the serial number makes a retried archive run harmless.
+    ARCHIVE_INSERT_SQL = '''INSERT OR IGNORE INTO archive.readings
+                                (serial_number, timestamp, date, A, B, DO1, DO2, Tx, device_id)
+                            SELECT serial_number, timestamp, date, A, B, DO1, DO2, Tx, device_id
+                            FROM main.readings WHERE date >= ? AND date < ?'''
+
+    COMPACT_DELETE_SQL = "DELETE FROM main.readings WHERE date >= ? AND date < ?"
+
+    # Storage layouts for the raw readings. 'standard' is the readings table above.
+    # 'packed' keeps them in readings_packed: epoch milliseconds, the local date
+    # as a day number (days since 1970-01-01), A/B/DO1/DO2 as bits 0-3 of flags
+    # and Tx in hundredths of a degree. Small integers take 1-2 bytes in a record
+    # instead of 8 for a REAL or 11 for the date text, so rows and index entries
+    # shrink and more of them fit in the page cache. readings stays as a view that
+    # decodes the packed columns, and PACKED_SQL replaces the hot queries with
+    # versions that filter and sort on the packed columns so they keep their
+    # indexes; every query returns the same shapes in either layout. Exports walk
+    # the (day, ts_ms) index, which saves the packed table a timestamp index.
+    STORAGE_LAYOUTS = ('standard', 'packed')
+    PACKED_SCHEMA = (
+        '''CREATE TABLE readings_packed
+           (serial_number INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts_ms INTEGER NOT NULL, day INTEGER NOT NULL, flags INTEGER NOT NULL,
+            Tx_centi INTEGER, device_id INTEGER NOT NULL DEFAULT 0)''',
+        '''CREATE INDEX idx_packed_day_ts ON readings_packed (day, ts_ms, flags, Tx_centi)''',
+        '''CREATE INDEX idx_packed_device_day ON readings_packed (device_id, day, ts_ms, flags, Tx_centi)''',
+        '''CREATE INDEX idx_packed_device_serial ON readings_packed (device_id, serial_number)''',
+        '''CREATE VIEW readings AS
+           SELECT serial_number, ts_ms / 1000.0 AS timestamp, date(day * 86400, 'unixepoch') AS date,
+                  flags & 1 AS A, (flags >> 1) & 1 AS B, (flags >> 2) & 1 AS DO1, (flags >> 3) & 1 AS DO2,
+                  Tx_centi / 100.0 AS Tx, device_id
+           FROM readings_packed''',
+    )
+    STANDARD_SCHEMA = (
+        '''CREATE TABLE readings
+           (serial_number INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp REAL, date TEXT, A INTEGER, B INTEGER,
+            DO1 INTEGER, DO2 INTEGER, Tx REAL, device_id INTEGER NOT NULL DEFAULT 0)''',
+        '''CREATE INDEX idx_readings_date_timestamp ON readings (date, timestamp, DO1, DO2, Tx)''',
+        '''CREATE INDEX idx_readings_device_date ON readings (device_id, date, timestamp, DO1, DO2, Tx)''',
+        '''CREATE INDEX idx_readings_device_serial ON readings (device_id, serial_number)''',
+        '''CREATE INDEX idx_readings_timestamp ON readings (timestamp)''',
+    )
+    # STORAGE_CONVERSIONS[layout] rewrites a database (or archive file) in the
+    # other layout into layout. The readings table's indexes go with it on DROP.
+    STORAGE_CONVERSIONS = {
+        'packed': (
+            "ALTER TABLE readings RENAME TO readings_standard",
+            PACKED_SCHEMA[0],
+            '''INSERT INTO readings_packed (serial_number, ts_ms, day, flags, Tx_centi, device_id)
+               SELECT serial_number, CAST(round(timestamp * 1000) AS INTEGER),
+                      CAST(julianday(date) - 2440587.5 AS INTEGER),
+                      (A & 1) | ((B & 1) << 1) | ((DO1 & 1) << 2) | ((DO2 & 1) << 3),
+                      CAST(round(Tx * 100) AS INTEGER), device_id
+               FROM readings_standard''',
+            "DROP TABLE readings_standard",
+        ) + PACKED_SCHEMA[1:],
+        'standard': (
+            "DROP VIEW readings",
+            STANDARD_SCHEMA[0],
+            '''INSERT INTO readings (serial_number, timestamp, date, A, B, DO1, DO2, Tx, device_id)
+               SELECT serial_number, ts_ms / 1000.0, date(day * 86400, 'unixepoch'),
+                      flags & 1, (flags >> 1) & 1, (flags >> 2) & 1, (flags >> 3) & 1,
+                      Tx_centi / 100.0, device_id
+               FROM readings_packed''',
+            "DROP TABLE readings_packed",
+        ) + STANDARD_SCHEMA[1:],
+    }
+    # Dates come in as 'YYYY-MM-DD' and are turned into day numbers once per
+    # statement, so the comparisons run on the indexed integer column.
+    PACKED_SQL = {
+        'SPECIFIC_DATE_SQL':
+            "SELECT ts_ms / 1000.0, (flags >> 2) & 1, (flags >> 3) & 1, Tx_centi / 100.0 FROM readings_packed "
+            "WHERE day = CAST(julianday(?) - 2440587.5 AS INTEGER) ORDER BY ts_ms",
+        'DEVICE_SPECIFIC_DATE_SQL':
+            "SELECT ts_ms / 1000.0, (flags >> 2) & 1, (flags >> 3) & 1, Tx_centi / 100.0 FROM readings_packed "
+            "WHERE device_id = ? AND day = CAST(julianday(?) - 2440587.5 AS INTEGER) ORDER BY ts_ms",
+        'DATE_RANGE_SQL':
+            "SELECT date(day * 86400, 'unixepoch'), (flags >> 2) & 1, (flags >> 3) & 1, Tx_centi / 100.0 "
+            "FROM readings_packed WHERE day >= CAST(julianday(?) - 2440587.5 AS INTEGER) "
+            "AND day <= CAST(julianday(?) - 2440587.5 AS INTEGER) ORDER BY day",
+        'EXPORT_SQL':
+            "SELECT ts_ms / 1000.0, date(day * 86400, 'unixepoch'), flags & 1, (flags >> 1) & 1, "
+            "(flags >> 2) & 1, (flags >> 3) & 1, Tx_centi / 100.0 FROM readings_packed ORDER BY day, ts_ms",
+        'EXPORT_RANGE_SQL':
+            "SELECT ts_ms / 1000.0, date(day * 86400, 'unixepoch'), flags & 1, (flags >> 1) & 1, "
+            "(flags >> 2) & 1, (flags >> 3) & 1, Tx_centi / 100.0 FROM readings_packed "
+            "WHERE day >= CAST(julianday(?) - 2440587.5 AS INTEGER) "
+            "AND day <= CAST(julianday(?) - 2440587.5 AS INTEGER) ORDER BY day, ts_ms",
+        'INSERT_READING_SQL':
+            "INSERT INTO readings_packed (ts_ms, day, flags, Tx_centi, device_id) "
+            "VALUES (CAST(round(?1 * 1000) AS INTEGER), CAST(julianday(?2) - 2440587.5 AS INTEGER), "
+            "(?3 & 1) | ((?4 & 1) << 1) | ((?5 & 1) << 2) | ((?6 & 1) << 3), CAST(round(?7 * 100) AS INTEGER), ?8)",
+        'DAILY_ROLLUP_BACKFILL_SQL': (
+            "DELETE FROM daily_rollup",
+            '''INSERT INTO daily_rollup (date, device_id, count, DO1_ones, DO2_ones, Tx_sum, Tx_min, Tx_max,
+                                         first_timestamp)
+               SELECT date(day * 86400, 'unixepoch'), device_id, COUNT(*), SUM((flags >> 2) & 1),
+                      SUM((flags >> 3) & 1), SUM(Tx_centi / 100.0), MIN(Tx_centi) / 100.0,
+                      MAX(Tx_centi) / 100.0, MIN(ts_ms) / 1000.0
+               FROM readings_packed GROUP BY day, device_id''',
+            '''UPDATE daily_rollup SET (first_DO1, first_DO2) =
+                   (SELECT (flags >> 2) & 1, (flags >> 3) & 1 FROM readings_packed
+                    WHERE readings_packed.device_id = daily_rollup.device_id
+                      AND readings_packed.day = CAST(julianday(daily_rollup.date) - 2440587.5 AS INTEGER)
+                    ORDER BY ts_ms LIMIT 1)''',
+        ),
+        'COMPACT_READINGS_SQL':
+            "SELECT device_id, ts_ms / 1000.0, (flags >> 2) & 1, (flags >> 3) & 1, Tx_centi / 100.0 "
+            "FROM readings_packed WHERE day >= CAST(julianday(?) - 2440587.5 AS INTEGER) "
+            "AND day < CAST(julianday(?) - 2440587.5 AS INTEGER)",
+        'COMPACT_MONTHS_SQL':
+            "SELECT DISTINCT substr(date(day * 86400, 'unixepoch'), 1, 7) FROM readings_packed "
+            "WHERE day < CAST(julianday(?) - 2440587.5 AS INTEGER) ORDER BY 1",
+        'COMPACT_DELETE_SQL':
+            "DELETE FROM main.readings_packed WHERE day >= CAST(julianday(?) - 2440587.5 AS INTEGER) "
+            "AND day < CAST(julianday(?) - 2440587.5 AS INTEGER)",
+        # Archives of a packed database are packed too; the view inside the
+        # archive file resolves against the archive's own table.
+        'ARCHIVE_SCHEMA': tuple(statement.replace('CREATE TABLE ', 'CREATE TABLE IF NOT EXISTS archive.')
+                                .replace('CREATE INDEX ', 'CREATE INDEX IF NOT EXISTS archive.')
+                                .replace('CREATE VIEW ', 'CREATE VIEW IF NOT EXISTS archive.')
+                                for statement in PACKED_SCHEMA),
+        'ARCHIVE_INSERT_SQL':
+            '''INSERT OR IGNORE INTO archive.readings_packed
+                   (serial_number, ts_ms, day, flags, Tx_centi, device_id)
+               SELECT serial_number, ts_ms, day, flags, Tx_centi, device_id
+               FROM main.readings_packed WHERE day >= CAST(julianday(?) - 2440587.5 AS INTEGER)
+               AND day < CAST(julianday(?) - 2440587.5 AS INTEGER)''',
+    }
+
+    # SCHEMA_MIGRATIONS[n] upgrades a database from user_version n to n + 1.
+    SCHEMA_MIGRATIONS = (
+        # 1: covering index for the per-day and date-range trends, timestamp index for exports
+        ('''CREATE INDEX IF NOT EXISTS idx_readings_date_timestamp
+            ON readings (date, timestamp, DO1, DO2, Tx)''',
+         '''CREATE INDEX IF NOT EXISTS idx_readings_timestamp ON readings (timestamp)'''),
+        # 2: per-day rollup (superseded by 3, which rebuilds and backfills it)
+        ('''CREATE TABLE IF NOT EXISTS daily_rollup
+            (date TEXT PRIMARY KEY, count INTEGER NOT NULL,
+             DO1_ones INTEGER NOT NULL, DO2_ones INTEGER NOT NULL,
+             Tx_sum REAL NOT NULL, Tx_min REAL, Tx_max REAL,
+             first_timestamp REAL, first_DO1 INTEGER, first_DO2 INTEGER)''',),
+        # 3: fleet support. Existing readings belong to device 0; the rollup is
+        # rebuilt per (date, device_id).
+        ('''ALTER TABLE readings ADD COLUMN device_id INTEGER NOT NULL DEFAULT 0''',
+         '''CREATE INDEX IF NOT EXISTS idx_readings_device_date
+            ON readings (device_id, date, timestamp, DO1, DO2, Tx)''',
+         '''CREATE INDEX IF NOT EXISTS idx_readings_device_serial ON readings (device_id, serial_number)''',
+         '''DROP TABLE daily_rollup''',
+         '''CREATE TABLE daily_rollup
+            (date TEXT NOT NULL, device_id INTEGER NOT NULL, count INTEGER NOT NULL,
+             DO1_ones INTEGER NOT NULL, DO2_ones INTEGER NOT NULL,
+             Tx_sum REAL NOT NULL, Tx_min REAL, Tx_max REAL,
+             first_timestamp REAL, first_DO1 INTEGER, first_DO2 INTEGER,
+             PRIMARY KEY (date, device_id))''',
+         '''CREATE INDEX IF NOT EXISTS idx_daily_rollup_device ON daily_rollup (device_id, date)''')
+        + DAILY_ROLLUP_BACKFILL_SQL,
+        # 4: hourly summaries of compacted readings
+        ('''CREATE TABLE IF NOT EXISTS hourly_rollup
+            (hour TEXT NOT NULL, device_id INTEGER NOT NULL, count INTEGER NOT NULL,
+             DO1_ones INTEGER NOT NULL, DO2_ones INTEGER NOT NULL,
+             Tx_sum REAL NOT NULL, Tx_min REAL, Tx_max REAL,
+             first_timestamp REAL, first_DO1 INTEGER, first_DO2 INTEGER,
+             PRIMARY KEY (hour, device_id))''',
+         '''CREATE INDEX IF NOT EXISTS idx_hourly_rollup_device ON hourly_rollup (device_id, hour)'''),
+    )
+
+    def __init__(self, device, db_filename, excel_filename, export_mode='immediate',
+                 export_interval=30.0, export_threshold=1000, read_pool_size=4,
+                 write_behind=False, write_batch_size=500, write_max_latency=0.05,
+                 write_queue_size=10000, enqueue_timeout=None, device_id=0, poll_workers=4,
+                 retention_days=None, retention_mode='archive', retention_interval=3600.0,
+                 storage='standard', cache_rows=2000000, metrics=None, synchronous='NORMAL',
+                 ingest=None, stats_windows=StreamingStats.WINDOWS):
+        if export_mode not in self.EXPORT_MODES:
+            raise ValueError("export_mode must be one of: " + ", ".join(self.EXPORT_MODES))
+        if retention_mode not in self.RETENTION_MODES:
+            raise ValueError("retention_mode must be one of: " + ", ".join(self.RETENTION_MODES))
+        if storage not in self.STORAGE_LAYOUTS:
+            raise ValueError("storage must be one of: " + ", ".join(self.STORAGE_LAYOUTS))
+        # device is the simulator for device_id, the default for every per-device
+        # call; more devices sharing this database go in via register_device.
+        self.device = device
+        self.device_id = device_id
+        self.devices = {device_id: device}
+        self.db_filename = db_filename
+        self.excel_filename = excel_filename
+        self.export_mode = export_mode
+        # Trend and aggregate results, up to cache_rows readings' worth (0 disables).
+        self.query_cache = QueryCache(cache_rows) if cache_rows else None
+        self.export_interval = export_interval
+        self.export_threshold = export_threshold
+        self.dirty_rows = 0
+        self._dirty_lock = threading.Lock()
+        self._export_lock = threading.Lock()
+        self._export_wakeup = threading.Event()
+        self._export_stop = threading.Event()
+        self._export_thread = None
+        # With write_behind, set_inputs only enqueues readings; a writer thread
+        # group-commits them in batches of up to write_batch_size, waiting at most
+        # write_max_latency seconds for a batch to fill. A full queue blocks the
+        # producer (for up to enqueue_timeout seconds, then raises queue.Full).
+        self.write_batch_size = write_batch_size
+        self.write_max_latency = write_max_latency
+        self.enqueue_timeout = enqueue_timeout
+        self._write_queue = None
+        self._writer_thread = None
+        # Newest reading known to this process per device id (None for the whole
+        # fleet), bumped with status_version on every change; _latest_data_version
+        # holds the writer's PRAGMA data_version when each entry was last checked
+        # against the database.
+        self._status_lock = threading.Lock()
+        self._latest = {}
+        self._latest_data_version = {}
+        self.status_version = 0
+        # Streaming statistics per device over the (name, seconds) stats_windows,
+        # fed with every reading this process logs (None or () turns them off).
+        # They start empty: nothing is read back from the database.
+        self.stats_windows = stats_windows
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        # poll_devices updates the simulators on a small pool, created on first use.
+        self.poll_workers = poll_workers
+        self._poll_lock = threading.Lock()
+        self._poll_executor = None
+        self._poll_stop = threading.Event()
+        self._poll_thread = None
+        self.last_poll_duration = None
+        # Failures of the background workers, {worker: [count, message, exception]}
+        # with the latest of each. Printed as they happen, then raised by close()
+        # ('write_behind' ones already by flush()) so lost readings get noticed.
+        self._worker_errors = {}
+        self._worker_errors_lock = threading.Lock()
+        # With retention_days set, a background thread runs compact() every
+        # retention_interval seconds. Archived months live next to the database
+        # as <name>_archive_YYYY-MM.db and are read alongside the live table.
+        # 'delete' drops the old readings instead: their days then only remain
+        # in daily_rollup and hourly_rollup, so get_date_range_aggregates still
+        # reports days that get_date_range_trend no longer has readings for.
+        self.retention_days = retention_days
+        self.retention_mode = retention_mode
+        self.retention_interval = retention_interval
+        self._retention_stop = threading.Event()
+        self._retention_thread = None
+        # storage picks the layout of a new database; an existing one keeps its
+        # own until convert_storage is called.
+        self.storage = None
+        # With metrics (a Metrics) every method, connection and statement is timed.
+        self.metrics = metrics
+        if metrics is not None:
+            self._instrument(metrics)
+        # With ingest (a tekx_ingest.IngestClient) readings are committed by the
+        # ingest daemon that owns the database's writes; reads stay local.
+        self.ingest = ingest
+        self.db = ConnectionManager(db_filename, read_pool_size=read_pool_size, synchronous=synchronous,
+                                    metrics=metrics)
+        self.create_db(storage)
+        if write_behind:
+            self._write_queue = queue.Queue(maxsize=write_queue_size)
+            self._writer_thread = threading.Thread(target=self._write_behind_worker, daemon=True)
+            self._writer_thread.start()
+        if self.export_mode == 'deferred':
+            self._export_thread = threading.Thread(target=self._export_worker, daemon=True)
+            self._export_thread.start()
+        if self.retention_days is not None:
+            self._retention_thread = threading.Thread(target=self._retention_worker, daemon=True)
+            self._retention_thread.start()
+
+    def _instrument(self, metrics):
+        # Shadow each method with a timed wrapper on this instance only. Worker
+        # loops and generators are skipped: their run time isn't a latency.
+        gauges = self._metrics_gauges
+        for name, method in inspect.getmembers(self, inspect.ismethod):
+            if name.startswith('__') or name.endswith('_worker') or inspect.isgeneratorfunction(method):
+                continue
+            setattr(self, name, metrics.wrap('method', name, method))
+        metrics.add_gauges(gauges)
+
+    def _metrics_gauges(self):
+        gauges = {'dirty_rows': self.dirty_rows, 'status_version': self.status_version,
+                  'archives': len(self._find_archives())}
+        if self._write_queue is not None:
+            gauges['write_queue_depth'] = self._write_queue.qsize()
+        for worker, (count, message, error) in self.worker_errors().items():
+            gauges[worker + '_failures'] = count
+        if self.query_cache is not None:
+            for name, value in self.query_cache.stats().items():
+                gauges['query_cache_' + name] = value
+        return gauges
+
+    def register_device(self, device_id, device=None):
+        # Add a device to the fleet (a fresh simulator unless one is given).
+        if device is None:
+            device = TekXSimulator()
+        self.devices[device_id] = device
+        return device
+
+    def unregister_device(self, device_id):
+        # Stop polling a device; its readings stay in the database.
+        if device_id == self.device_id:
+            raise ValueError("Cannot unregister the default device %r" % (device_id,))
+        del self.devices[device_id]
+
+    def set_inputs(self, A, B, device_id=None):
+        if device_id is None:
+            device_id = self.device_id
+        device = self.devices[device_id]
+        device.A = A
+        device.B = B
+        device.update_status()
+        self._log_and_export([self.make_reading(device_id)])
+
+    def _log_and_export(self, readings):
+        if self._write_queue is not None:
+            for reading in readings:
+                self._write_queue.put(reading, timeout=self.enqueue_timeout)
+            self._remember_latest(readings)
+            self._update_stats(readings)
+        else:
+            self.log_readings_batch(readings)
+        if self.export_mode == 'immediate':
+            self.log_readings_to_excel()
+        else:
+            self.mark_export_dirty(len(readings))
+
+    def _poll_chunk(self, device_ids):
+        readings = []
+        for device_id in device_ids:
+            self.devices[device_id].update_status()
+            readings.append(self.make_reading(device_id))
+        return readings
+
+    def poll_devices(self, device_ids=None):
+        # Take one reading from every registered device (or just device_ids).
+        # The devices are read concurrently on the poll pool, in one chunk per
+        # worker, and all readings go to the single writer together: one
+        # transaction, or one batch through the write-behind queue.
+        if device_ids is None:
+            device_ids = list(self.devices)
+        if not device_ids:
+            return []
+        with self._poll_lock:
+            if self._poll_executor is None:
+                self._poll_executor = ThreadPoolExecutor(max_workers=self.poll_workers)
+        chunk_size = -(-len(device_ids) // self.poll_workers)
+        chunks = [device_ids[i:i + chunk_size] for i in range(0, len(device_ids), chunk_size)]
+        readings = list(itertools.chain.from_iterable(self._poll_executor.map(self._poll_chunk, chunks)))
+        self._log_and_export(readings)
+        return readings
+
+    def start_polling(self, interval=1.0):
+        # Poll the whole fleet every `interval` seconds on a background thread.
+        # Ticks are scheduled against a monotonic clock, so a slow poll shortens
+        # the next wait instead of drifting; ticks missed entirely are skipped.
+        if self._poll_thread is not None:
+            return
+        self._poll_stop.clear()
+        self._poll_thread = threading.Thread(target=self._poll_worker, args=(interval,), daemon=True)
+        self._poll_thread.start()
+
+    def _poll_worker(self, interval):
+        next_poll = time.monotonic()
+        while not self._poll_stop.is_set():
+            started = time.monotonic()
+            try:
+                self.poll_devices()
+            except Exception as e:
+                self._worker_failed('poll', "Polling devices failed:", e)
+            self.last_poll_duration = time.monotonic() - started
+            next_poll += interval
+            now = time.monotonic()
+            if next_poll < now:
+                next_poll = now
+            self._poll_stop.wait(next_poll - now)
+
+    def stop_polling(self):
+        if self._poll_thread is not None:
+            self._poll_stop.set()
+            self._poll_thread.join()
+            self._poll_thread = None
+
+    def mark_export_dirty(self, rows=1):
+        with self._dirty_lock:
+            self.dirty_rows += rows
+            threshold_reached = self.export_threshold and self.dirty_rows >= self.export_threshold
+        if threshold_reached and self.export_mode == 'deferred':
+            self._export_wakeup.set()
+
+    def request_export(self):
+        # Ask the background exporter to rebuild the workbook now without waiting for it.
+        if self._export_thread is None:
+            self.log_readings_to_excel()
+        else:
+            self._export_wakeup.set()
+
+    def _write_behind_worker(self):
+        stopping = False
+        while not stopping:
+            item = self._write_queue.get()
+            batch = []
+            taken = 1
+            if item is None:
+                stopping = True
+            else:
+                batch.append(item)
+            deadline = time.monotonic() + self.write_max_latency
+            while not stopping and len(batch) < self.write_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._write_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                taken += 1
+                if item is None:
+                    stopping = True
+                else:
+                    batch.append(item)
+            try:
+                if batch:
+                    self._insert_batch(batch)
+            except Exception as e:
+                self._worker_failed('write_behind', "Write-behind flush of %d readings failed:" % len(batch), e)
+            finally:
+                for _ in range(taken):
+                    self._write_queue.task_done()
+
+    def flush(self):
+        # Block until every enqueued reading has been committed, by the ingest
+        # daemon too whatever its ack mode; raises RuntimeError if a write-behind
+        # batch failed since the last flush.
+        self._wait_for_writes()
+        self._raise_worker_errors(('write_behind',))
+
+    def _wait_for_writes(self):
+        # flush() for our own reads and exports: a failed batch is left for the
+        # caller's flush() or close() to report.
+        if self._write_queue is not None:
+            self._write_queue.join()
+        if self.ingest is not None:
+            self.ingest.flush()
+
+    def _worker_failed(self, worker, message, error):
+        print(message, error)
+        with self._worker_errors_lock:
+            failure = self._worker_errors.setdefault(worker, [0, None, None])
+            failure[:] = failure[0] + 1, message, error
+
+    def worker_errors(self):
+        # {worker: (failures, message, exception)} not yet raised by flush() or close().
+        with self._worker_errors_lock:
+            return {worker: tuple(failure) for worker, failure in self._worker_errors.items()}
+
+    def _raise_worker_errors(self, workers=None):
+        with self._worker_errors_lock:
+            failures = [(worker, self._worker_errors.pop(worker)) for worker in list(self._worker_errors)
+                        if workers is None or worker in workers]
+        if failures:
+            error = failures[-1][1][2]
+            raise RuntimeError("; ".join("%s %s%s" % (message, exception,
+                                                      " (%d failures)" % count if count > 1 else "")
+                                         for worker, (count, message, exception) in failures)) from error
+
+    def _export_worker(self):
+        while not self._export_stop.is_set():
+            self._export_wakeup.wait(self.export_interval)
+            self._export_wakeup.clear()
+            if self._export_stop.is_set() or not self.dirty_rows:
+                continue
+            try:
+                self.log_readings_to_excel()
+            except Exception as e:
+                self._worker_failed('export', "Background Excel export failed:", e)
+
+    def close(self):
+        self.stop_polling()
+        if self._retention_thread is not None:
+            self._retention_stop.set()
+            self._retention_thread.join()
+            self._retention_thread = None
+        if self._poll_executor is not None:
+            self._poll_executor.shutdown()
+            self._poll_executor = None
+        if self._writer_thread is not None:
+            self._write_queue.put(None)
+            self._writer_thread.join()
+            self._writer_thread = None
+        if self._export_thread is not None:
+            self._export_stop.set()
+            self._export_wakeup.set()
+            self._export_thread.join()
+            self._export_thread = None
+        # Don't leave readings out of the workbook just because the schedule hasn't fired yet.
+        try:
+            if self.export_mode == 'deferred' and self.dirty_rows:
+                self.log_readings_to_excel()
+        finally:
+            self.db.close()
+        self._raise_worker_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_status(self, device_id=None):
+        # (DO1, DO2, Tx) of the newest reading, or of the device itself before it
+        # has logged anything.
+        version, latest = self.get_latest_reading(device_id)
+
+        if latest is None:
+            device = self.devices[self.device_id if device_id is None else device_id]
+            return device.DO1, device.DO2, device.Tx
+
+        return latest[4], latest[5], latest[6]
+
+    def _remember_latest(self, readings):
+        # readings in log_readings_batch order, oldest first
+        with self._status_lock:
+            for reading in readings:
+                self._latest[reading[7]] = reading
+            self._latest[None] = readings[-1]
+            self.status_version += 1
+
+    def _update_stats(self, readings):
+        if not self.stats_windows:
+            return
+        for timestamp, date, A, B, DO1, DO2, Tx, device_id in readings:
+            stats = self._stats.get(device_id)
+            if stats is None:
+                with self._stats_lock:
+                    stats = self._stats.setdefault(device_id, StreamingStats(self.stats_windows))
+            stats.add(timestamp, DO1, DO2, Tx)
+
+    def get_online_stats(self, device_id=None, now=None):
+        # {window name: statistics} for one device (the default one unless
+        # device_id is given), from memory only; see StreamingStats.
+        if not self.stats_windows:
+            return {}
+        stats = self._stats.get(self.device_id if device_id is None else device_id)
+        if stats is None:
+            stats = StreamingStats(self.stats_windows)
+        return stats.summary(now)
+
+    def max_serial(self):
+        # Serial number of the newest committed reading (0 when there is none).
+        # Any write moves it, so it versions everything derived from the readings.
+        with self.db.reader() as conn:
+            return conn.execute(self.MAX_SERIAL_SQL).fetchone()[0] or 0
+
+    def get_latest_reading(self, device_id=None):
+        # Returns (status_version, reading) with reading in log_readings_batch order,
+        # or (status_version, None) when there is nothing logged yet. device_id=None
+        # means the newest reading from any device. Answered from memory; SQLite is
+        # only asked on cold start or when another connection wrote.
+        with self._status_lock:
+            version = self.status_version
+            latest = self._latest.get(device_id)
+            known_data_version = self._latest_data_version.get(device_id)
+        if latest is not None:
+            # Readings still queued for write-behind are newer than anything committed.
+            if self._write_queue is not None and self._write_queue.unfinished_tasks:
+                return version, latest
+            if self.db.data_version() == known_data_version:
+                return version, latest
+
+        data_version = self.db.data_version()
+        with self.db.reader() as conn:
+            if device_id is None:
+                row = conn.execute(self.LATEST_READING_SQL).fetchone()
+            else:
+                row = conn.execute(self.DEVICE_LATEST_READING_SQL, (device_id,)).fetchone()
+        with self._status_lock:
+            # Don't let a slower reload overwrite a reading logged meanwhile, nor
+            # an older committed row replace one logged here but not committed yet
+            # (write-behind, or an ingest daemon acking before its commit).
+            if self.status_version == version:
+                self._latest_data_version[device_id] = data_version
+                current = self._latest.get(device_id)
+                if row is not None and row != current and (current is None or row[0] >= current[0]):
+                    self._latest[device_id] = row
+                    self.status_version += 1
+            return self.status_version, self._latest.get(device_id)
+
+    def calculate_mode(self, data):
+        # Count occurrences of each value
+        counts = Counter(data)
+        # Get the most common value(s)
+        mode_values = counts.most_common(1)
+        if mode_values:  # Check if there are mode values
+            mode_value, mode_count = mode_values[0]
+            return mode_value 
+        else:
+            return None
+    def _specific_date_query(self, selected_date, device_id):
+        if device_id is None:
+            return self.SPECIFIC_DATE_SQL, (selected_date,)
+        return self.DEVICE_SPECIFIC_DATE_SQL, (device_id, selected_date)
+
+    @cached_query('selected_date')
+    def get_specific_date_trend(self, selected_date, device_id=None):
+        # device_id=None merges every device's readings for the day.
+        data = []
+        partitions = 0
+        for conn in self._partitions(selected_date, selected_date):
+            c = conn.cursor()
+
+            c.execute(*self._specific_date_query(selected_date, device_id))
+            rows = c.fetchall()
+            if rows:
+                data.extend(rows)
+                partitions += 1
+        if partitions > 1:
+            data.sort()
+
+        timestamps = [row[0] for row in data]
+        DO1_values = [row[1] for row in data]
+        DO2_values = [row[2] for row in data]
+        Tx_values  = [row[3] for row in data]
+
+        return timestamps, DO1_values, DO2_values,Tx_values
+    @cached_query('selected_date')
+    def get_specific_date_trend_arrays(self, selected_date, as_datetime64=False, chunk_size=65536,
+                                       device_id=None):
+        # Columnar get_specific_date_trend: float64 epoch seconds (or local
+        # datetime64[us]), uint8 DO1/DO2 and float32 Tx, filled chunk by chunk.
+        sql, params = self._specific_date_query(selected_date, device_id)
+        parts = [self._fetch_trend_arrays(conn, sql, params, chunk_size)
+                 for conn in self._partitions(selected_date, selected_date)]
+        filled_parts = [part for part in parts if len(part[0])]
+        if len(filled_parts) > 1:
+            # The day is split between an archive and the live table.
+            columns = [np.concatenate(column) for column in zip(*filled_parts)]
+            order = np.argsort(columns[0], kind='stable')
+            timestamps, DO1_values, DO2_values, Tx_values = [column[order] for column in columns]
+        else:
+            timestamps, DO1_values, DO2_values, Tx_values = filled_parts[0] if filled_parts else parts[-1]
+
+        if as_datetime64:
+            timestamps = timestamps_to_datetime64(timestamps)
+        return timestamps, DO1_values, DO2_values, Tx_values
+
+    def _fetch_trend_arrays(self, conn, sql, params, chunk_size):
+        c = conn.cursor()
+        # One read transaction so the count and the rows see the same snapshot.
+        c.execute("BEGIN")
+        count = c.execute("SELECT COUNT(*) FROM (%s)" % sql, params).fetchone()[0]
+        timestamps = np.empty(count, dtype=np.float64)
+        DO1_values = np.empty(count, dtype=np.uint8)
+        DO2_values = np.empty(count, dtype=np.uint8)
+        Tx_values = np.empty(count, dtype=np.float32)
+
+        c.execute(sql, params)
+        filled = 0
+        while True:
+            chunk = c.fetchmany(chunk_size)
+            if not chunk:
+                break
+            block = np.fromiter(itertools.chain.from_iterable(chunk), dtype=np.float64,
+                                count=4 * len(chunk)).reshape(-1, 4)
+            end = filled + len(block)
+            timestamps[filled:end] = block[:, 0]
+            DO1_values[filled:end] = block[:, 1]
+            DO2_values[filled:end] = block[:, 2]
+            Tx_values[filled:end] = block[:, 3]
+            filled = end
+        conn.rollback()
+        return timestamps, DO1_values, DO2_values, Tx_values
+
+    def _find_archives(self):
+        # [(month, path)] of the archive files next to the database, oldest first.
+        # Listed on every use rather than kept, so archives written by another
+        # process's compact() are read as soon as they exist.
+        directory, name = os.path.split(os.path.abspath(self.db_filename))
+        prefix = os.path.splitext(name)[0] + '_archive_'
+        archives = []
+        for entry in os.listdir(directory):
+            month = entry[len(prefix):-len('.db')]
+            if entry.startswith(prefix) and entry.endswith('.db') and len(month) == 7:
+                archives.append((month, os.path.join(directory, entry)))
+        archives.sort()
+        return archives
+
+    def _archive_filename(self, month):
+        return "%s_archive_%s.db" % (os.path.splitext(self.db_filename)[0], month)
+
+    def _partitions(self, start_date=None, end_date=None):
+        # Read connections holding the readings of start_date..end_date, oldest
+        # first: each monthly archive overlapping the range, then the live table.
+        start_month = None if start_date is None else str(start_date)[:7]
+        end_month = None if end_date is None else str(end_date)[:7]
+        for month, path in self._find_archives():
+            if (start_month is None or month >= start_month) and (end_month is None or month <= end_month):
+                with self.db.partition_reader(path) as conn:
+                    yield conn
+        with self.db.reader() as conn:
+            yield conn
+
+    def get_readings_since(self, serial_number, limit=-1, device_id=None):
+        # Readings with serial_number above the given watermark, oldest first, as
+        # (serial_number, timestamp, date, A, B, DO1, DO2, Tx). With a limit only
+        # the newest `limit` of them are returned. A primary-key (or device_id,
+        # serial_number) range scan, so the cost depends on the number of new
+        # rows, not the table size. Live table only; compact() never archives
+        # readings that are still this recent.
+        with self.db.reader() as conn:
+            if device_id is None:
+                rows = conn.execute(self.READINGS_SINCE_SQL, (serial_number, limit)).fetchall()
+            else:
+                rows = conn.execute(self.DEVICE_READINGS_SINCE_SQL,
+                                    (device_id, serial_number, limit)).fetchall()
+        rows.reverse()
+        return rows
+
+    @cached_query('start_date', 'end_date')
+    def get_date_range_trend(self, start_date, end_date):
+        start_date, end_date = _day_string(start_date), _day_string(end_date)
+        data = []
+        for conn in self._partitions(start_date, end_date):
+            c = conn.cursor()
+
+            c.execute(self.DATE_RANGE_SQL, (start_date, end_date))
+            data.extend(c.fetchall())
+
+        date_dict = {}  # Dictionary to store DO1, DO2, and Tx values for each date
+        for row in data:
+            date = row[0]
+            DO1_value = row[1]
+            DO2_value = row[2]
+            tx_value = row[3]
+            if date not in date_dict:
+                date_dict[date] = {'DO1': [], 'DO2': [], 'Tx': []}
+        
+            date_dict[date]['DO1'].append(DO1_value)
+            date_dict[date]['DO2'].append(DO2_value)
+            date_dict[date]['Tx'].append(tx_value)
+        return date_dict
+    def calculate_average(self,number_list):
+        if not number_list:
+            return 0
+        
+        total = sum(number_list)
+        average = total / len(number_list)
+       # print(number_list,average)
+        return average       
+    def calculate_mode_for_dates(self, date_dict):
+        dates = []
+        do1_modes = []
+        do2_modes = []
+        tx_modes = []
+    
+        for date, values in date_dict.items():
+            if not values:
+                continue
+        
+            # Calculate mode for DO1 and DO2
+            do1_mode = self.calculate_mode(values['DO1'])
+            do2_mode = self.calculate_mode(values['DO2'])
+            tx_mode = self.calculate_average(values['Tx'])
+            # Append results to lists
+            dates.append(date)
+            do1_modes.append(do1_mode)
+            do2_modes.append(do2_mode)
+            tx_modes.append(tx_mode)
+    
+        return dates, do1_modes, do2_modes, tx_modes
+
+    @cached_query('start_date', 'end_date')
+    def get_date_range_aggregates(self, start_date, end_date, device_id=None):
+        # Same result as calculate_mode_for_dates(get_date_range_trend(...)), read from
+        # daily_rollup so the cost is one row per day whatever the sampling rate
+        # (see test_tekx_core.py). Days compacted with mode='delete' are the
+        # exception: their readings are gone but their rollup rows are kept.
+        # device_id=None aggregates the whole fleet.
+        start_date, end_date = _day_string(start_date), _day_string(end_date)
+        with self.db.reader() as conn:
+            if device_id is None:
+                data = conn.execute(self.DAILY_ROLLUP_SQL, (start_date, end_date)).fetchall()
+            else:
+                data = conn.execute(self.DEVICE_DAILY_ROLLUP_SQL, (device_id, start_date, end_date)).fetchall()
+
+        dates = [row[0] for row in data]
+        do1_modes = [row[1] for row in data]
+        do2_modes = [row[2] for row in data]
+        tx_averages = [row[3] for row in data]
+        return dates, do1_modes, do2_modes, tx_averages
+
+    def create_db(self, storage='standard'):
+        with self.db.writer() as conn:
+            c = conn.cursor()
+            # IMMEDIATE so two processes opening an old database don't both migrate it.
+            c.execute("BEGIN IMMEDIATE")
+            # A packed database starts out as a standard one, migrated to the
+            # current version and converted while it is still empty.
+            is_new = c.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'readings'").fetchone()[0] == 0
+            c.execute('''CREATE TABLE IF NOT EXISTS readings
+                         (serial_number INTEGER PRIMARY KEY AUTOINCREMENT,
+                          timestamp REAL, date TEXT, A INTEGER, B INTEGER,
+                          DO1 INTEGER, DO2 INTEGER, Tx REAL)''')
+            version = c.execute("PRAGMA user_version").fetchone()[0]
+            for target, statements in enumerate(self.SCHEMA_MIGRATIONS[version:], version + 1):
+                for statement in statements:
+                    c.execute(statement)
+                c.execute("PRAGMA user_version=%d" % target)
+            if is_new and storage == 'packed':
+                for statement in self.STORAGE_CONVERSIONS[storage]:
+                    c.execute(statement)
+            packed = c.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'readings_packed'").fetchone()[0]
+        self._use_storage('packed' if packed else 'standard')
+
+    def _use_storage(self, storage):
+        # Point the query constants at the given layout: PACKED_SQL entries shadow
+        # the class attributes on this instance, or are dropped again.
+        self.storage = storage
+        for name, sql in self.PACKED_SQL.items():
+            if storage == 'packed':
+                setattr(self, name, sql)
+            else:
+                self.__dict__.pop(name, None)
+
+    def convert_storage(self, storage):
+        # Rewrite the live readings and every archive file in the given layout,
+        # then VACUUM so the file shrinks (or grows) to match. Each file converts
+        # in one transaction. Returns the database size in bytes before and after.
+        if storage not in self.STORAGE_LAYOUTS:
+            raise ValueError("storage must be one of: " + ", ".join(self.STORAGE_LAYOUTS))
+        before = os.path.getsize(self.db_filename)
+        if storage == self.storage:
+            return before, before
+        self._wait_for_writes()
+        statements = self.STORAGE_CONVERSIONS[storage]
+        with self.db.writer() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for statement in statements:
+                conn.execute(statement)
+            conn.commit()
+            self._use_storage(storage)
+            # Packing rounds timestamps and Tx, so cached results no longer match.
+            self.clear_query_cache()
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        for month, path in self._find_archives():
+            archive = sqlite3.connect(path, isolation_level=None)
+            try:
+                archive.execute("BEGIN IMMEDIATE")
+                for statement in statements:
+                    archive.execute(statement)
+                archive.execute("COMMIT")
+                archive.execute("VACUUM")
+            finally:
+                archive.close()
+        return before, os.path.getsize(self.db_filename)
+
+    def check_query_plans(self):
+        # Runs EXPLAIN QUERY PLAN on the trend and export queries. A query counts as
+        # indexed when it searches or scans through an index (or the primary key)
+        # and needs no temp b-tree for its ORDER BY. Returns {name: (uses_index, [plan details])}.
+        queries = (('specific_date', self.SPECIFIC_DATE_SQL, ('2000-01-01',)),
+                   ('date_range', self.DATE_RANGE_SQL, ('2000-01-01', '2000-01-07')),
+                   ('daily_rollup', self.DAILY_ROLLUP_SQL, ('2000-01-01', '2000-01-07')),
+                   ('export', self.EXPORT_SQL, ()),
+                   ('export_range', self.EXPORT_RANGE_SQL, ('2000-01-01', '2000-01-07')),
+                   ('readings_since', self.READINGS_SINCE_SQL, (0, 100)),
+                   ('device_specific_date', self.DEVICE_SPECIFIC_DATE_SQL, (0, '2000-01-01')),
+                   ('device_daily_rollup', self.DEVICE_DAILY_ROLLUP_SQL, (0, '2000-01-01', '2000-01-07')),
+                   ('device_readings_since', self.DEVICE_READINGS_SINCE_SQL, (0, 0, 100)),
+                   ('device_latest', self.DEVICE_LATEST_READING_SQL, (0,)),
+                   ('hourly_rollup', self.HOURLY_ROLLUP_SQL, ('2000-01-01 00', '2000-01-02 00')))
+        results = {}
+        with self.db.reader() as conn:
+            for name, sql, params in queries:
+                details = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+                uses_index = (any('INDEX' in detail or 'PRIMARY KEY' in detail for detail in details)
+                              and not any('TEMP B-TREE' in detail for detail in details))
+                results[name] = (uses_index, details)
+        return results
+
+    def make_reading(self, device_id=None):
+        # Snapshot a device (the default one unless device_id is given) as a row in
+        # log_readings_batch order: (timestamp, date, A, B, DO1, DO2, Tx, device_id)
+        if device_id is None:
+            device_id = self.device_id
+        device = self.devices[device_id]
+        timestamp = time.time()
+        date = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+        return (timestamp, date, device.A, device.B, device.DO1, device.DO2, device.Tx, device_id)
+
+    def log_readings(self):
+        self.log_readings_batch([self.make_reading()])
+
+    def log_readings_batch(self, rows):
+        # Rows without a trailing device_id belong to the default device.
+        rows = [row if len(row) == 8 else tuple(row) + (self.device_id,) for row in rows]
+        if rows:
+            self._insert_batch(rows)
+            self._remember_latest(rows)
+            self._update_stats(rows)
+
+    def log_readings_columns(self, timestamps, dates, A, B, DO1, DO2, Tx, device_id=None,
+                             chunk_size=100000):
+        # Bulk insert of columnar readings such as TekXSimulator.generate_batch
+        # output; dates may be datetime64[D] or strings. Each chunk is one
+        # transaction, and its daily_rollup rows are summed with NumPy over runs
+        # of equal dates instead of row by row.
+        if device_id is None:
+            device_id = self.device_id
+        last_row = None
+        for start in range(0, len(timestamps), chunk_size):
+            end = min(start + chunk_size, len(timestamps))
+            ts = np.asarray(timestamps[start:end], dtype=np.float64)
+            days = np.asarray(dates[start:end])
+            if days.dtype.kind == 'M':
+                days = days.astype('datetime64[D]').astype(str)
+            do1 = np.asarray(DO1[start:end], dtype=np.int64)
+            do2 = np.asarray(DO2[start:end], dtype=np.int64)
+            tx = np.asarray(Tx[start:end], dtype=np.float64)
+
+            starts = np.concatenate(([0], np.flatnonzero(days[1:] != days[:-1]) + 1))
+            counts = np.diff(np.append(starts, len(ts)))
+            sums = [np.add.reduceat(column, starts).tolist() for column in (do1, do2, tx)]
+            Tx_min = np.minimum.reduceat(tx, starts).tolist()
+            Tx_max = np.maximum.reduceat(tx, starts).tolist()
+            rollup = {}
+            for i, run_start in enumerate(starts.tolist()):
+                run_end = run_start + int(counts[i])
+                first = run_start + int(ts[run_start:run_end].argmin())
+                run = [int(counts[i]), sums[0][i], sums[1][i], sums[2][i], Tx_min[i], Tx_max[i],
+                       float(ts[first]), int(do1[first]), int(do2[first])]
+                day = rollup.get((str(days[run_start]), device_id))
+                if day is None:
+                    rollup[str(days[run_start]), device_id] = run
+                    continue
+                for k in range(4):
+                    day[k] += run[k]
+                day[4] = min(day[4], run[4])
+                day[5] = max(day[5], run[5])
+                if run[6] < day[6]:
+                    day[6:9] = run[6:9]
+
+            rows = list(zip(ts.tolist(), days.tolist(), np.asarray(A[start:end]).tolist(),
+                            np.asarray(B[start:end]).tolist(), do1.tolist(), do2.tolist(), tx.tolist(),
+                            itertools.repeat(device_id)))
+            self._insert_batch(rows, rollup)
+            if self.stats_windows:
+                # Only readings young enough for a window; bulk loads are mostly history.
+                oldest = time.time() - max(seconds for name, seconds in self.stats_windows)
+                self._update_stats([row for row, recent in zip(rows, (ts >= oldest).tolist()) if recent])
+            last_row = rows[-1]
+        if last_row is not None:
+            self._remember_latest([last_row])
+
+    def _rollup_rows(self, rows):
+        rollup = {}
+        for timestamp, date, A, B, DO1, DO2, Tx, device_id in rows:
+            day = rollup.get((date, device_id))
+            if day is None:
+                rollup[date, device_id] = [1, DO1, DO2, Tx, Tx, Tx, timestamp, DO1, DO2]
+                continue
+            day[0] += 1
+            day[1] += DO1
+            day[2] += DO2
+            day[3] += Tx
+            day[4] = min(day[4], Tx)
+            day[5] = max(day[5], Tx)
+            if timestamp < day[6]:
+                day[6:9] = timestamp, DO1, DO2
+        return rollup
+
+    def _insert_batch(self, rows, rollup=None):
+        if self.ingest is not None:
+            # The daemon rebuilds the rollup rows from the readings itself.
+            self.ingest.submit(rows)
+            if self.query_cache is not None:
+                self.query_cache.invalidate_dates({row[1] for row in rows})
+            return
+        if rollup is None:
+            rollup = self._rollup_rows(rows)
+        with self.db.writer() as conn:
+            conn.executemany(self.INSERT_READING_SQL, rows)
+            conn.executemany(self.DAILY_ROLLUP_UPSERT_SQL,
+                             [key + tuple(day) for key, day in rollup.items()])
+        if self.query_cache is not None:
+            self.query_cache.invalidate_dates(date for date, device_id in rollup)
+
+    def rebuild_daily_rollup(self):
+        # Recompute daily_rollup from scratch, e.g. after readings were written by
+        # something other than log_readings_batch.
+        with self.db.writer() as conn:
+            for statement in self.DAILY_ROLLUP_BACKFILL_SQL:
+                conn.execute(statement)
+        self.clear_query_cache()
+
+    def clear_query_cache(self):
+        # For changes the cache can't see, such as readings written to past days
+        # by another process.
+        if self.query_cache is not None:
+            self.query_cache.clear()
+
+    def compact(self, retention_days=None, mode=None):
+        # Takes the raw readings of every date older than retention_days out of the
+        # live table, a month at a time: they are summarised into hourly_rollup
+        # (daily_rollup already has them per day and keeps them), then archived or
+        # deleted according to mode. Deleted days stay in the rollups, so the
+        # aggregate and hourly views keep them while the raw trends lose them.
+        # Freed pages go back to the filesystem through incremental vacuum.
+        # Returns the number of readings removed.
+        if retention_days is None:
+            retention_days = self.retention_days
+        if retention_days is None:
+            raise ValueError("retention_days is not set")
+        mode = mode or self.retention_mode
+        if mode not in self.RETENTION_MODES:
+            raise ValueError("retention mode must be one of: " + ", ".join(self.RETENTION_MODES))
+        cutoff = time.strftime('%Y-%m-%d', time.localtime(time.time() - retention_days * 86400))
+        self._wait_for_writes()
+        with self.db.reader() as conn:
+            months = [row[0] for row in conn.execute(self.COMPACT_MONTHS_SQL, (cutoff,))]
+        removed = 0
+        for month in months:
+            year, month_number = int(month[:4]), int(month[5:7])
+            next_month = "%04d-%02d-01" % (year + month_number // 12, month_number % 12 + 1)
+            removed += self._compact_range(month, month + '-01', min(next_month, cutoff), mode)
+        if removed:
+            # Deleted readings and the new hourly rows change past results.
+            self.clear_query_cache()
+        self.reclaim_space()
+        return removed
+
+    def _compact_range(self, month, start_date, end_date, mode):
+        # Dates in [start_date, end_date), all within `month`.
+        params = (start_date, end_date)
+        with self.db.writer() as conn:
+            # ATTACH/DETACH only work outside a transaction, so this one is explicit.
+            if mode == 'archive':
+                conn.execute("ATTACH DATABASE ? AS archive", (self._archive_filename(month),))
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany(self.HOURLY_ROLLUP_UPSERT_SQL, self._hourly_rollup_rows(conn, *params))
+                if mode == 'archive':
+                    for statement in self.ARCHIVE_SCHEMA:
+                        conn.execute(statement)
+                    conn.execute(self.ARCHIVE_INSERT_SQL, params)
+                removed = conn.execute(self.COMPACT_DELETE_SQL, params).rowcount
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                if mode == 'archive':
+                    conn.execute("DETACH DATABASE archive")
+        return removed
+
+    def _hourly_rollup_rows(self, conn, start_date, end_date):
+        # HOURLY_ROLLUP_UPSERT_SQL rows for the readings dated [start_date, end_date).
+        # Readings are binned with NumPy against the local hour boundaries, found by
+        # probing every quarter hour; strftime(..., 'localtime') per row in SQL is
+        # an order of magnitude slower. A repeated hour at the end of DST gets one
+        # row per pass, which the upsert merges.
+        rows = conn.execute(self.COMPACT_READINGS_SQL, (start_date, end_date)).fetchall()
+        if not rows:
+            return []
+        device_ids, timestamps, DO1_values, DO2_values, Tx_values = (np.array(column) for column in zip(*rows))
+        boundaries = []
+        labels = []
+        for probe in range(math.floor(timestamps.min() / 900) * 900 - 3600, math.ceil(timestamps.max()) + 1, 900):
+            local = time.localtime(probe)
+            if local.tm_min == 0:
+                boundaries.append(probe)
+                labels.append(time.strftime('%Y-%m-%d %H', local))
+        hour_index = np.searchsorted(boundaries, timestamps, side='right') - 1
+
+        order = np.lexsort((timestamps, hour_index, device_ids))
+        device_ids, hour_index = device_ids[order], hour_index[order]
+        starts = np.flatnonzero((np.diff(device_ids) != 0) | (np.diff(hour_index) != 0)) + 1
+        starts = np.concatenate(([0], starts))
+        Tx_sorted = Tx_values[order]
+        first = order[starts]
+        return list(zip([labels[i] for i in hour_index[starts].tolist()],
+                        device_ids[starts].tolist(),
+                        np.diff(np.append(starts, len(order))).tolist(),
+                        np.add.reduceat(DO1_values[order], starts).tolist(),
+                        np.add.reduceat(DO2_values[order], starts).tolist(),
+                        np.add.reduceat(Tx_sorted, starts).tolist(),
+                        np.minimum.reduceat(Tx_sorted, starts).tolist(),
+                        np.maximum.reduceat(Tx_sorted, starts).tolist(),
+                        timestamps[first].tolist(),
+                        DO1_values[first].tolist(),
+                        DO2_values[first].tolist()))
+
+    def reclaim_space(self):
+        # Incremental auto-vacuum returns the free pages left behind by compact().
+        # Databases created before it was enabled need one full VACUUM to switch.
+        # The file only shrinks once the WAL is checkpointed back into it.
+        with self.db.writer() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+            else:
+                # executescript steps the pragma to completion; execute frees one page.
+                conn.executescript("PRAGMA incremental_vacuum;")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+    def _retention_worker(self):
+        while not self._retention_stop.is_set():
+            try:
+                self.compact()
+            except Exception as e:
+                self._worker_failed('retention', "Compacting old readings failed:", e)
+            self._retention_stop.wait(self.retention_interval)
+
+    @cached_query('start_hour', 'end_hour', fmt='%Y-%m-%d %H')
+    def get_hourly_aggregates(self, start_hour, end_hour, device_id=None):
+        # Like get_date_range_aggregates per local hour ('YYYY-MM-DD HH', end
+        # exclusive), for the period compact() has summarised.
+        with self.db.reader() as conn:
+            if device_id is None:
+                data = conn.execute(self.HOURLY_ROLLUP_SQL, (start_hour, end_hour)).fetchall()
+            else:
+                data = conn.execute(self.DEVICE_HOURLY_ROLLUP_SQL, (device_id, start_hour, end_hour)).fetchall()
+
+        hours = [row[0] for row in data]
+        do1_modes = [row[1] for row in data]
+        do2_modes = [row[2] for row in data]
+        tx_averages = [row[3] for row in data]
+        return hours, do1_modes, do2_modes, tx_averages
+
+
+    def log_readings_to_excel(self, start_date=None, end_date=None, excel_filename=None, sheets_per_file=None):
+        # Returns the workbook file names written.
+        return self.export_readings('xlsx', excel_filename, start_date, end_date,
+                                    sheets_per_file=sheets_per_file)[0]
+
+    def _export_chunks(self, start_date=None, end_date=None, chunk_size=10000):
+        # fetchmany chunks of every reading in timestamp order, or only start_date..end_date.
+        start_date, end_date = _day_string(start_date), _day_string(end_date)
+        if start_date is None and end_date is None:
+            sql, params = self.EXPORT_SQL, ()
+        else:
+            sql, params = self.EXPORT_RANGE_SQL, (start_date or '0000-01-01', end_date or '9999-12-31')
+        for conn in self._partitions(start_date, end_date):
+            c = conn.execute(sql, params)
+            while True:
+                chunk = c.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def iter_readings(self, start_date=None, end_date=None, chunk_size=10000):
+        # Lists of up to chunk_size (timestamp, date, A, B, DO1, DO2, Tx) rows in
+        # timestamp order, across archives and the live table. A pooled read
+        # connection stays checked out until the generator is exhausted or closed.
+        return self._export_chunks(start_date, end_date, chunk_size)
+
+    def export_readings(self, fmt='xlsx', filename=None, start_date=None, end_date=None, **options):
+        # Streams the readings (optionally only start_date..end_date) through
+        # EXPORTERS[fmt] in bounded memory. filename defaults to excel_filename with
+        # the format's extension. Returns (file names, readings written, seconds).
+        # Only a full xlsx export to excel_filename settles the pending-row count;
+        # anything else is a one-off.
+        if fmt not in EXPORTERS:
+            raise ValueError("export format must be one of: " + ", ".join(EXPORTERS))
+        if filename is None:
+            filename = os.path.splitext(self.excel_filename)[0] + EXPORT_EXTENSIONS[fmt]
+        if fmt == 'xlsx':
+            options.setdefault('max_rows', self.EXCEL_MAX_ROWS)
+        full_export = (fmt == 'xlsx' and start_date is None and end_date is None
+                       and filename == self.excel_filename)
+        self._wait_for_writes()
+        with self._export_lock:
+            with self._dirty_lock:
+                exported_rows = self.dirty_rows
+            written = [0]
+
+            def counted(chunks):
+                for chunk in chunks:
+                    written[0] += len(chunk)
+                    yield chunk
+
+            start = time.perf_counter()
+            filenames = EXPORTERS[fmt](counted(self._export_chunks(start_date, end_date)), filename, **options)
+            elapsed = time.perf_counter() - start
+            if full_export:
+                with self._dirty_lock:
+                    self.dirty_rows -= exported_rows
+        return filenames, written[0], elapsed
@@ -0,0 +1,402 @@
+import argparse
+import itertools
+import multiprocessing
+import os
+import queue
+import secrets
+import sys
+import threading
+import time
+from multiprocessing.connection import Listener, Client
+from tekx_core import TekXSimulator, DeviceManager
+
+# Single-writer ingest daemon. When several processes (the CLI, the Tk app, ...)
+# log readings into the same database, each one's writer queues on SQLite's
+# write lock and past busy_timeout gets "database is locked". Here the daemon
+# owns the only write connection: producers hand it batches of readings, and
+# it group-commits whatever all of them sent in one transaction. Readers still
+# open the database directly (WAL lets them read while the daemon writes).
+#
+#   python tekx_ingest.py --db tekx_readings8.db
+#   python assignment_python.py --ingest tekx_readings8.db.sock
+#   python tekx_ingest.py --measure
+#
+# The transport is multiprocessing.connection: a Unix socket on POSIX, a named
+# pipe on Windows. Its messages are pickles, so every connection has to pass
+# the HMAC challenge with the daemon's authkey: a fresh random key the daemon
+# writes on start to <db>.ingest-key, readable by its owner only (the socket
+# is made owner-only too). Producers read the key from there.
+#
+# The daemon is not a speed-up in itself: every request costs a round trip to
+# it. Measured with --measure on one CPU and a RAM disk, direct writes reached
+# ~58k readings/s with 1-8 producers and never saw "database is locked", while
+# the daemon reached 39-44k. It pays off when direct writers do block each
+# other: when some process holds long write transactions (bulk imports,
+# compact, convert_storage) that outlast busy_timeout, and on real disks
+# with --synchronous FULL, where one fsync covers every producer's batch
+# instead of one fsync per producer commit.
+#
+# Each request picks its acknowledgement:
+#   'none'       fire and forget, errors are only printed by the daemon
+#   'queued'     answered once the daemon holds the rows
+#   'committed'  answered once the rows are committed (the default)
+# Whatever the mode, IngestClient.flush() (and so DeviceManager.flush()) waits
+# until everything sent before it is committed. A commit survives the daemon or producer crashing; with --synchronous FULL it
+# also survives power loss, at the cost of an fsync per batch.
+
+ACK_MODES = ('none', 'queued', 'committed')
+
+
+def default_address(db_filename):
+    if sys.platform == 'win32':
+        return r'\\.\pipe\tekx-ingest-' + os.path.basename(os.path.abspath(db_filename))
+    return db_filename + '.sock'
+
+
+def default_authkey_file(db_filename):
+    return db_filename + '.ingest-key'
+
+
+def new_authkey():
+    return secrets.token_hex(32).encode()
+
+
+def write_authkey(filename, authkey):
+    # Into a file only its owner can read, replacing any old one.
+    if os.path.exists(filename):
+        os.remove(filename)
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+
+
+def read_authkey(filename):
+    with open(filename, 'rb') as f:
+        return f.read().strip()
+
+
+class IngestClient:
+    # Producer side, safe to share between threads; a DeviceManager created with
+    # ingest=IngestClient(...) sends its writes here instead of committing them.
+    # authkey is the daemon's, e.g. read_authkey(default_authkey_file(db)).
+    def __init__(self, address, authkey, ack='committed'):
+        if not authkey:
+            raise ValueError("an authkey is required")
+        if ack not in ACK_MODES:
+            raise ValueError("ack must be one of: " + ", ".join(ACK_MODES))
+        self.ack = ack
+        self._conn = Client(address, authkey=authkey)
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count(1)
+
+    def _request(self, kind, payload, ack):
+        with self._lock:
+            request_id = next(self._request_ids)
+            self._conn.send((kind, request_id, payload, ack))
+            if ack == 'none':
+                return None
+            status, reply_id, value = self._conn.recv()
+        if status == 'error':
+            raise RuntimeError("ingest daemon: " + value)
+        return value
+
+    def submit(self, rows, ack=None):
+        # rows in DeviceManager.log_readings_batch order; returns how many were
+        # taken (None with ack='none').
+        ack = ack or self.ack
+        if ack not in ACK_MODES:
+            raise ValueError("ack must be one of: " + ", ".join(ACK_MODES))
+        return self._request('log', [tuple(row) for row in rows], ack)
+
+    def flush(self):
+        # Wait until everything this client sent, whatever its ack, is committed.
+        self._request('flush', None, 'committed')
+
+    def stats(self):
+        return self._request('stats', None, 'queued')
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _Producer:
+    def __init__(self, conn):
+        self.conn = conn
+        self.send_lock = threading.Lock()
+
+    def reply(self, *message):
+        # A producer that went away just doesn't hear back.
+        try:
+            with self.send_lock:
+                self.conn.send(message)
+        except (OSError, EOFError):
+            pass
+
+
+class IngestDaemon:
+    # Requests from every producer go through one bounded queue to the writer
+    # thread, which commits everything queued (up to batch_size rows) with one
+    # log_readings_batch as soon as the previous commit is done: the readings
+    # that arrive during a commit share the next one. max_latency makes it wait
+    # that much longer for a batch to fill, which saves commits when producers
+    # don't wait for theirs. A full queue stops the producers' reader threads, so
+    # their sends block instead of the daemon buffering without bound.
+    def __init__(self, manager, address, authkey, batch_size=5000, max_latency=0.0,
+                 queue_size=1000):
+        if not authkey:
+            raise ValueError("an authkey is required")
+        self.manager = manager
+        self.address = address
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._closing = threading.Event()
+        self._producers = set()
+        self._producers_lock = threading.Lock()
+        self.requests = 0
+        self.rows = 0
+        self.batches = 0
+        self.errors = 0
+        if sys.platform != 'win32' and os.path.exists(address):
+            self._remove_stale_socket(address)
+        self._listener = Listener(address, authkey=authkey)
+        if sys.platform != 'win32':
+            os.chmod(address, 0o600)
+        self._authkey = authkey
+        self._writer_thread = threading.Thread(target=self._writer_worker, daemon=True)
+        self._writer_thread.start()
+
+    @staticmethod
+    def _remove_stale_socket(address):
+        # A socket file left by a daemon that died; refuse to take over a live one.
+        # Connecting is enough to tell, so no key is needed.
+        try:
+            Client(address).close()
+        except OSError:
+            os.remove(address)
+            return
+        raise RuntimeError("an ingest daemon is already listening on " + address)
+
+    def serve_forever(self):
+        while not self._closing.is_set():
+            try:
+                conn = self._listener.accept()
+            except (multiprocessing.AuthenticationError, EOFError):
+                continue  # a client without the key, or one that hung up mid-handshake
+            except OSError:
+                if self._closing.is_set():
+                    break
+                continue
+            if self._closing.is_set():
+                conn.close()
+                break
+            producer = _Producer(conn)
+            with self._producers_lock:
+                self._producers.add(producer)
+            threading.Thread(target=self._producer_worker, args=(producer,), daemon=True).start()
+
+    def _producer_worker(self, producer):
+        try:
+            while True:
+                try:
+                    kind, request_id, payload, ack = producer.conn.recv()
+                except (EOFError, OSError):
+                    break
+                if kind == 'stats':
+                    producer.reply('ok', request_id, self.stats())
+                    continue
+                self._queue.put((producer, kind, request_id, payload, ack))
+                if ack == 'queued':
+                    producer.reply('ok', request_id, len(payload) if payload else 0)
+        finally:
+            with self._producers_lock:
+                self._producers.discard(producer)
+            producer.conn.close()
+
+    def _writer_worker(self):
+        stopping = False
+        while not stopping:
+            requests = []
+            rows = 0
+            item = self._queue.get()
+            deadline = time.monotonic() + self.max_latency
+            while item is not None:
+                requests.append(item)
+                rows += len(item[3] or ())
+                if rows >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            stopping = item is None
+            logs = [request for request in requests if request[1] == 'log' and request[3]]
+            error = self._commit([row for request in logs for row in request[3]])
+            errors = {}
+            if error is not None:
+                # The batch was rolled back whole; commit each request on its own
+                # so only the bad ones fail.
+                errors = {id(request): error if len(logs) == 1 else self._commit(request[3])
+                          for request in logs}
+            for request in requests:
+                producer, kind, request_id, payload, ack = request
+                self.requests += 1
+                if ack != 'committed':
+                    continue
+                if errors.get(id(request)) is not None:
+                    producer.reply('error', request_id, errors[id(request)])
+                else:
+                    producer.reply('ok', request_id, len(payload) if payload else 0)
+
+    def _commit(self, rows):
+        # One transaction; returns None, or the error it was rolled back with.
+        if not rows:
+            return None
+        try:
+            self.manager.log_readings_batch(rows)
+        except Exception as e:
+            self.errors += 1
+            error = "%s: %s" % (type(e).__name__, e)
+            print("Committing %d readings failed:" % len(rows), error)
+            return error
+        self.batches += 1
+        self.rows += len(rows)
+        return None
+
+    def stats(self):
+        with self._producers_lock:
+            producers = len(self._producers)
+        return {'producers': producers, 'requests': self.requests, 'rows': self.rows,
+                'batches': self.batches, 'errors': self.errors, 'queued': self._queue.qsize()}
+
+    def close(self):
+        # Stop accepting, commit everything already queued, then stop the writer.
+        if self._closing.is_set():
+            return
+        self._closing.set()
+        try:
+            # Wakes serve_forever, which is blocked in accept().
+            Client(self.address, authkey=self._authkey).close()
+        except OSError:
+            pass
+        self._listener.close()
+        self._queue.put(None)
+        self._writer_thread.join()
+        with self._producers_lock:
+            producers = list(self._producers)
+        for producer in producers:
+            producer.conn.close()
+
+
+def _produce(db_filename, address, authkey, seconds, batch, synchronous, results):
+    # One producer process for measure_scaling: log batches of `batch` readings
+    # for `seconds`, directly when address is None, otherwise through the daemon.
+    simulator = TekXSimulator()
+    client = IngestClient(address, authkey) if address else None
+    manager = DeviceManager(simulator, db_filename, None, export_mode='manual', cache_rows=0,
+                            synchronous=synchronous, ingest=client)
+    logged = failed = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        rows = []
+        for _ in range(batch):
+            simulator.update_status()
+            rows.append(manager.make_reading())
+        try:
+            manager.log_readings_batch(rows)
+            logged += len(rows)
+        except Exception:  # sqlite3.OperationalError: database is locked
+            failed += len(rows)
+    manager.close()
+    if client is not None:
+        client.close()
+    results.put((logged, failed))
+
+
+def measure_scaling(producer_counts=(1, 2, 4, 8), seconds=3.0, batch=10, synchronous='NORMAL'):
+    # Aggregate readings/s with producer processes writing directly and through
+    # the daemon, each against a fresh database.
+    import tempfile
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for mode in ('direct', 'daemon'):
+            for count in producer_counts:
+                db_filename = os.path.join(tmpdir, "scaling_%s_%d.db" % (mode, count))
+                manager = DeviceManager(TekXSimulator(), db_filename, None, export_mode='manual', cache_rows=0,
+                                        synchronous=synchronous)
+                daemon = None
+                address = None
+                authkey = new_authkey()
+                if mode == 'daemon':
+                    address = default_address(db_filename)
+                    daemon = IngestDaemon(manager, address, authkey)
+                    threading.Thread(target=daemon.serve_forever, daemon=True).start()
+                results = context.Queue()
+                processes = [context.Process(target=_produce,
+                                             args=(db_filename, address, authkey, seconds, batch, synchronous,
+                                                   results))
+                             for _ in range(count)]
+                for process in processes:
+                    process.start()
+                totals = [results.get() for _ in processes]
+                for process in processes:
+                    process.join()
+                if daemon is not None:
+                    daemon.close()
+                manager.close()
+                logged = sum(logged for logged, failed in totals)
+                failed = sum(failed for logged, failed in totals)
+                print("%-6s %2d producers: %9.0f readings/s, %d readings failed"
+                      % (mode, count, logged / seconds, failed))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Own the write connection to a TekX readings database.")
+    parser.add_argument('--db', default="tekx_readings8.db")
+    parser.add_argument('--address', help="socket path or pipe name (default: <db>.sock, "
+                                          r"or \\.\pipe\tekx-ingest-<db> on Windows)")
+    parser.add_argument('--authkey-file', help="where to write the key producers authenticate with "
+                                               "(default: <db>.ingest-key)")
+    parser.add_argument('--batch-size', type=int, default=5000, help="readings per commit at most")
+    parser.add_argument('--max-latency', type=float, default=0.0,
+                        help="extra seconds to wait for a batch to fill (default: 0)")
+    parser.add_argument('--synchronous', choices=('NORMAL', 'FULL'), default='NORMAL',
+                        help="FULL fsyncs every commit, so committed readings survive power loss")
+    parser.add_argument('--measure', action='store_true',
+                        help="compare direct and daemon ingest with 1-8 producer processes, then exit")
+    args = parser.parse_args(argv)
+
+    if args.measure:
+        measure_scaling(synchronous=args.synchronous)
+        return 0
+    address = args.address or default_address(args.db)
+    authkey_file = args.authkey_file or default_authkey_file(args.db)
+    manager = DeviceManager(TekXSimulator(), args.db, None, export_mode='manual', cache_rows=0,
+                            synchronous=args.synchronous)
+    # The key file is only (re)written once the address is ours, so starting a
+    # second daemon can't lock the first one's producers out.
+    authkey = new_authkey()
+    daemon = IngestDaemon(manager, address, authkey, batch_size=args.batch_size, max_latency=args.max_latency)
+    write_authkey(authkey_file, authkey)
+    print("Ingesting into %s on %s (key in %s)" % (args.db, address, authkey_file))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+        manager.close()
+        os.remove(authkey_file)
+        print("Committed %d readings in %d batches." % (daemon.rows, daemon.batches))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,457 @@
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import sys
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+import numpy as np
+from tekx_core import TekXSimulator, DeviceManager, Metrics, EXPORTERS, EXPORT_EXTENSIONS
+
+# Headless HTTP/JSON service over DeviceManager for dashboards and scripts that
+# need concurrent read access to the readings database. It runs on asyncio; all
+# database work goes through a small thread pool, so hundreds of open client
+# connections share a handful of SQLite read connections.
+#
+#   python tekx_service.py --db tekx_readings8.db --port 8080
+#
+#   GET  /status[?device_id=N]                         newest reading
+#   GET  /trend?date=YYYY-MM-DD[&device_id=N]          one day of readings, by column
+#   GET  /aggregates?start=...&end=...[&device_id=N]   daily DO1/DO2 modes and Tx averages
+#   GET  /readings[?start=...][&end=...]               raw readings, streamed
+#   POST /exports  {"format": "csv", "start_date": ..., "end_date": ...}
+#   GET  /exports, /exports/<id>                       export jobs
+#   GET  /metrics[?format=json]                        with --metrics: timings, Prometheus text
+#
+# GET responses carry the newest serial_number as their ETag, and a matching
+# If-None-Match is answered with 304 before the query runs. /trend and /readings
+# are sent with chunked transfer encoding.
+
+MAX_HEADER_BYTES = 16384
+MAX_BODY_BYTES = 65536
+STREAM_CHUNK_ROWS = 10000
+MAX_EXPORT_JOBS = 1000
+JSON_TYPE = 'application/json'
+READING_FIELDS = ('timestamp', 'date', 'A', 'B', 'DO1', 'DO2', 'Tx')
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Request:
+    def __init__(self, method, target, version, headers, body):
+        url = urllib.parse.urlsplit(target)
+        self.method = method
+        self.path = url.path
+        self.query = dict(urllib.parse.parse_qsl(url.query))
+        self.version = version
+        self.headers = headers
+        self.body = body
+        # HTTP/1.0 clients get one request per connection.
+        self.keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+
+def _json_bytes(payload):
+    return json.dumps(payload).encode()
+
+
+def _date_param(params, name, required=True):
+    value = params.get(name)
+    if value is None:
+        if required:
+            raise HTTPError(400, "missing parameter %r" % name)
+        return None
+    # Exactly YYYY-MM-DD: it is compared as text with the date columns, so
+    # '2024-3-5' (which strptime takes) or '20240305' would match the wrong rows.
+    try:
+        valid = datetime.date.fromisoformat(value).isoformat() == value
+    except (TypeError, ValueError):
+        valid = False
+    if not valid:
+        raise HTTPError(400, "%s must be a date in YYYY-MM-DD format" % name)
+    return value
+
+
+def _device_param(params):
+    value = params.get('device_id')
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise HTTPError(400, "device_id must be an integer")
+
+
+def _encode_next_chunk(chunks):
+    # The next chunk of readings as JSON rows without the enclosing brackets, or None.
+    chunk = next(chunks, None)
+    if chunk is None:
+        return None
+    return json.dumps(chunk)[1:-1].encode()
+
+
+class TekXService:
+    def __init__(self, manager, workers=4, stream_limit=2, max_queue=1000, export_dir='exports',
+                 keepalive_timeout=15.0):
+        # Queries run on `workers` threads. At most that many are handed to the pool
+        # at a time and up to max_queue more wait on the event loop; past that
+        # requests get 503. A streaming response keeps a read connection checked
+        # out between chunks, so only stream_limit of them run at once. Exports run
+        # one at a time on their own thread and never hold up queries.
+        self.manager = manager
+        self.max_queue = max_queue
+        self.export_dir = export_dir
+        self.keepalive_timeout = keepalive_timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tekx-http')
+        self._export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tekx-export')
+        self._slots = asyncio.Semaphore(workers)
+        self._streams = asyncio.Semaphore(stream_limit)
+        self._waiting = 0
+        self._jobs = {}
+        self._job_ids = itertools.count(1)
+        self._server = None
+        self.routes = {
+            ('GET', '/status'): self.handle_status,
+            ('GET', '/trend'): self.handle_trend,
+            ('GET', '/aggregates'): self.handle_aggregates,
+            ('GET', '/readings'): self.handle_readings,
+            ('GET', '/exports'): self.handle_list_exports,
+            ('POST', '/exports'): self.handle_create_export,
+        }
+        # An instrumented manager also gets its requests timed (kind 'http') and /metrics.
+        self.metrics = manager.metrics
+        if self.metrics is not None:
+            self.routes['GET', '/metrics'] = self.handle_metrics
+
+    async def _run(self, func, *args):
+        if self._waiting >= self.max_queue:
+            raise HTTPError(503, "too many requests in progress")
+        self._waiting += 1
+        try:
+            async with self._slots:
+                return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self._waiting -= 1
+
+    def _versioned(self, request, build):
+        # On the pool: (etag, None) when the client's copy is current, otherwise
+        # (etag, build()). The ETag is read first, so a reading committed in
+        # between only makes the body newer than its tag, never older.
+        etag = '"%d"' % self.manager.max_serial()
+        if_none_match = request.headers.get('if-none-match', '')
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        if etag in tags or 'W/' + etag in tags or '*' in tags:
+            return etag, None
+        return etag, build()
+
+    async def _json_versioned(self, request, build):
+        etag, body = await self._run(self._versioned, request, lambda: _json_bytes(build()))
+        if body is None:
+            return 304, {'ETag': etag}, b''
+        return 200, {'ETag': etag, 'Content-Type': JSON_TYPE}, body
+
+    async def handle_status(self, request):
+        device_id = _device_param(request.query)
+
+        def build():
+            version, latest = self.manager.get_latest_reading(device_id)
+            if latest is None:
+                return {'device_id': device_id, 'reading': None}
+            return {'device_id': latest[7], 'reading': dict(zip(READING_FIELDS, latest[:7]))}
+        return await self._json_versioned(request, build)
+
+    async def handle_trend(self, request):
+        date = _date_param(request.query, 'date')
+        device_id = _device_param(request.query)
+
+        def build():
+            # One piece per column; a day is bounded, so it is read in one go and
+            # only the sending is chunked.
+            timestamps, DO1_values, DO2_values, Tx_values = self.manager.get_specific_date_trend_arrays(
+                date, device_id=device_id)
+            pieces = [_json_bytes({'date': date, 'device_id': device_id, 'count': len(timestamps)})[:-1]]
+            for name, values in (('timestamp', timestamps.tolist()), ('DO1', DO1_values.tolist()),
+                                 ('DO2', DO2_values.tolist()),
+                                 ('Tx', Tx_values.astype(np.float64).round(4).tolist())):
+                pieces.append(b', "%s": %s' % (name.encode(), _json_bytes(values)))
+            pieces.append(b'}')
+            return pieces
+
+        etag, pieces = await self._run(self._versioned, request, build)
+        if pieces is None:
+            return 304, {'ETag': etag}, b''
+        return 200, {'ETag': etag, 'Content-Type': JSON_TYPE}, self._stream_pieces(pieces)
+
+    async def _stream_pieces(self, pieces):
+        for piece in pieces:
+            yield piece
+
+    async def handle_aggregates(self, request):
+        start_date = _date_param(request.query, 'start')
+        end_date = _date_param(request.query, 'end')
+        device_id = _device_param(request.query)
+
+        def build():
+            dates, DO1_modes, DO2_modes, Tx_averages = self.manager.get_date_range_aggregates(
+                start_date, end_date, device_id)
+            return {'start': start_date, 'end': end_date, 'device_id': device_id, 'dates': dates,
+                    'DO1': DO1_modes, 'DO2': DO2_modes, 'Tx': Tx_averages}
+        return await self._json_versioned(request, build)
+
+    async def handle_readings(self, request):
+        start_date = _date_param(request.query, 'start', required=False)
+        end_date = _date_param(request.query, 'end', required=False)
+        await self._streams.acquire()
+        try:
+            etag, chunks = await self._run(self._versioned, request,
+                                           lambda: self.manager.iter_readings(start_date, end_date,
+                                                                              STREAM_CHUNK_ROWS))
+        except BaseException:
+            self._streams.release()
+            raise
+        if chunks is None:
+            self._streams.release()
+            return 304, {'ETag': etag}, b''
+        return 200, {'ETag': etag, 'Content-Type': JSON_TYPE}, self._stream_readings(chunks)
+
+    async def _stream_readings(self, chunks):
+        # Each chunk is fetched and encoded on the pool, then written and drained
+        # before the next one, so memory stays at one chunk per client whatever the range.
+        try:
+            yield b'{"columns": %s, "rows": [' % _json_bytes(READING_FIELDS)
+            separator = b''
+            while True:
+                piece = await self._run(_encode_next_chunk, chunks)
+                if piece is None:
+                    break
+                yield separator + piece
+                separator = b', '
+            yield b']}'
+        finally:
+            # Hands the read connection back to the pool.
+            chunks.close()
+            self._streams.release()
+
+    async def handle_create_export(self, request):
+        try:
+            spec = json.loads(request.body or b'{}')
+        except ValueError:
+            raise HTTPError(400, "request body must be JSON")
+        if not isinstance(spec, dict):
+            raise HTTPError(400, "request body must be a JSON object")
+        fmt = spec.get('format', 'csv')
+        if fmt not in EXPORTERS:
+            raise HTTPError(400, "format must be one of: " + ", ".join(EXPORTERS))
+        job_id = next(self._job_ids)
+        job = {'id': job_id, 'format': fmt,
+               'start_date': _date_param(spec, 'start_date', required=False),
+               'end_date': _date_param(spec, 'end_date', required=False),
+               'status': 'queued', 'files': [], 'rows': None, 'seconds': None, 'error': None}
+        # Forget the oldest finished jobs; their files stay in export_dir.
+        for old_id in list(self._jobs)[:max(0, len(self._jobs) + 1 - MAX_EXPORT_JOBS)]:
+            if self._jobs[old_id]['status'] in ('done', 'failed'):
+                del self._jobs[old_id]
+        self._jobs[job_id] = job
+        filename = os.path.join(self.export_dir, "export_%d%s" % (job_id, EXPORT_EXTENSIONS[fmt]))
+        # Encoded before the export thread can start changing the job.
+        body = _json_bytes(job)
+        asyncio.get_running_loop().run_in_executor(self._export_executor, self._run_export, job, filename)
+        return 202, {'Location': '/exports/%d' % job_id, 'Content-Type': JSON_TYPE}, body
+
+    def _run_export(self, job, filename):
+        job['status'] = 'running'
+        try:
+            os.makedirs(self.export_dir, exist_ok=True)
+            filenames, rows, elapsed = self.manager.export_readings(job['format'], filename,
+                                                                    job['start_date'], job['end_date'])
+        except Exception as e:
+            job.update(status='failed', error=str(e))
+        else:
+            job.update(status='done', files=filenames, rows=rows, seconds=elapsed)
+
+    async def handle_list_exports(self, request):
+        return 200, {'Content-Type': JSON_TYPE}, _json_bytes(list(self._jobs.values()))
+
+    async def handle_get_export(self, request):
+        job_id = request.path[len('/exports/'):]
+        job = self._jobs.get(int(job_id)) if job_id.isdigit() else None
+        if job is None:
+            raise HTTPError(404, "no export job %r" % job_id)
+        return 200, {'Content-Type': JSON_TYPE}, _json_bytes(job)
+
+    async def handle_metrics(self, request):
+        if request.query.get('format') == 'json':
+            return 200, {'Content-Type': JSON_TYPE}, _json_bytes(self.metrics.snapshot())
+        return (200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+                self.metrics.prometheus_text().encode())
+
+    async def _dispatch(self, request):
+        handler = self.routes.get((request.method, request.path))
+        name = '%s %s' % (request.method, request.path)
+        if handler is None and request.method == 'GET' and request.path.startswith('/exports/'):
+            handler = self.handle_get_export
+            name = 'GET /exports/<id>'
+        if handler is None:
+            if any(path == request.path for method, path in self.routes):
+                raise HTTPError(405, "method %s not allowed on %s" % (request.method, request.path))
+            raise HTTPError(404, "no endpoint %s" % request.path)
+        if self.metrics is None:
+            return await handler(request)
+        # Streamed responses are timed until their headers are ready.
+        start = time.perf_counter()
+        try:
+            response = await handler(request)
+        except BaseException:
+            self.metrics.observe('http', name, time.perf_counter() - start, error=True)
+            raise
+        self.metrics.observe('http', name, time.perf_counter() - start)
+        return response
+
+    async def _read_request(self, reader):
+        # The next request on the connection, or None once the client has closed it.
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            raise HTTPError(431, "request headers too large")
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            raise HTTPError(400, "malformed request line")
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+        if 'transfer-encoding' in headers:
+            raise HTTPError(501, "chunked request bodies are not supported")
+        length = headers.get('content-length', '0')
+        if not length.isdigit():
+            raise HTTPError(400, "bad Content-Length")
+        if int(length) > MAX_BODY_BYTES:
+            raise HTTPError(413, "request body too large")
+        body = await reader.readexactly(int(length)) if int(length) else b''
+        return Request(method, target, version, headers, body)
+
+    async def _respond(self, writer, request, status, headers, body):
+        # Writes one response; returns whether the connection stays open.
+        keep_alive = request.keep_alive
+        lines = ['HTTP/1.1 %d %s' % (status, HTTPStatus(status).phrase)]
+        lines.extend('%s: %s' % item for item in headers.items())
+        streaming = not isinstance(body, bytes)
+        chunked = streaming and request.version == 'HTTP/1.1'
+        if not streaming:
+            lines.append('Content-Length: %d' % len(body))
+        elif chunked:
+            lines.append('Transfer-Encoding: chunked')
+        else:
+            keep_alive = False  # an HTTP/1.0 body ends when the connection does
+        lines.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if not streaming:
+            writer.write(body)
+            await writer.drain()
+            return keep_alive
+        try:
+            async for piece in body:
+                if not piece:
+                    continue
+                if chunked:
+                    writer.write(b'%x\r\n' % len(piece))
+                    writer.write(piece)
+                    writer.write(b'\r\n')
+                else:
+                    writer.write(piece)
+                await writer.drain()
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        finally:
+            await body.aclose()
+        return keep_alive
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), self.keepalive_timeout)
+                except HTTPError as e:
+                    request = Request('GET', '/', 'HTTP/1.1', {'connection': 'close'}, b'')
+                    await self._respond(writer, request, e.status, {'Content-Type': JSON_TYPE},
+                                        _json_bytes({'error': e.message}))
+                    break
+                if request is None:
+                    break
+                try:
+                    status, headers, body = await self._dispatch(request)
+                except HTTPError as e:
+                    status, headers, body = e.status, {'Content-Type': JSON_TYPE}, _json_bytes({'error': e.message})
+                except Exception as e:
+                    status, headers, body = 500, {'Content-Type': JSON_TYPE}, _json_bytes({'error': str(e)})
+                if not await self._respond(writer, request, status, headers, body):
+                    break
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8080):
+        self._server = await asyncio.start_server(self._handle_connection, host, port,
+                                                  limit=MAX_HEADER_BYTES, backlog=1024)
+        return self._server
+
+    async def serve_forever(self, host='127.0.0.1', port=8080):
+        server = await self.start(host, port)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        self._executor.shutdown(wait=True)
+        self._export_executor.shutdown(wait=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve TekX readings as JSON over HTTP.")
+    parser.add_argument('--db', default="tekx_readings8.db")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=4, help="threads running database queries")
+    parser.add_argument('--streams', type=int, default=2, help="streamed responses served at once")
+    parser.add_argument('--export-dir', default='exports', help="where export jobs write their files")
+    parser.add_argument('--metrics', action='store_true', help="time requests and queries, served on /metrics")
+    parser.add_argument('--slow-query-ms', type=float, default=100.0,
+                        help="with --metrics, log statements slower than this (default: 100)")
+    parser.add_argument('--slow-query-log', help="with --metrics, also append slow statements to this file")
+    args = parser.parse_args(argv)
+
+    metrics = Metrics(args.slow_query_ms / 1000, args.slow_query_log) if args.metrics else None
+    # Every query thread and every stream can hold a read connection at once.
+    manager = DeviceManager(TekXSimulator(), args.db, None, export_mode='manual',
+                            read_pool_size=args.workers + args.streams, metrics=metrics)
+    service = TekXService(manager, workers=args.workers, stream_limit=args.streams,
+                          export_dir=args.export_dir)
+    print("Serving %s on http://%s:%d/" % (args.db, args.host, args.port))
+    try:
+        asyncio.run(service.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+        manager.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,340 @@
+import contextlib
+import datetime
+import io
+import math
+import os
+import random
+import statistics
+import tempfile
+import time
+import unittest
+from tekx_core import TekXSimulator, DeviceManager, QueryCache, StreamingStats
+
+
+def _timestamp(day, seconds):
+    return datetime.datetime(2024, 3, day).timestamp() + seconds
+
+
+class DateRangeAggregatesTest(unittest.TestCase):
+    # get_date_range_aggregates reads daily_rollup; it has to agree with the
+    # original calculate_mode_for_dates(get_date_range_trend(...)) path.
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def make_manager(self, storage):
+        manager = DeviceManager(TekXSimulator(seed=1), os.path.join(self.tmpdir.name, storage + '.db'), None,
+                                export_mode='manual', storage=storage)
+        self.addCleanup(manager.close)
+        # (day, seconds into the day, DO1, DO2, Tx, device_id), logged in time order
+        # as several devices polled together would be.
+        readings = [
+            # 4th: two devices, DO1 and DO2 tied 2-2, broken by the first reading
+            (4, 10, 1, 0, 21.5, 1), (4, 20, 0, 1, 22.25, 0),
+            (4, 30, 0, 1, 23.0, 1), (4, 40, 1, 0, 24.75, 0),
+            # 5th: clear majorities across three devices
+            (5, 5, 0, 1, 25.0, 0), (5, 6, 0, 1, 26.5, 1), (5, 7, 1, 1, 27.0, 2),
+            (5, 8, 0, 0, 28.25, 0),
+            # 6th: nothing logged
+            # 7th: a single device, tied the other way
+            (7, 100, 0, 1, 29.5, 2), (7, 200, 1, 0, 20.1, 2),
+        ]
+        manager.log_readings_batch([
+            (_timestamp(day, seconds), '2024-03-%02d' % day, 0, 0, DO1, DO2, Tx, device_id)
+            for day, seconds, DO1, DO2, Tx, device_id in readings])
+        return manager
+
+    def assertSameAggregates(self, manager, start_date, end_date):
+        expected = manager.calculate_mode_for_dates(manager.get_date_range_trend(start_date, end_date))
+        actual = manager.get_date_range_aggregates(start_date, end_date)
+        self.assertEqual(list(expected[:3]), list(actual[:3]))
+        # Tx averages may differ in the last bits of summation order.
+        self.assertEqual(len(expected[3]), len(actual[3]))
+        for e, a in zip(expected[3], actual[3]):
+            self.assertTrue(math.isclose(e, a, rel_tol=1e-9), (e, a))
+        return actual
+
+    def test_several_days_and_devices(self):
+        for storage in DeviceManager.STORAGE_LAYOUTS:
+            with self.subTest(storage=storage):
+                manager = self.make_manager(storage)
+                dates, DO1_modes, DO2_modes, Tx_averages = self.assertSameAggregates(
+                    manager, '2024-03-01', '2024-03-31')
+                self.assertEqual(list(dates), ['2024-03-04', '2024-03-05', '2024-03-07'])
+                self.assertEqual(list(DO1_modes), [1, 0, 0])
+                self.assertEqual(list(DO2_modes), [0, 1, 1])
+
+    def test_ties_go_to_the_first_reading(self):
+        manager = self.make_manager('standard')
+        dates, DO1_modes, DO2_modes, Tx_averages = self.assertSameAggregates(manager, '2024-03-04', '2024-03-04')
+        self.assertEqual((list(DO1_modes), list(DO2_modes)), ([1], [0]))
+        dates, DO1_modes, DO2_modes, Tx_averages = self.assertSameAggregates(manager, '2024-03-07', '2024-03-07')
+        self.assertEqual((list(DO1_modes), list(DO2_modes)), ([0], [1]))
+
+    def test_empty_range(self):
+        manager = self.make_manager('standard')
+        for start_date, end_date in (('2024-03-06', '2024-03-06'), ('2024-04-01', '2024-04-30'),
+                                     ('2024-03-07', '2024-03-04')):
+            with self.subTest(start_date=start_date, end_date=end_date):
+                columns = self.assertSameAggregates(manager, start_date, end_date)
+                self.assertEqual([list(column) for column in columns], [[], [], [], []])
+
+    def test_datetime_bounds(self):
+        # Bounds are whole days, so a datetime start includes its own day. The
+        # original code compared the datetime's text and left that day out
+        # ('2024-03-05' < '2024-03-05 12:00:00'); callers wanting N days pass dates.
+        manager = self.make_manager('standard')
+        dates = self.assertSameAggregates(manager, datetime.datetime(2024, 3, 5, 12),
+                                          datetime.datetime(2024, 3, 7, 8))[0]
+        self.assertEqual(list(dates), ['2024-03-05', '2024-03-07'])
+
+    def test_date_bounds_are_inclusive(self):
+        # The weekly views ask for today - 6 days .. today: both ends included.
+        manager = self.make_manager('standard')
+        dates = self.assertSameAggregates(manager, datetime.date(2024, 3, 4), datetime.date(2024, 3, 7))[0]
+        self.assertEqual(list(dates), ['2024-03-04', '2024-03-05', '2024-03-07'])
+
+
+    def test_storage_layouts_select_the_same_days(self):
+        standard, packed = self.make_manager('standard'), self.make_manager('packed')
+        for start_date, end_date in ((datetime.datetime(2024, 3, 5, 12), datetime.datetime(2024, 3, 7, 8)),
+                                     ('2024-03-04 23:00', '2024-03-05 01:00'),
+                                     (datetime.date(2024, 3, 5), None)):
+            with self.subTest(start_date=start_date, end_date=end_date):
+                if end_date is not None:
+                    self.assertEqual(standard.get_date_range_trend(start_date, end_date),
+                                     packed.get_date_range_trend(start_date, end_date))
+                self.assertEqual([row for chunk in standard.iter_readings(start_date, end_date) for row in chunk],
+                                 [row for chunk in packed.iter_readings(start_date, end_date) for row in chunk])
+
+
+
+class WriteBehindTest(unittest.TestCase):
+    # Readings queued by the write-behind path are only committed by its worker
+    # thread; flush() and close() have to wait for them and report failures.
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.db_filename = os.path.join(self.tmpdir.name, 'write_behind.db')
+
+    def make_manager(self):
+        # A batching window long enough for the readings to still be queued when flushed.
+        return DeviceManager(TekXSimulator(seed=1), self.db_filename, None, export_mode='manual',
+                             write_behind=True, write_max_latency=0.2)
+
+    def count_readings(self, manager):
+        with manager.db.reader() as conn:
+            return conn.execute("SELECT COUNT(*) FROM readings").fetchone()[0]
+
+    def test_flush_commits_queued_readings(self):
+        manager = self.make_manager()
+        self.addCleanup(manager.close)
+        for _ in range(50):
+            manager.set_inputs(1, 0)
+        manager.flush()
+        self.assertEqual(self.count_readings(manager), 50)
+
+    def test_close_commits_queued_readings(self):
+        manager = self.make_manager()
+        for _ in range(50):
+            manager.set_inputs(0, 1)
+        manager.close()
+        manager = DeviceManager(TekXSimulator(seed=1), self.db_filename, None, export_mode='manual')
+        self.addCleanup(manager.close)
+        self.assertEqual(self.count_readings(manager), 50)
+
+    def test_failed_batch_is_reported(self):
+        manager = self.make_manager()
+        self.addCleanup(manager.close)
+        insert_batch = manager._insert_batch
+        failures = [OSError("disk full")]
+
+        def flaky_insert_batch(batch):
+            if failures:
+                raise failures.pop()
+            return insert_batch(batch)
+        manager._insert_batch = flaky_insert_batch
+        manager.set_inputs(1, 1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(RuntimeError) as caught:
+                manager.flush()
+        self.assertIsInstance(caught.exception.__cause__, OSError)
+        self.assertEqual(self.count_readings(manager), 0)
+        # Reported once; later batches go through again.
+        manager.set_inputs(1, 1)
+        manager.flush()
+        self.assertEqual(self.count_readings(manager), 1)
+        self.assertEqual(manager.worker_errors(), {})
+
+
+
+class CompactionTest(unittest.TestCase):
+    # compact() moves old readings out of the live table into monthly archive
+    # files (or deletes them); reads have to come out the same afterwards.
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def make_manager(self, storage):
+        manager = DeviceManager(TekXSimulator(seed=1), os.path.join(self.tmpdir.name, storage + '.db'), None,
+                                export_mode='manual', storage=storage)
+        self.addCleanup(manager.close)
+        # Every 5 hours for 80 days up to yesterday, alternating between two
+        # devices, so the compacted part spans at least two months.
+        now = time.time()
+        readings = []
+        for i in range(80 * 24 // 5):
+            timestamp = now - 86400 - i * 5 * 3600
+            readings.append((timestamp, time.strftime('%Y-%m-%d', time.localtime(timestamp)), i % 2, 0,
+                             i % 3 == 0, i % 4 != 0, 20 + i % 11 * 0.25, i % 2))
+        readings.reverse()
+        manager.log_readings_batch(readings)
+        return manager
+
+    def read_all(self, manager):
+        return (manager.get_date_range_trend('2000-01-01', '2100-12-31'),
+                manager.get_date_range_aggregates('2000-01-01', '2100-12-31'),
+                [row for chunk in manager.iter_readings() for row in chunk])
+
+    def test_archive_keeps_every_result(self):
+        for storage in DeviceManager.STORAGE_LAYOUTS:
+            with self.subTest(storage=storage):
+                manager = self.make_manager(storage)
+                before = self.read_all(manager)
+                self.assertGreater(manager.compact(retention_days=30, mode='archive'), 0)
+                self.assertGreaterEqual(len(manager._find_archives()), 2)
+                self.assertEqual(self.read_all(manager), before)
+
+    def test_delete_keeps_aggregates_and_recent_readings(self):
+        for storage in DeviceManager.STORAGE_LAYOUTS:
+            with self.subTest(storage=storage):
+                manager = self.make_manager(storage)
+                trend, aggregates, rows = self.read_all(manager)
+                removed = manager.compact(retention_days=30, mode='delete')
+                self.assertEqual(manager._find_archives(), [])
+                # Deleted days stay in daily_rollup but lose their readings.
+                cutoff = time.strftime('%Y-%m-%d', time.localtime(time.time() - 30 * 86400))
+                kept_rows = [row for row in rows if row[1] >= cutoff]
+                self.assertEqual(removed, len(rows) - len(kept_rows))
+                self.assertEqual(self.read_all(manager),
+                                 ({date: values for date, values in trend.items() if date >= cutoff},
+                                  aggregates, kept_rows))
+
+
+
+class QueryCacheTest(unittest.TestCase):
+    # Cached trends have to follow new readings: entries reaching today are
+    # checked against the max serial_number, past days are invalidated by date.
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.manager = DeviceManager(TekXSimulator(seed=1), os.path.join(self.tmpdir.name, 'cache.db'), None,
+                                     export_mode='manual')
+        self.addCleanup(self.manager.close)
+
+    def log(self, timestamp, Tx):
+        self.manager.log_readings_batch([(timestamp, time.strftime('%Y-%m-%d', time.localtime(timestamp)),
+                                          0, 0, 1, 0, Tx)])
+
+    def test_new_reading_today_is_seen(self):
+        today = time.strftime('%Y-%m-%d')
+        self.log(time.time(), 21.0)
+        self.assertEqual(self.manager.get_specific_date_trend(today)[3], [21.0])
+        self.assertEqual(self.manager.get_specific_date_trend(today)[3], [21.0])
+        self.assertEqual(self.manager.query_cache.hits, 1)
+        self.log(time.time(), 22.0)
+        self.assertEqual(self.manager.get_specific_date_trend(today)[3], [21.0, 22.0])
+
+    def test_new_reading_for_a_past_day_is_seen(self):
+        yesterday = time.time() - 86400
+        date = time.strftime('%Y-%m-%d', time.localtime(yesterday))
+        self.log(yesterday, 20.0)
+        self.assertEqual(self.manager.get_date_range_aggregates(date, date)[3], [20.0])
+        self.assertEqual(self.manager.get_date_range_aggregates(date, date)[3], [20.0])
+        self.assertEqual(self.manager.query_cache.hits, 1)
+        self.log(yesterday + 1, 30.0)
+        self.assertEqual(self.manager.get_date_range_aggregates(date, date)[3], [25.0])
+
+    def test_past_results_are_final(self):
+        cache = QueryCache()
+
+        def max_serial():
+            raise AssertionError("a final result should not be checked")
+        self.assertEqual(cache.fetch('key', '2000-01-01', '2000-01-02', lambda: ([1, 2],), max_serial), ([1, 2],))
+        self.assertEqual(cache.fetch('key', '2000-01-01', '2000-01-02', lambda: ([3],), max_serial), ([1, 2],))
+
+    def test_least_recently_used_results_are_evicted(self):
+        cache = QueryCache(max_rows=4)
+        for key in ('a', 'b'):
+            cache.fetch(key, '2000-01-01', '2000-01-01', lambda: ([key, key],), None)
+        cache.fetch('a', '2000-01-01', '2000-01-01', lambda: ([],), None)
+        cache.fetch('c', '2000-01-01', '2000-01-01', lambda: (['c', 'c'],), None)
+        self.assertEqual((cache.hits, cache.evictions), (1, 1))
+        self.assertEqual(cache.fetch('a', '2000-01-01', '2000-01-01', lambda: ([],), None), (['a', 'a'],))
+        self.assertEqual(cache.fetch('b', '2000-01-01', '2000-01-01', lambda: ([],), None), ([],))
+
+
+
+class StreamingStatsTest(unittest.TestCase):
+    # The bucketed Welford/Chan summaries and histogram percentiles against the
+    # same statistics computed directly over a fixed sample.
+
+    def setUp(self):
+        rng = random.Random(7)
+        self.samples = [(rng.random() < 0.3, rng.random() < 0.6, round(rng.uniform(15, 35), 2))
+                        for _ in range(500)]
+
+    def check(self, stats, samples):
+        n = len(samples)
+        Tx_values = [Tx for DO1, DO2, Tx in samples]
+        self.assertEqual(stats['count'], n)
+        self.assertTrue(math.isclose(stats['Tx_mean'], statistics.mean(Tx_values), rel_tol=1e-12))
+        self.assertTrue(math.isclose(stats['Tx_stdev'] ** 2 * (n - 1) / n, statistics.pvariance(Tx_values),
+                                     rel_tol=1e-9))
+        self.assertEqual((stats['Tx_min'], stats['Tx_max']), (min(Tx_values), max(Tx_values)))
+        self.assertTrue(math.isclose(stats['DO1_duty'], sum(sample[0] for sample in samples) / n))
+        self.assertTrue(math.isclose(stats['DO2_duty'], sum(sample[1] for sample in samples) / n))
+        ordered = sorted(Tx_values)
+        for p in StreamingStats.PERCENTILES:
+            expected = ordered[math.ceil(p / 100 * n) - 1]
+            # Histogram bins are 0.1 wide, clamped to the observed range.
+            self.assertLessEqual(abs(stats['Tx_p%d' % p] - expected), 0.05 + 1e-9)
+            self.assertTrue(min(Tx_values) <= stats['Tx_p%d' % p] <= max(Tx_values))
+
+    def test_one_bucket(self):
+        stats = StreamingStats((('window', 600),), buckets=60)
+        start = 600 * 1000000
+        for i, (DO1, DO2, Tx) in enumerate(self.samples):
+            stats.add(start + i / 100, DO1, DO2, Tx)
+        self.check(stats.summary(start + 9)['window'], self.samples)
+
+    def test_merge_of_two_buckets(self):
+        stats = StreamingStats((('window', 600),), buckets=60)
+        start = 600 * 1000000
+        half = len(self.samples) // 2
+        for i, (DO1, DO2, Tx) in enumerate(self.samples):
+            stats.add(start + (0 if i < half else 10) + i / 1000, DO1, DO2, Tx)
+        summary = stats.summary(start + 15)['window']
+        self.check(summary, self.samples)
+        transitions = sum(a[0] != b[0] for a, b in zip(self.samples, self.samples[1:]))
+        self.assertEqual(summary['DO1_transitions'], transitions)
+
+    def test_many_buckets_and_expiry(self):
+        stats = StreamingStats((('window', 600),), buckets=60)
+        start = 600 * 1000000
+        for i, (DO1, DO2, Tx) in enumerate(self.samples):
+            stats.add(start + i * 2, DO1, DO2, Tx)
+        end = start + 2 * (len(self.samples) - 1)
+        # The window keeps the buckets of the last 600 s: 60 buckets of 10 s.
+        first_kept = (end // 10 - 59) * 10
+        kept = [sample for i, sample in enumerate(self.samples) if start + i * 2 >= first_kept]
+        self.check(stats.summary(end)['window'], kept)
+        self.assertEqual(stats.summary(end + 600)['window']['count'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
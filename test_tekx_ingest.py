@@ -0,0 +1,69 @@
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import unittest
+from tekx_core import TekXSimulator, DeviceManager
+from tekx_ingest import IngestClient, IngestDaemon, default_address, new_authkey
+
+
+class IngestDaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.db_filename = os.path.join(self.tmpdir.name, 'ingest.db')
+        self.authkey = new_authkey()
+        self.address = default_address(self.db_filename)
+        writer = DeviceManager(TekXSimulator(seed=1), self.db_filename, None, export_mode='manual', cache_rows=0)
+        self.addCleanup(writer.close)
+        daemon = IngestDaemon(writer, self.address, self.authkey)
+        self.addCleanup(daemon.close)
+        threading.Thread(target=daemon.serve_forever, daemon=True).start()
+
+    def make_manager(self, ack):
+        client = IngestClient(self.address, self.authkey, ack=ack)
+        self.addCleanup(client.close)
+        manager = DeviceManager(TekXSimulator(seed=2), self.db_filename, None, export_mode='manual',
+                                ingest=client)
+        self.addCleanup(manager.close)
+        return manager
+
+    def readings(self, count):
+        now = time.time()
+        return [(now + i, time.strftime('%Y-%m-%d', time.localtime(now)), 0, 0, i % 2, 0, 20.0 + i, 0)
+                for i in range(count)]
+
+    def count_readings(self, manager):
+        with manager.db.reader() as conn:
+            return conn.execute("SELECT COUNT(*) FROM readings").fetchone()[0]
+
+    def test_committed_round_trip(self):
+        manager = self.make_manager('committed')
+        self.assertEqual(manager.ingest.submit(self.readings(10)), 10)
+        self.assertEqual(self.count_readings(manager), 10)
+        manager.log_readings_batch(self.readings(5))
+        self.assertEqual(self.count_readings(manager), 15)
+
+    def test_flush_waits_for_commit_in_every_mode(self):
+        for ack in ('none', 'queued'):
+            with self.subTest(ack=ack):
+                manager = self.make_manager(ack)
+                before = self.count_readings(manager)
+                for _ in range(20):
+                    manager.log_readings_batch(self.readings(50))
+                manager.flush()
+                self.assertEqual(self.count_readings(manager), before + 1000)
+
+    def test_wrong_authkey_is_refused(self):
+        with self.assertRaises(multiprocessing.AuthenticationError):
+            IngestClient(self.address, new_authkey())
+        with self.assertRaises(ValueError):
+            IngestClient(self.address, None)
+        # The daemon keeps serving clients that have the key.
+        self.test_committed_round_trip()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from tekx_core import TekXSimulator, DeviceManager
+from tekx_service import HTTPError, Request, TekXService, _date_param
+
+
+def _parse(data):
+    async def parse():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await TekXService._read_request(None, reader)
+    return asyncio.run(parse())
+
+
+class RequestParserTest(unittest.TestCase):
+
+    def test_get(self):
+        request = _parse(b'GET /trend?date=2024-03-05&device_id=1 HTTP/1.1\r\n'
+                         b'Host: localhost\r\nIf-None-Match: "3"\r\n\r\n')
+        self.assertEqual((request.method, request.path), ('GET', '/trend'))
+        self.assertEqual(request.query, {'date': '2024-03-05', 'device_id': '1'})
+        self.assertEqual(request.headers['if-none-match'], '"3"')
+        self.assertTrue(request.keep_alive)
+
+    def test_post_body_and_connection_close(self):
+        request = _parse(b'POST /exports HTTP/1.1\r\nContent-Length: 17\r\nConnection: close\r\n\r\n'
+                         b'{"format": "csv"}')
+        self.assertEqual(request.body, b'{"format": "csv"}')
+        self.assertFalse(request.keep_alive)
+        self.assertFalse(_parse(b'GET / HTTP/1.0\r\n\r\n').keep_alive)
+
+    def test_closed_connection(self):
+        self.assertIsNone(_parse(b''))
+
+    def test_bad_requests(self):
+        for data, status in ((b'GET /\r\n\r\n', 400),
+                             (b'POST /exports HTTP/1.1\r\nContent-Length: -1\r\n\r\n', 400),
+                             (b'POST /exports HTTP/1.1\r\nContent-Length: 100000\r\n\r\n', 413),
+                             (b'POST /exports HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n', 501)):
+            with self.subTest(data=data):
+                with self.assertRaises(HTTPError) as caught:
+                    _parse(data)
+                self.assertEqual(caught.exception.status, status)
+
+    def test_date_param(self):
+        self.assertEqual(_date_param({'date': '2024-03-05'}, 'date'), '2024-03-05')
+        self.assertIsNone(_date_param({}, 'date', required=False))
+        for value in ('2024-3-5', '20240305', '2024-02-30', '2024-03-05T12:00', 20240305):
+            with self.subTest(value=value):
+                with self.assertRaises(HTTPError) as caught:
+                    _date_param({'date': value}, 'date')
+                self.assertEqual(caught.exception.status, 400)
+
+
+class ServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.manager = DeviceManager(TekXSimulator(seed=1), os.path.join(self.tmpdir.name, 'service.db'), None,
+                                     export_mode='manual')
+        self.addCleanup(self.manager.close)
+        self.log()
+
+    def log(self):
+        now = time.time()
+        self.manager.log_readings_batch([(now, time.strftime('%Y-%m-%d', time.localtime(now)), 0, 1, 0, 1, 21.5)])
+
+    def dispatch(self, path, headers=None, method='GET', body=b''):
+        async def dispatch():
+            service = TekXService(self.manager, export_dir=os.path.join(self.tmpdir.name, 'exports'))
+            try:
+                return await service._dispatch(Request(method, path, 'HTTP/1.1', headers or {}, body))
+            finally:
+                service.close()
+        return asyncio.run(dispatch())
+
+    def test_etag_and_not_modified(self):
+        status, headers, body = self.dispatch('/status')
+        self.assertEqual(status, 200)
+        etag = headers['ETag']
+        self.assertEqual(self.dispatch('/status', {'if-none-match': etag}), (304, {'ETag': etag}, b''))
+        self.assertEqual(self.dispatch('/aggregates?start=2000-01-01&end=2100-01-01',
+                                       {'if-none-match': 'W/' + etag})[0], 304)
+        self.log()
+        status, headers, body = self.dispatch('/status', {'if-none-match': etag})
+        self.assertEqual(status, 200)
+        self.assertNotEqual(headers['ETag'], etag)
+
+    def test_unpadded_date_is_rejected(self):
+        with self.assertRaises(HTTPError) as caught:
+            self.dispatch('/aggregates?start=2024-3-5&end=2024-03-07')
+        self.assertEqual(caught.exception.status, 400)
+
+    def test_created_export_reports_its_queued_state(self):
+        status, headers, body = self.dispatch('/exports', method='POST', body=b'{"format": "csv"}')
+        self.assertEqual(status, 202)
+        self.assertIn(b'"status": "queued"', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,170 +1,169 @@
+import sys
 import tkinter as tk
 from tkinter import ttk, messagebox
 from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import random
-import sqlite3
-import xlsxwriter
-from collections import Counter
-import time
-
-
-class TekXSimulator:
-    def __init__(self):
-        self.A = 0
-        self.B = 0
-        self.DO1 = 0
-        self.DO2 = 0
-        self.Tx = 0.0  
-
-    def update_status(self):
-        self.DO1 = random.randint(0, 1)
-        self.DO2 = random.randint(0, 1)
-        self.Tx = round(random.uniform(20, 30), 2)  # Simulated temperature reading
-
-class DeviceManager:
-    def __init__(self, device, db_filename, excel_filename):
-        self.device = device
-        self.db_filename = db_filename
-        self.excel_filename = excel_filename
-        self.create_db()
-
-    def set_inputs(self, A, B):
-        self.device.A = A
-        self.device.B = B
-        self.device.update_status()
-        self.log_readings()
-        self.log_readings_to_excel()
-
-    def get_status(self):
-        conn = sqlite3.connect(self.db_filename)
-        c = conn.cursor()
-        c.execute('''SELECT * FROM readings WHERE serial_number = (SELECT MAX(serial_number) FROM readings)''')
-        data = c.fetchall()
-        conn.close()
-
-        if not data:
-            return self.device.DO1,self.device.DO2,self.device.Tx
-
-        for row in data:
-            return row[5],row[6],row[7]
-
-    def calculate_mode(self, data):
-        counts = Counter(data)
-        mode_values = counts.most_common(1)
-        if mode_values:  
-            mode_value, mode_count = mode_values[0]
-            return mode_value 
+import itertools
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from tekx_core import (TekXSimulator, DeviceManager, EXPORTERS, Metrics, downsample_trend,
+                       format_stats, timestamps_to_datetime64)
+from tekx_ingest import IngestClient, default_authkey_file, read_authkey
+
+
+class TrendCharts:
+    # The DO1/DO2 and temperature charts of one trends tab. The Figures and Tk
+    # canvases are built on first use and afterwards only have their line data
+    # replaced, so repeated refreshes neither allocate figures nor touch pyplot.
+    def __init__(self, master, title, xlabel):
+        self.master = master
+        self.title = title
+        self.xlabel = xlabel
+        self.frame = None
+        # Set by an instrumented Application: canvas draws are timed as 'ui' <name>_draw.
+        self.metrics = None
+        self.name = title
+
+    def _build(self):
+        # matplotlib is only imported once a trends tab first draws.
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        self.frame = tk.Frame(self.master)
+        self.frame.pack(fill=tk.BOTH, expand=True)
+
+        self.fig = Figure()
+        self.ax = self.fig.add_subplot()
+        self.DO1_line, = self.ax.plot([], [], marker='o', label='DO1')
+        self.DO2_line, = self.ax.plot([], [], marker='s', label='DO2', linestyle='dashed')
+        # The lines start empty, so tell the axes up front that x holds dates.
+        self.ax.xaxis_date()
+        self.ax.set_xlabel(self.xlabel)
+        self.ax.set_ylabel('Value')
+        self.ax.set_title(self.title)
+        self.ax.legend()
+
+        self.fig2 = Figure()
+        self.ax2 = self.fig2.add_subplot()
+        self.Tx_line, = self.ax2.plot([], [], marker='x', label='Temperature')
+        self.ax2.xaxis_date()
+        self.ax2.set_xlabel(self.xlabel)
+        self.ax2.set_ylabel('Temperature')
+        self.ax2.set_title('Temperature Trend')
+        self.ax2.legend()
+
+        self.canvas = FigureCanvasTkAgg(self.fig, master=self.frame)
+        self.canvas.get_tk_widget().pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.canvas2 = FigureCanvasTkAgg(self.fig2, master=self.frame)
+        self.canvas2.get_tk_widget().pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        if self.metrics is not None:
+            # draw_idle ends up calling canvas.draw, so this times the actual rendering.
+            self.canvas.draw = self.metrics.wrap('ui', self.name + '_draw', self.canvas.draw)
+            self.canvas2.draw = self.metrics.wrap('ui', self.name + '_draw_temperature', self.canvas2.draw)
+
+    def update(self, DO1_x, DO1_values, DO2_x, DO2_values, Tx_x, Tx_values):
+        if self.frame is None:
+            self._build()
+        self.DO1_line.set_data(DO1_x, DO1_values)
+        self.DO2_line.set_data(DO2_x, DO2_values)
+        self.Tx_line.set_data(Tx_x, Tx_values)
+        self._redraw()
+
+    def append(self, x, DO1_values, DO2_values, Tx_values, max_points):
+        # Adds points to the end of all three lines and keeps the newest max_points,
+        # so a live view only converts what is new rather than its whole history.
+        if self.frame is None:
+            self._build()
+        for line, values in ((self.DO1_line, DO1_values), (self.DO2_line, DO2_values),
+                             (self.Tx_line, Tx_values)):
+            old_x = line.get_xdata()
+            if len(old_x):
+                line.set_data(np.concatenate((old_x, x))[-max_points:],
+                              np.concatenate((line.get_ydata(), values))[-max_points:])
+            else:
+                line.set_data(x[-max_points:], values[-max_points:])
+        self._redraw()
+
+    def _redraw(self):
+        for ax, fig in ((self.ax, self.fig), (self.ax2, self.fig2)):
+            ax.relim()
+            ax.autoscale_view()
+            fig.autofmt_xdate()
+        self.canvas.draw_idle()
+        self.canvas2.draw_idle()
+
+class BackgroundTasks:
+    # Runs slow work on a small thread pool and hands the result back to the Tk
+    # thread by polling with after(). Tasks are keyed: submitting under a key that
+    # is still running supersedes the old task, whose result is then dropped.
+    # That is only for reads; a task submitted with cancellable=False is never
+    # cancelled, by cancel() or otherwise, so it has to get a key of its own.
+    def __init__(self, root, max_workers=2, poll_interval=50):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tekx-ui')
+        self._generations = {}
+        self._running = {}
+        self.on_change = None
+
+    def submit(self, key, func, on_done, on_error, cancellable=True):
+        # func receives a threading.Event that is set when the task is cancelled
+        # or superseded; on_done/on_error run on the Tk thread.
+        self._cancel_running(key)
+        generation = self._generations.get(key, 0) + 1
+        self._generations[key] = generation
+        cancel_event = threading.Event()
+        future = self.executor.submit(func, cancel_event)
+        self._running[key] = (generation, future, cancel_event, cancellable)
+        self._changed()
+        self.root.after(self.poll_interval, self._poll, key, generation, future, on_done, on_error)
+
+    def _poll(self, key, generation, future, on_done, on_error):
+        if not future.done():
+            self.root.after(self.poll_interval, self._poll, key, generation, future, on_done, on_error)
+            return
+        if self._generations.get(key) != generation:
+            return
+        del self._running[key]
+        self._changed()
+        if future.cancelled():
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            on_error(e)
         else:
-            return None
-
-    def get_specific_date_trend(self, selected_date):
-        conn = sqlite3.connect(self.db_filename)
-        c = conn.cursor()
-
-        c.execute("SELECT timestamp, DO1, DO2, Tx FROM readings WHERE date = ? ORDER BY timestamp",
-                  (selected_date,))
-        data = c.fetchall()
-        conn.close()
-
-        timestamps = [row[0] for row in data]
-        DO1_values = [row[1] for row in data]
-        DO2_values = [row[2] for row in data]
-        Tx_values  = [row[3] for row in data]
-
-        return timestamps, DO1_values, DO2_values, Tx_values
-
-    def get_date_range_trend(self, start_date, end_date):
-        conn = sqlite3.connect(self.db_filename)
-        c = conn.cursor()
-
-        c.execute("SELECT date, DO1, DO2, Tx FROM readings WHERE date >= ? AND date <= ? ORDER BY date",
-                  (start_date, end_date))
-        data = c.fetchall()
-        conn.close()
-
-        date_dict = {}
-        for row in data:
-            date = row[0]
-            DO1_value = row[1]
-            DO2_value = row[2]
-            tx_value = row[3]
-            if date not in date_dict:
-                date_dict[date] = {'DO1': [], 'DO2': [], 'Tx': []}
-        
-            date_dict[date]['DO1'].append(DO1_value)
-            date_dict[date]['DO2'].append(DO2_value)
-            date_dict[date]['Tx'].append(tx_value)
-        return date_dict
-    def calculate_average(self,number_list):
-        if not number_list:
-            return 0
-        
-        total = sum(number_list)
-        average = total / len(number_list)
-        #print(number_list,average)
-        return average        
-    def calculate_mode_for_dates(self, date_dict):
-        dates = []
-        do1_modes = []
-        do2_modes = []
-        tx_modes = []
-    
-        for date, values in date_dict.items():
-            if not values:
-                continue
-        
-            do1_mode = self.calculate_mode(values['DO1'])
-            do2_mode = self.calculate_mode(values['DO2'])
-            tx_mode = self.calculate_average(values['Tx'])
-            dates.append(date)
-            do1_modes.append(do1_mode)
-            do2_modes.append(do2_mode)
-            tx_modes.append(tx_mode)
-    
-        return dates, do1_modes, do2_modes, tx_modes
-
-    def create_db(self):
-        conn = sqlite3.connect(self.db_filename)
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS readings
-                     (serial_number INTEGER PRIMARY KEY AUTOINCREMENT,
-                      timestamp REAL, date TEXT, A INTEGER, B INTEGER,
-                      DO1 INTEGER, DO2 INTEGER, Tx REAL)''')
-        conn.commit()
-        conn.close()
-
-    def log_readings(self):
-        conn = sqlite3.connect(self.db_filename)
-        c = conn.cursor()
-        timestamp = time.time()
-        date = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
-        c.execute("INSERT INTO readings (timestamp, date, A, B, DO1, DO2, Tx) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                  (timestamp, date, self.device.A, self.device.B, self.device.DO1, self.device.DO2, self.device.Tx))
-        conn.commit()
-        conn.close()
-
-    def log_readings_to_excel(self):
-        workbook = xlsxwriter.Workbook(self.excel_filename)
-        worksheet = workbook.add_worksheet()
-
-        header = ['Timestamp', 'Date', 'A', 'B', 'DO1', 'DO2', 'Tx']
-        for col, item in enumerate(header):
-            worksheet.write(0, col, item)
-
-        conn = sqlite3.connect(self.db_filename)
-        c = conn.cursor()
-        c.execute("SELECT timestamp, date, A, B, DO1, DO2, Tx FROM readings ORDER BY timestamp")
-        data = c.fetchall()
-        for row_idx, row_data in enumerate(data):
-            for col_idx, cell_data in enumerate(row_data):
-                worksheet.write(row_idx + 1, col_idx, cell_data)
-
-        workbook.close()
+            on_done(result)
+
+    def _cancel_running(self, key):
+        running = self._running.pop(key, None)
+        if running is not None:
+            generation, future, cancel_event, cancellable = running
+            cancel_event.set()
+            future.cancel()
+            self._generations[key] = generation + 1
+
+    def cancel(self):
+        for key in self.cancellable():
+            self._cancel_running(key)
+        self._changed()
+
+    def running(self):
+        return list(self._running)
+
+    def cancellable(self):
+        return [key for key, running in self._running.items() if running[3]]
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def shutdown(self):
+        # Cancelled reads never start; queued writes still run.
+        self.cancel()
+        self.executor.shutdown(wait=True)
 
 class Application(tk.Tk):
-    def __init__(self):
+    def __init__(self, metrics=None, ingest_address=None):
         super().__init__()
         self.title("TekX Simulator")
         self.geometry("600x600")
@@ -172,11 +171,98 @@ class Application(tk.Tk):
         self.tekx_simulator = TekXSimulator()
         self.db_filename = "tekx_readings8.db"
         self.excel_filename = "tekx_readings8.xlsx"
-        self.device_manager = DeviceManager(self.tekx_simulator, self.db_filename, self.excel_filename)
+        ingest = None
+        if ingest_address:
+            ingest = IngestClient(ingest_address, read_authkey(default_authkey_file(self.db_filename)))
+        self.device_manager = DeviceManager(self.tekx_simulator, self.db_filename, self.excel_filename,
+                                            export_mode='deferred', export_interval=30.0,
+                                            export_threshold=1000, write_behind=True, metrics=metrics,
+                                            ingest=ingest)
+
+        # Live view: the newest live_buffer_size readings, topped up each tick with
+        # rows above live_last_serial only.
+        self.live_buffer_size = 3600
+        self.live_last_serial = 0
+        self._live_job = None
+
+        self.tasks = BackgroundTasks(self)
+        self.tasks.on_change = self.update_task_status
+        self._task_descriptions = {}
+        self._write_ids = itertools.count(1)
+
+        # With metrics (a Metrics) the plot callbacks, their background loads and
+        # the chart draws are timed too; the buttons bind the wrapped callbacks.
+        self.metrics = metrics
+        if metrics is not None:
+            for name in dir(self):
+                if name.startswith(('plot_', 'show_')):
+                    setattr(self, name, metrics.wrap('ui', name, getattr(self, name)))
 
         self.create_widgets()
 
+        if metrics is not None:
+            for name in ('live', 'weekly', 'specific_date', 'date_range'):
+                charts = getattr(self, name + '_charts')
+                charts.metrics = metrics
+                charts.name = name
+
+    def destroy(self):
+        if self._live_job is not None:
+            self.after_cancel(self._live_job)
+            self._live_job = None
+        self.tasks.shutdown()
+        try:
+            self.device_manager.close()
+        except RuntimeError as e:
+            # A background worker failed, e.g. readings that never reached the database.
+            messagebox.showerror("Error", str(e))
+        finally:
+            if self.device_manager.ingest is not None:
+                self.device_manager.ingest.close()
+            super().destroy()
+
+    def run_in_background(self, key, description, func, on_done, write=False):
+        # Database reads made by func are interrupted when the task is cancelled.
+        # A write gets a key of its own and can't be cancelled or superseded, so
+        # a second click or Cancel never drops a state change; failures still
+        # end up in background_task_failed.
+        if self.metrics is not None:
+            func = self.metrics.wrap('ui', key + '_load', func)
+        if write:
+            key = '%s-%d' % (key, next(self._write_ids))
+        def task(cancel_event):
+            with self.device_manager.db.cancellable(cancel_event):
+                return func()
+        self._task_descriptions[key] = description
+        self.tasks.submit(key, task, on_done, self.background_task_failed, cancellable=not write)
+
+    def background_task_failed(self, error):
+        messagebox.showerror("Error", str(error))
+
+    def update_task_status(self):
+        running = self.tasks.running()
+        for key in list(self._task_descriptions):
+            if key not in running:
+                del self._task_descriptions[key]
+        if running:
+            self.lbl_task.config(text=", ".join(self._task_descriptions[key] for key in running) + "...")
+            self.progress.start(10)
+        else:
+            self.lbl_task.config(text="")
+            self.progress.stop()
+        self.btn_cancel.config(state=tk.NORMAL if self.tasks.cancellable() else tk.DISABLED)
+
     def create_widgets(self):
+        # Packed before the notebook so it keeps its row at the bottom.
+        status_bar = tk.Frame(self)
+        status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+        self.btn_cancel = tk.Button(status_bar, text="Cancel", state=tk.DISABLED, command=self.tasks.cancel)
+        self.btn_cancel.pack(side=tk.RIGHT, padx=5, pady=2)
+        self.progress = ttk.Progressbar(status_bar, mode='indeterminate', length=120)
+        self.progress.pack(side=tk.RIGHT, pady=2)
+        self.lbl_task = tk.Label(status_bar, text="", anchor=tk.W)
+        self.lbl_task.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+
         self.tabs = ttk.Notebook(self)
         self.tabs.pack(fill=tk.BOTH, expand=True)
 
@@ -218,6 +304,34 @@ class Application(tk.Tk):
         self.lbl_result = tk.Label(self.tab1, text="", font=('Helvetica', 12))
         self.lbl_result.pack(pady=10)
 
+        # Streaming statistics per window, refreshed with the status from memory.
+        self.stats_table = None
+        windows = [name for name, seconds in self.device_manager.stats_windows or ()]
+        if windows:
+            columns = ('statistic',) + tuple(windows)
+            self.stats_table = ttk.Treeview(self.tab1, columns=columns, show='headings', height=12)
+            self.stats_table.heading('statistic', text="Statistic")
+            self.stats_table.column('statistic', width=120, anchor=tk.W)
+            for name in windows:
+                self.stats_table.heading(name, text="Last " + name)
+                self.stats_table.column(name, width=80, anchor=tk.E)
+            self.stats_table.pack(pady=5)
+            self.update_stats()
+
+        live_controls = tk.Frame(self.tab1)
+        live_controls.pack()
+        self.live_enabled = tk.BooleanVar(value=False)
+        chk_live = tk.Checkbutton(live_controls, text="Live", variable=self.live_enabled, command=self.toggle_live)
+        chk_live.pack(side=tk.LEFT)
+        lbl_interval = tk.Label(live_controls, text="Refresh every (s): ")
+        lbl_interval.pack(side=tk.LEFT)
+        self.live_interval = tk.Spinbox(live_controls, from_=0.5, to=60, increment=0.5, width=5)
+        self.live_interval.delete(0, tk.END)
+        self.live_interval.insert(0, "1")
+        self.live_interval.pack(side=tk.LEFT)
+
+        self.live_charts = TrendCharts(self.tab1, 'Live DO1 and DO2', 'Timestamp')
+
     def create_tab2(self):
         lbl_config = tk.Label(self.tab2, text="Configure Inputs", font=('Helvetica', 16))
         lbl_config.pack(pady=10)
@@ -242,6 +356,8 @@ class Application(tk.Tk):
         btn_plot_trends = tk.Button(self.tab3, text="Plot Weekly Trends", command=self.plot_weekly_trends)
         btn_plot_trends.pack()
 
+        self.weekly_charts = TrendCharts(self.tab3, 'Weekly Trends of DO1 and DO2', 'Date')
+
     def create_tab4(self):
         lbl_specific_date = tk.Label(self.tab4, text="Specific Date Trends", font=('Helvetica', 16))
         lbl_specific_date.pack(pady=10)
@@ -251,15 +367,38 @@ class Application(tk.Tk):
         self.entry_date = tk.Entry(self.tab4)
         self.entry_date.pack()
 
+        self.full_resolution = tk.BooleanVar(value=False)
+        chk_full_resolution = tk.Checkbutton(self.tab4, text="Full resolution", variable=self.full_resolution)
+        chk_full_resolution.pack()
+
         btn_plot_specific_date = tk.Button(self.tab4, text="Plot Trends for Specific Date", command=self.plot_specific_date_trends)
         btn_plot_specific_date.pack(pady=10)
 
+        self.specific_date_charts = TrendCharts(self.tab4, 'Trends of DO1 and DO2', 'Timestamp')
+
     def create_tab5(self):
-        lbl_excel_report = tk.Label(self.tab5, text="Download Excel Report", font=('Helvetica', 16))
+        lbl_excel_report = tk.Label(self.tab5, text="Download Report", font=('Helvetica', 16))
         lbl_excel_report.pack(pady=10)
 
+        lbl_export_start_date = tk.Label(self.tab5, text="Start Date (YYYY-MM-DD, optional): ")
+        lbl_export_start_date.pack()
+        self.entry_export_start_date = tk.Entry(self.tab5)
+        self.entry_export_start_date.pack()
+
+        lbl_export_end_date = tk.Label(self.tab5, text="End Date (YYYY-MM-DD, optional): ")
+        lbl_export_end_date.pack()
+        self.entry_export_end_date = tk.Entry(self.tab5)
+        self.entry_export_end_date.pack()
+
+        lbl_export_format = tk.Label(self.tab5, text="Format: ")
+        lbl_export_format.pack()
+        self.export_format = tk.StringVar(value='xlsx')
+        cmb_export_format = ttk.Combobox(self.tab5, textvariable=self.export_format, values=list(EXPORTERS),
+                                         state='readonly')
+        cmb_export_format.pack()
+
         btn_download_excel = tk.Button(self.tab5, text="Download", command=self.download_excel_report)
-        btn_download_excel.pack()
+        btn_download_excel.pack(pady=10)
 
     def create_tab6(self):
         lbl_exit = tk.Label(self.tab6, text="Exit Application", font=('Helvetica', 16))
@@ -284,9 +423,50 @@ class Application(tk.Tk):
 
         btn_plot_specific_date_range = tk.Button(self.tab7, text="Plot Trends for Specific Date Range", command=self.plot_specific_date_range_trends)
         btn_plot_specific_date_range.pack(pady=10)
+
+        self.date_range_charts = TrendCharts(self.tab7, 'Trends of DO1 and DO2', 'Date')
     def get_current_status(self):
         DO1, DO2, Tx = self.device_manager.get_status()
         self.lbl_result.config(text=f"DO1: {DO1}, DO2: {DO2}, Tx: {Tx}")
+        self.update_stats()
+
+    def update_stats(self):
+        if self.stats_table is None:
+            return
+        self.stats_table.delete(*self.stats_table.get_children())
+        for label, values in format_stats(self.device_manager.get_online_stats()):
+            self.stats_table.insert('', tk.END, values=(label,) + tuple(values))
+
+    def toggle_live(self):
+        if self.live_enabled.get():
+            if self._live_job is None:
+                self.poll_live()
+        elif self._live_job is not None:
+            self.after_cancel(self._live_job)
+            self._live_job = None
+
+    def poll_live(self):
+        try:
+            rows = self.device_manager.get_readings_since(self.live_last_serial, limit=self.live_buffer_size)
+            if rows:
+                self.live_last_serial = rows[-1][0]
+                DO1, DO2, Tx = rows[-1][5:8]
+                self.lbl_result.config(text=f"DO1: {DO1}, DO2: {DO2}, Tx: {Tx}")
+
+                timestamps = timestamps_to_datetime64([row[1] for row in rows])
+                self.live_charts.append(timestamps, np.array([row[5] for row in rows]),
+                                        np.array([row[6] for row in rows]), np.array([row[7] for row in rows]),
+                                        self.live_buffer_size)
+            self.update_stats()
+        except Exception as e:
+            # Shown rather than raised, so one failed tick doesn't end the live view.
+            self.lbl_result.config(text=f"Live update failed: {e}")
+        finally:
+            try:
+                interval = float(self.live_interval.get())
+            except ValueError:
+                interval = 1.0
+            self._live_job = self.after(max(int(interval * 1000), 100), self.poll_live)
 
     def configure_inputs(self):
         A = int(self.entry_A.get())
@@ -294,8 +474,11 @@ class Application(tk.Tk):
         if A not in (0, 1) or B not in (0, 1):
             messagebox.showerror("Error", "Invalid input. A and B must be either 0 or 1.")
             return
-        self.device_manager.set_inputs(A, B)
-        messagebox.showinfo("Success", "Inputs A and B configured successfully.")
+        self.run_in_background('configure', "Configuring inputs",
+                               lambda: self.device_manager.set_inputs(A, B),
+                               lambda result: messagebox.showinfo("Success", "Inputs A and B configured successfully."),
+                               write=True)
+
     def plot_specific_date_range_trends(self):
         start_date = self.entry_start_date.get()
         end_date = self.entry_end_date.get()
@@ -315,152 +498,83 @@ class Application(tk.Tk):
             messagebox.showerror("Error", "Start date cannot be after end date.")
             return
 
-        date_dict = self.device_manager.get_date_range_trend(start_date, end_date)
-        if not date_dict:
+        self.run_in_background('date_range', "Loading date range trends",
+                               lambda: self.device_manager.get_date_range_aggregates(start_date, end_date),
+                               self.show_specific_date_range_trends)
+
+    def show_specific_date_range_trends(self, result):
+        dates, DO1_values, DO2_values, Tx_values = result
+        if not dates:
             messagebox.showerror("Error", "No data available for the selected date range.")
             return
 
-        dates, DO1_values, DO2_values, Tx_values = self.device_manager.calculate_mode_for_dates(date_dict)
-
-        # Clear existing canvas widgets
-        for widget in self.tab7.winfo_children():
-            if isinstance(widget, tk.Frame):
-                widget.destroy()
-
-        # Create a frame for the canvas
-        plot_frame = tk.Frame(self.tab7)
-        plot_frame.pack(fill=tk.BOTH, expand=True)
-
-        # Create the first subplot for DO1 and DO2
-        fig, ax = plt.subplots()
-        ax.plot(dates, DO1_values, marker='o', label='DO1')
-        ax.plot(dates, DO2_values, marker='s', label='DO2', linestyle='dashed')
-        ax.set_xlabel('Date')
-        ax.set_ylabel('Value')
-        ax.set_title('Trends of DO1 and DO2')
-        ax.legend()
-        fig.autofmt_xdate()
-
-        # Create the second subplot for Temperature
-        fig2, ax2 = plt.subplots()
-        ax2.plot(dates, Tx_values, marker='x', label='Temperature')
-        ax2.set_xlabel('Date')
-        ax2.set_ylabel('Temperature')
-        ax2.set_title('Temperature Trend')
-        ax2.legend()
-        fig2.autofmt_xdate()
-
-        # Create canvas for the first subplot
-        canvas = FigureCanvasTkAgg(fig, master=plot_frame)
-        canvas.draw()
-        canvas_widget = canvas.get_tk_widget()
-        canvas_widget.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-
-        # Create canvas for the second subplot
-        canvas2 = FigureCanvasTkAgg(fig2, master=plot_frame)
-        canvas2.draw()
-        canvas_widget2 = canvas2.get_tk_widget()
-        canvas_widget2.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        dates = np.array(dates, dtype='datetime64[D]')
+        self.date_range_charts.update(dates, DO1_values, dates, DO2_values, dates, Tx_values)
+
     def plot_weekly_trends(self):
-        start_date = datetime.now() - timedelta(days=7)
-        end_date = datetime.now()
-        dates, DO1_values, DO2_values, Tx_values = self.device_manager.calculate_mode_for_dates(
-            self.device_manager.get_date_range_trend(start_date, end_date))
-
-        # Clear existing canvas widgets
-        for widget in self.tab3.winfo_children():
-            if isinstance(widget, tk.Frame):
-                widget.destroy()
-
-        # Create a frame for the canvas
-        plot_frame = tk.Frame(self.tab3)
-        plot_frame.pack(fill=tk.BOTH, expand=True)
-
-        # Create the first subplot for DO1 and DO2
-        fig, ax = plt.subplots()
-        ax.plot(dates, DO1_values, marker='o', label='DO1')
-        ax.plot(dates, DO2_values, marker='s', label='DO2', linestyle='dashed')
-        ax.set_xlabel('Date')
-        ax.set_ylabel('Value')
-        ax.set_title('Weekly Trends of DO1 and DO2')
-        ax.legend()
-        fig.autofmt_xdate()
-
-        # Create the second subplot for Temperature
-        fig2, ax2 = plt.subplots()
-        ax2.plot(dates, Tx_values, marker='x', label='Temperature')
-        ax2.set_xlabel('Date')
-        ax2.set_ylabel('Temperature')
-        ax2.set_title('Temperature Trend')
-        ax2.legend()
-        fig2.autofmt_xdate()
-
-        # Create canvas for the first subplot
-        canvas = FigureCanvasTkAgg(fig, master=plot_frame)
-        canvas.draw()
-        canvas_widget = canvas.get_tk_widget()
-        canvas_widget.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-
-        # Create canvas for the second subplot
-        canvas2 = FigureCanvasTkAgg(fig2, master=plot_frame)
-        canvas2.draw()
-        canvas_widget2 = canvas2.get_tk_widget()
-        canvas_widget2.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        # The last seven days, today included (bounds are whole days).
+        end_date = datetime.now().date()
+        start_date = end_date - timedelta(days=6)
+        self.run_in_background('weekly', "Loading weekly trends",
+                               lambda: self.device_manager.get_date_range_aggregates(start_date, end_date),
+                               self.show_weekly_trends)
+
+    def show_weekly_trends(self, result):
+        dates, DO1_values, DO2_values, Tx_values = result
+        dates = np.array(dates, dtype='datetime64[D]')
+        self.weekly_charts.update(dates, DO1_values, dates, DO2_values, dates, Tx_values)
+
     def plot_specific_date_trends(self):
         selected_date = self.entry_date.get()
         if not selected_date:
             messagebox.showerror("Error", "Please enter a valid date.")
             return
-        timestamps, DO1_values, DO2_values, Tx_values = self.device_manager.get_specific_date_trend(selected_date)
-        if not timestamps:
+
+        # The two charts sit side by side, so each gets about half the tab's width in pixels.
+        max_points = None
+        if not self.full_resolution.get():
+            max_points = max(self.tab4.winfo_width() // 2, 320)
+
+        def load():
+            timestamps, DO1_values, DO2_values, Tx_values = self.device_manager.get_specific_date_trend_arrays(
+                selected_date, as_datetime64=True)
+            if not len(timestamps):
+                return None
+            return downsample_trend(timestamps, DO1_values, DO2_values, Tx_values, max_points)
+
+        self.run_in_background('specific_date', "Loading trends for " + selected_date, load,
+                               self.show_specific_date_trends)
+
+    def show_specific_date_trends(self, result):
+        if result is None:
             messagebox.showerror("Error", "No data available for the selected date.")
             return
-
-        # Clear existing canvas widgets
-        for widget in self.tab4.winfo_children():
-            if isinstance(widget, tk.Frame):
-                widget.destroy()
-
-        # Create a frame for the canvas
-        plot_frame = tk.Frame(self.tab4)
-        plot_frame.pack(fill=tk.BOTH, expand=True)
-
-        # Create the first subplot for DO1 and DO2
-        fig, ax = plt.subplots()
-        timestamps = [datetime.fromtimestamp(ts) for ts in timestamps]
-        ax.plot(timestamps, DO1_values, marker='o', label='DO1')
-        ax.plot(timestamps, DO2_values, marker='s', label='DO2', linestyle='dashed')
-        ax.set_xlabel('Timestamp')
-        ax.set_ylabel('Value')
-        ax.set_title('Trends of DO1 and DO2')
-        ax.legend()
-        fig.autofmt_xdate()
-
-        # Create the second subplot for Temperature
-        fig2, ax2 = plt.subplots()
-        ax2.plot(timestamps, Tx_values, marker='x', label='Temperature')
-        ax2.set_xlabel('Timestamp')
-        ax2.set_ylabel('Temperature')
-        ax2.set_title('Temperature Trend')
-        ax2.legend()
-        fig2.autofmt_xdate()
-
-        # Create canvas for the first subplot
-        canvas = FigureCanvasTkAgg(fig, master=plot_frame)
-        canvas.draw()
-        canvas_widget = canvas.get_tk_widget()
-        canvas_widget.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-
-        # Create canvas for the second subplot
-        canvas2 = FigureCanvasTkAgg(fig2, master=plot_frame)
-        canvas2.draw()
-        canvas_widget2 = canvas2.get_tk_widget()
-        canvas_widget2.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.specific_date_charts.update(*result)
 
     def download_excel_report(self):
-        self.device_manager.log_readings_to_excel()
-        messagebox.showinfo("Success", "Excel report downloaded successfully.")
+        start_date = self.entry_export_start_date.get().strip() or None
+        end_date = self.entry_export_end_date.get().strip() or None
+        fmt = self.export_format.get()
+        self.run_in_background('export', "Writing %s report" % fmt,
+                               lambda: self.device_manager.export_readings(fmt, None, start_date, end_date),
+                               self.show_export_result)
+
+    def show_export_result(self, result):
+        filenames, rows, elapsed = result
+        if len(filenames) > 5:
+            filenames = filenames[:5] + ["... (%d files)" % len(filenames)]
+        messagebox.showinfo("Success", "Report downloaded successfully:\n%s\n\n%d readings in %.2f s (%.0f readings/s)"
+                            % ("\n".join(filenames), rows, elapsed, rows / elapsed if elapsed else 0))
 
 if __name__ == "__main__":
-    app = Application()
+    # --metrics FILE times the app and writes the metrics (JSON for .json,
+    # Prometheus text otherwise) to FILE on exit; slow queries go to FILE.slow.jsonl.
+    # --ingest ADDRESS has the ingest daemon listening there (tekx_ingest.py)
+    # commit the readings, so the CLI can log into the same database meanwhile.
+    options = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+    metrics_filename = options.get('--metrics')
+    metrics = Metrics(slow_query_log=metrics_filename + '.slow.jsonl') if metrics_filename else None
+    app = Application(metrics, options.get('--ingest'))
     app.mainloop()
+    if metrics is not None:
+        metrics.write(metrics_filename)